@@ -2,12 +2,16 @@
 # this repository contains the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import aeat
+from . import compare
+from . import export
 from . import invoice
+from . import reconciliation
 
 
 def register():
     Pool.register(
         aeat.Report,
+        aeat.ReportStaging,
         aeat.Issued,
         aeat.Received,
         aeat.Investment,
@@ -17,16 +21,28 @@ def register():
         invoice.TypeTemplateTax,
         invoice.Record,
         invoice.AEAT340RecordInvoiceLine,
+        invoice.RecordSummary,
         invoice.TemplateTax,
         invoice.Tax,
         invoice.Invoice,
         invoice.InvoiceLine,
         invoice.Recalculate340RecordStart,
         invoice.Recalculate340RecordEnd,
+        invoice.Recalculate340RecordScheduled,
+        invoice.Recalculate340RecordJob,
         invoice.Reasign340RecordStart,
         invoice.Reasign340RecordEnd,
+        export.ExportStart,
+        export.ExportResult,
+        compare.CompareFileStart,
+        compare.CompareFileResult,
+        reconciliation.ReconciliationContext,
+        reconciliation.Reconciliation,
+        reconciliation.ReconciliationInvoice,
         module='aeat_340', type_='model')
     Pool.register(
         invoice.Recalculate340Record,
         invoice.Reasign340Record,
+        export.Export,
+        compare.CompareFile,
         module='aeat_340', type_='wizard')
@@ -0,0 +1,138 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Aggregation of values by key shared by the generation of AEAT 340 records
+and the calculation of the reports
+
+The entries are kept by tuple keys in objects with slots where the summed
+amounts are stored in a list, and they are converted to the value
+dictionaries of the ORM only when they are created.
+"""
+
+__all__ = ['Accumulator']
+
+_MISSING = object()
+
+
+class _Entry(object):
+    __slots__ = ('values', 'sums', 'ids')
+
+    def __init__(self, values, sums, ids):
+        self.values = values
+        self.sums = sums
+        self.ids = ids
+
+
+class Accumulator(object):
+    '''
+    Aggregate value dictionaries by key.
+
+    The sum_fields are added, the min_fields and max_fields keep the lowest
+    and highest values and the ids of ids_field, a Many2Many or One2Many
+    field, are collected. The other values are those of the first
+    dictionary inserted for the key. A summed field that is missing in the
+    first dictionary is never added, and a None amount is ignored.
+    '''
+    __slots__ = ('sum_fields', 'min_fields', 'max_fields', 'ids_field',
+        '_index', '_entries')
+
+    def __init__(self, sum_fields, ids_field, min_fields=(), max_fields=()):
+        self.sum_fields = tuple(sum_fields)
+        self.min_fields = tuple(min_fields)
+        self.max_fields = tuple(max_fields)
+        self.ids_field = ids_field
+        self._index = dict((f, i) for i, f in enumerate(self.sum_fields))
+        self._entries = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.keys())
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def insert(self, key, vals):
+        'Store the value dictionary vals for the key which must be new'
+        assert key not in self._entries
+        values = dict(vals)
+        sums = [values.pop(f, _MISSING) for f in self.sum_fields]
+        ids = values.pop(self.ids_field, None)
+        if ids and isinstance(ids[0], (tuple, list)):
+            ids = ids[0][1]
+        self._entries[key] = _Entry(values, sums, list(ids or []))
+
+    def add(self, key, ids=(), **amounts):
+        '''
+        Add the amounts and the ids to the existing entry of key. The
+        min_fields and max_fields can be passed as amounts.
+        '''
+        entry = self._entries[key]
+        sums = entry.sums
+        index = self._index
+        for field, amount in amounts.iteritems():
+            if amount is None:
+                continue
+            if field in index:
+                i = index[field]
+                value = sums[i]
+                if value is _MISSING:
+                    continue
+                sums[i] = amount if value is None else value + amount
+            elif field in self.min_fields or field in self.max_fields:
+                value = entry.values.get(field)
+                if value is None:
+                    entry.values[field] = amount
+                elif field in self.min_fields:
+                    entry.values[field] = min(value, amount)
+                else:
+                    entry.values[field] = max(value, amount)
+            else:
+                raise KeyError(field)
+        entry.ids.extend(ids)
+
+    def merge(self, key, vals):
+        'Insert vals for key or add its amounts to the existing entry'
+        if key not in self._entries:
+            self.insert(key, vals)
+            return
+        amounts = dict((f, vals[f])
+            for f in self.sum_fields + self.min_fields + self.max_fields
+            if f in vals)
+        ids = vals.get(self.ids_field) or []
+        if ids and isinstance(ids[0], (tuple, list)):
+            ids = ids[0][1]
+        self.add(key, ids=ids, **amounts)
+
+    def get_value(self, key, field):
+        entry = self._entries[key]
+        if field in self._index:
+            value = entry.sums[self._index[field]]
+            return None if value is _MISSING else value
+        return entry.values.get(field)
+
+    def set_value(self, key, field, value):
+        entry = self._entries[key]
+        if field in self._index:
+            if entry.sums[self._index[field]] is not _MISSING:
+                entry.sums[self._index[field]] = value
+        else:
+            entry.values[field] = value
+
+    def get_vals(self, key):
+        'Return the value dictionary of the ORM for the entry of key'
+        entry = self._entries[key]
+        vals = entry.values.copy()
+        for field, value in zip(self.sum_fields, entry.sums):
+            if value is not _MISSING:
+                vals[field] = value
+        vals[self.ids_field] = [('add', list(entry.ids))]
+        return vals
+
+    def vlist(self):
+        'Return the list of value dictionaries of all the entries'
+        return [self.get_vals(k) for k in self._entries]
@@ -3,22 +3,45 @@
 # copyright notices and license terms.
 import itertools
 import datetime
+import gzip
+import json
+import operator
 import unicodedata
 from decimal import Decimal
+from io import BytesIO
 
 from retrofix import aeat340
-from retrofix.record import Record, write as retrofix_write
-from sql import Null
+from retrofix.record import Record
+from sql import Column, Literal, Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Exists
 
 from trytond import backend
-from trytond.model import ModelSQL, ModelView, fields, Workflow
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields, Workflow, Unique
 from trytond.pyson import Eval
 from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
-__all__ = ['Report', 'Issued', 'Received', 'Investment', 'Intracommunity']
+from .accumulator import Accumulator
+from .formatter import RecordFormatter, write as write_lines
+from .instrumentation import instrumented, measure, add_rows
+from .validation import LineValidator
+
+__all__ = ['Report', 'ReportStaging', 'Issued', 'Received', 'Investment',
+    'Intracommunity']
 
 _ZERO = Decimal('0.0')
+# Maximum number of line errors shown when a report is processed
+_MAX_ERRORS = 20
+# The amounts of the lines that are negated to cancel them
+_AMOUNTS = {'base', 'tax', 'total', 'equivalence_tax'}
+# The counters of the lines that are zero on the cancelling lines
+_COUNTS = {'record_count', 'issued_invoice_count', 'received_invoice_count'}
 
 BOOK_KEY = [
     ('E', 'Issued Invoices'),
@@ -106,11 +129,30 @@ def remove_accents(unicode_string):
     # It converts nfd to nfc to allow unicode.decode()
     return unicodedata.normalize('NFC', unicode_string_nfd)
 
+
+def compress(data):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def decompress(data):
+    with gzip.GzipFile(fileobj=BytesIO(data), mode='rb') as fp:
+        return fp.read()
+
 _STATES = {
     'readonly': Eval('state') != 'draft',
     }
 _DEPENDS = ['state']
 
+if config.getboolean('aeat_340', 'filestore', default=False):
+    file_id = 'file_id'
+    store_prefix = config.get('aeat_340', 'store_prefix', default=None)
+else:
+    file_id = None
+    store_prefix = None
+
 
 class Report(Workflow, ModelSQL, ModelView):
     '''
@@ -127,6 +169,8 @@ class Report(Workflow, ModelSQL, ModelView):
         states={
             'readonly': ~Eval('state').in_(['draft', 'calculated']),
             }, depends=['state'])
+    declaration_number = fields.Char('Declaration Number', size=13,
+        readonly=True)
     representative_vat = fields.Char('L.R. VAT number', size=9, states={
             'readonly': ~Eval('state').in_(['draft', 'calculated']),
             }, depends=['state'],
@@ -160,6 +204,13 @@ class Report(Workflow, ModelSQL, ModelView):
             'readonly': ~Eval('state').in_(['draft', 'calculated']),
             }, depends=['state'])
     calculation_date = fields.DateTime('Calculation Date', readonly=True)
+    calculation_done = fields.Integer('Calculated Records', readonly=True)
+    calculation_total = fields.Integer('Records to Calculate', readonly=True)
+    calculation_last_record = fields.Integer('Last Calculated Record',
+        readonly=True)
+    calculation_progress = fields.Function(fields.Float(
+            'Calculation Progress', digits=(16, 2)),
+        'get_calculation_progress')
     contact_phone = fields.Char('Phone', size=9,
         states={
             'readonly': ~Eval('state').in_(['draft', 'calculated']),
@@ -173,6 +224,7 @@ class Report(Workflow, ModelSQL, ModelView):
             ('2T', 'Second quarter'),
             ('3T', 'Third quarter'),
             ('4T', 'Fourth quarter'),
+            ('0A', 'Annual'),
             ('01', 'January'),
             ('02', 'February'),
             ('03', 'March'),
@@ -189,6 +241,14 @@ class Report(Workflow, ModelSQL, ModelView):
         states={
             'readonly': Eval('state') != 'draft',
             }, depends=['state'])
+    rollup = fields.Boolean('Roll Up Sub-period Reports',
+        states={
+            'readonly': Eval('state') != 'draft',
+            'invisible': ~Eval('period').in_(['1T', '2T', '3T', '4T', '0A']),
+            }, depends=['state', 'period'],
+        help='Calculate the report from the lines of the calculated reports '
+        'of its quarters and months and from the records of the months '
+        'without report.')
     issued_lines = fields.One2Many('aeat.340.report.issued', 'report',
         'Issued', states={
             'readonly': Eval('state') != 'calculated',
@@ -213,13 +273,17 @@ class Report(Workflow, ModelSQL, ModelView):
         'get_totals')
     total = fields.Function(fields.Numeric('Total', digits=(16, 2)),
         'get_totals')
-    file_ = fields.Binary('File', filename='filename', states={
+    file_ = fields.Binary('File', filename='filename',
+        file_id=file_id, store_prefix=store_prefix, states={
             'invisible': Eval('state') != 'done',
             })
+    file_id = fields.Char('File ID', readonly=True)
+    file_compressed = fields.Boolean('File Compressed', readonly=True)
     filename = fields.Function(fields.Char("File Name"),
         'get_filename')
     state = fields.Selection([
             ('draft', 'Draft'),
+            ('calculating', 'Calculating'),
             ('calculated', 'Calculated'),
             ('done', 'Done'),
             ('cancelled', 'Cancelled')
@@ -239,11 +303,14 @@ class Report(Workflow, ModelSQL, ModelView):
                     'Residence" but it maybe it isn\'t correct.\n'
                     'Please, check the lines of this party before process the '
                     'report.'),
+                'invalid_lines': ('The report "%(report)s" can not be '
+                    'processed because %(count)s errors were found in its '
+                    'lines:\n%(errors)s'),
                 })
         cls._buttons.update({
                 'draft': {
-                    'invisible': ~Eval('state').in_(['calculated',
-                            'cancelled']),
+                    'invisible': ~Eval('state').in_(['calculating',
+                            'calculated', 'cancelled']),
                     'icon': 'tryton-go-previous',
                     },
                 'calculate': {
@@ -258,10 +325,18 @@ class Report(Workflow, ModelSQL, ModelView):
                     'invisible': Eval('state').in_(['cancelled']),
                     'icon': 'tryton-cancel',
                     },
+                'archive': {
+                    'invisible': ((Eval('state') != 'done')
+                        | Eval('file_compressed', False)),
+                    },
                 })
         cls._transitions |= set((
+                ('draft', 'calculating'),
                 ('draft', 'calculated'),
                 ('draft', 'cancelled'),
+                ('calculating', 'draft'),
+                ('calculating', 'calculated'),
+                ('calculating', 'cancelled'),
                 ('calculated', 'draft'),
                 ('calculated', 'done'),
                 ('calculated', 'cancelled'),
@@ -318,29 +393,61 @@ class Report(Workflow, ModelSQL, ModelView):
             'record_count': dict([(x.id, 0) for x in reports]),
             'total': dict([(x.id, _ZERO) for x in reports]),
             }
-        for report in reports:
-            base = sum([x.base for x in report.lines])
-            tax = sum([x.tax for x in report.lines])
-            res['record_count'][report.id] += (len(report.issued_lines) +
-                len(report.received_lines) + len(report.investment_lines) +
-                len(report.intracommunity_lines))
-            res['taxable_total'][report.id] = base
-            res['sharetax_total'][report.id] = tax
-            res['total'][report.id] += base + tax
+        report_ids = [r.id for r in reports]
+        # Not decorated as the getter must keep the names argument
+        with measure('aeat.340.report.get_totals'):
+            cursor = Transaction().connection.cursor()
+            for Line in cls._get_line_models():
+                table = Line.__table__()
+                for sub_ids in grouped_slice(report_ids):
+                    cursor.execute(*table.select(table.report,
+                            Sum(table.base), Sum(table.tax), Count(table.id),
+                            where=reduce_ids(table.report, sub_ids),
+                            group_by=table.report))
+                    for report_id, base, tax, count in cursor.fetchall():
+                        # SQLite uses float for SUM
+                        if not isinstance(base, Decimal):
+                            base = Decimal(str(base or 0))
+                        if not isinstance(tax, Decimal):
+                            tax = Decimal(str(tax or 0))
+                        add_rows(count)
+                        res['record_count'][report_id] += count
+                        res['taxable_total'][report_id] += base
+                        res['sharetax_total'][report_id] += tax
+                        res['total'][report_id] += base + tax
+        for key in ('taxable_total', 'sharetax_total', 'total'):
+            for report_id, value in res[key].iteritems():
+                res[key][report_id] = value.quantize(Decimal('0.01'))
         for x in res.keys():
             if x not in names:
                 del res[x]
         return res
 
+    def get_calculation_progress(self, name):
+        if not self.calculation_total:
+            return None
+        return 100. * (self.calculation_done or 0) / self.calculation_total
+
     def get_filename(self, name):
-        return 'aeat340-%s-%s.txt' % (
+        filename = 'aeat340-%s-%s.txt' % (
             self.fiscalyear_code, self.period)
+        if self.file_compressed:
+            filename += '.gz'
+        return filename
 
     @property
     def lines(self):
         return itertools.chain(self.issued_lines, self.received_lines,
             self.investment_lines, self.intracommunity_lines)
 
+    @staticmethod
+    def _get_line_models():
+        'Return the line models in the order they are written to the file'
+        pool = Pool()
+        return [pool.get(n) for n in ('aeat.340.report.issued',
+                'aeat.340.report.received', 'aeat.340.report.investment',
+                'aeat.340.report.intracommunity')]
+
     @classmethod
     def validate(cls, reports):
         for report in reports:
@@ -355,164 +462,530 @@ class Report(Workflow, ModelSQL, ModelView):
     @Workflow.transition('draft')
     def draft(cls, reports):
         cls._delete_lines(reports)
+        cls.write(reports, {
+                'calculation_done': None,
+                'calculation_total': None,
+                'calculation_last_record': None,
+                })
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('calculated')
+    @instrumented('aeat.340.report.calculate')
     def calculate(cls, reports):
+        '''
+        Calculate the reports or, if the calculation by chunks is configured,
+        leave them to be calculated by the cron
+        '''
+        chunked = set()
+        if cls._get_calculation_chunk():
+            chunked = set(r for r in reports
+                if not r.rollup and r.type != 'C')
+        if chunked:
+            cls.schedule_calculation(list(chunked))
+        reports = [r for r in reports if r not in chunked]
+        if reports:
+            cls._calculate(reports)
+
+    @classmethod
+    @Workflow.transition('calculated')
+    def _calculate(cls, reports):
+        Data = Pool().get('aeat.340.record')
+
+        cls._delete_lines(reports)
+
+        to_create = {}
+        complementary = []
+        for report in reports:
+            months = None
+            previous = report._get_previous_report()
+            if previous:
+                complementary.append((report, previous))
+            elif report.rollup:
+                months = report._rollup_lines(to_create)
+                if not months:
+                    continue
+            report._aggregate_records(
+                Data.search(report._get_records_domain(months)), to_create)
+        cls._create_lines(to_create)
+        for report, previous in complementary:
+            report._keep_changes(previous)
+
+        cls.write(reports, {
+                'calculation_date': datetime.datetime.now(),
+                'calculation_done': None,
+                'calculation_total': None,
+                'calculation_last_record': None,
+                })
+
+    @classmethod
+    @Workflow.transition('calculating')
+    def schedule_calculation(cls, reports):
+        '''
+        Check the records of the reports and reset their calculation so the
+        cron calculates them by chunks
+        '''
+        Data = Pool().get('aeat.340.record')
+        for report in reports:
+            report.check_foreign_vat()
+        cls._delete_lines(reports)
+        for report in reports:
+            cls.write([report], {
+                    'calculation_done': 0,
+                    'calculation_total': Data.search(
+                        report._get_records_domain(), count=True),
+                    'calculation_last_record': None,
+                    })
+
+    @classmethod
+    def calculate_scheduled(cls):
+        'Calculate by chunks the scheduled reports, called by the cron'
+        transaction = Transaction()
+        chunk = cls._get_calculation_chunk()
+        with transaction.set_user(0, set_context=True):
+            reports = cls.search([
+                    ('state', '=', 'calculating'),
+                    ], order=[('id', 'ASC')])
+            for report in reports:
+                with transaction.set_context(company=report.company.id):
+                    cls._calculate_chunked(report, chunk)
+
+    @staticmethod
+    def _get_calculation_chunk():
+        '''
+        Return the number of records calculated per transaction or 0 to
+        calculate all the records of the report at once
+        '''
+        return (Transaction().context.get('aeat340_calculation_chunk')
+            or config.getint('aeat_340', 'calculation_chunk', default=0))
+
+    @staticmethod
+    def _get_months(period):
+        'Return the first month and the month after the last of period'
+        if period == '0A':
+            return 1, 13
+        multiplier = 1
+        if 'T' in period:
+            period = int(period[0]) - 1
+            multiplier = 3
+            start_month = period * multiplier + 1
+        else:
+            start_month = int(period) * multiplier
+        return start_month, start_month + multiplier
+
+    def _get_period_months(self):
+        'Return the first month and the month after the last of the period'
+        return self._get_months(self.period)
+
+    def _get_records_domain(self, months=None):
+        '''
+        Return the domain of the records of the report or only of months if
+        it is set
+        '''
+        if months is not None:
+            return [
+                ('fiscalyear', '=', self.fiscalyear.id),
+                ('month', 'in', list(months)),
+                ]
+        start_month, end_month = self._get_period_months()
+        return [
+            ('fiscalyear', '=', self.fiscalyear.id),
+            ('month', '>=', start_month),
+            ('month', '<', end_month),
+            ]
+
+    def _get_previous_report(self):
+        '''
+        Return the done report completed by the complementary report. It is
+        the report with the previous declaration number or else the last
+        done report of the same period.
+        '''
+        if self.type != 'C':
+            return
+        domain = [
+            ('company', '=', self.company.id),
+            ('state', '=', 'done'),
+            ('id', '!=', self.id),
+            ]
+        reports = []
+        if self.previous_number:
+            reports = self.search(domain + [
+                    ('declaration_number', '=', self.previous_number),
+                    ], limit=1)
+        if not reports:
+            reports = self.search(domain + [
+                    ('fiscalyear', '=', self.fiscalyear.id),
+                    ('period', '=', self.period),
+                    ], order=[('calculation_date', 'DESC'), ('id', 'DESC')],
+                limit=1)
+        if reports:
+            return reports[0]
+
+    def _keep_changes(self, previous):
+        '''
+        Keep only the lines of the report that are new or different from the
+        lines of the previous report and add, with their amounts negated and
+        their counters to zero as they have no records, the lines of the
+        previous report that no longer exist.
+
+        The report must have been fully calculated from all the records of
+        the period: this is a full recalculation followed by a diff, the
+        lines are identified by invoice number, book key, operation key and
+        tax rate and they are compared with set-based queries.
+        '''
         pool = Pool()
         Data = pool.get('aeat.340.record')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        record = Data.__table__()
+
+        def same(current, old, names):
+            return reduce(operator.and_, ((
+                        (Column(current, n) == Column(old, n))
+                        | ((Column(current, n) == Null)
+                            & (Column(old, n) == Null)))
+                    for n in names))
+
+        def cancel(old, name):
+            if name in _AMOUNTS:
+                return -Column(old, name)
+            elif name in _COUNTS:
+                return Literal(0)
+            return Column(old, name)
+
+        for Line in self._get_line_models():
+            target = Line.__table__()
+            current = Line.__table__()
+            old = Line.__table__()
+            names = [n for n, f in Line._fields.iteritems()
+                if not isinstance(f, fields.Function)
+                and n not in ('id', 'report', 'records', 'create_uid',
+                    'create_date', 'write_uid', 'write_date')]
+            identity = same(current, old, ['invoice_number', 'book_key',
+                    'operation_key', 'tax_rate'])
+            unchanged = same(current, old, names)
+
+            cursor.execute(*current.select(Max(current.id),
+                    where=current.report == self.id))
+            last_id, = cursor.fetchone()
+
+            cursor.execute(*target.insert(
+                    [Column(target, n) for n in names]
+                    + [target.report, target.create_uid, target.create_date],
+                    old.select(*([cancel(old, n) for n in names]
+                            + [Literal(self.id), Literal(transaction.user),
+                                CurrentTimestamp()]),
+                        where=(old.report == previous.id)
+                        & ~Exists(current.select(current.id,
+                                where=(current.report == self.id)
+                                & identity)))))
+
+            if last_id is None:
+                continue
+            unchanged_ids = current.select(current.id,
+                where=(current.report == self.id)
+                & (current.id <= last_id)
+                & Exists(old.select(old.id,
+                        where=(old.report == previous.id) & unchanged)))
+            # The records of the unchanged lines stay in the previous report
+            link = Column(record, self._get_record_link(Line.__name__))
+            cursor.execute(*record.update([link],
+                    [current.join(old, condition=unchanged).select(
+                            Min(old.id),
+                            where=(current.id == link)
+                            & (old.report == previous.id))],
+                    where=link.in_(unchanged_ids)))
+            cursor.execute(*target.delete(
+                    where=target.id.in_(unchanged_ids)))
+
+    @staticmethod
+    def _get_record_link(line_model):
+        'Return the name of the field of the records to the lines of model'
+        return line_model[len('aeat.340.report.'):]
+
+    def _get_rollup_reports(self):
+        '''
+        Return the calculated reports of the quarters and months of the
+        period that do not overlap, preferring the longest periods and the
+        latest calculations
+        '''
+        start_month, end_month = self._get_period_months()
+        periods = []
+        for period, _ in self._fields['period'].selection:
+            if period == self.period:
+                continue
+            start, end = self._get_months(period)
+            if start_month <= start and end <= end_month:
+                periods.append(period)
+        reports = self.search([
+                ('company', '=', self.company.id),
+                ('fiscalyear', '=', self.fiscalyear.id),
+                ('period', 'in', periods),
+                ('type', '=', 'N'),
+                ('state', 'in', ['calculated', 'done']),
+                ('id', '!=', self.id),
+                ], order=[('calculation_date', 'DESC'), ('id', 'DESC')])
+        reports.sort(key=lambda r: r._get_months(r.period)[0]
+            - r._get_months(r.period)[1])
+
+        covered = set()
+        rollup = []
+        for report in reports:
+            months = set(xrange(*report._get_period_months()))
+            if months & covered:
+                continue
+            covered |= months
+            rollup.append(report)
+        return rollup
+
+    def _rollup_lines(self, to_create):
+        '''
+        Add to to_create the lines of the calculated sub-period reports and
+        return the months for which there is no report
+        '''
+        months = set(xrange(*self._get_period_months()))
+        reports = self._get_rollup_reports()
+        if not reports:
+            return months
+        for Line in self._get_line_models():
+            fields_names = [n for n, f in Line._fields.iteritems()
+                if not isinstance(f, fields.Function)
+                and n not in ('id', 'report', 'records', 'create_uid',
+                    'create_date', 'write_uid', 'write_date')]
+            lines = to_create.get(Line.__name__)
+            if lines is None:
+                lines = to_create[Line.__name__] = (
+                    self._get_line_accumulator())
+            for vals in Line.search_read([
+                        ('report', 'in', [r.id for r in reports]),
+                        ], fields_names=fields_names):
+                add_rows(1)
+                key = (self.id, 'line', vals.pop('id'))
+                vals['report'] = self.id
+                lines.insert(key, vals)
+        for report in reports:
+            months -= set(xrange(*report._get_period_months()))
+        return months
+
+    def _aggregate_records(self, records, to_create):
+        '''
+        Aggregate the records into to_create, a dictionary of the line values
+        by key for each line model name
+        '''
+        pool = Pool()
         Issued = pool.get('aeat.340.report.issued')
         Received = pool.get('aeat.340.report.received')
         Investment = pool.get('aeat.340.report.investment')
-        Intracomunity = pool.get('aeat.340.report.intracommunity')
-        Model = pool.get('ir.model')
 
+        model_names = self._get_line_model_names()
+
+        for record in records:
+            add_rows(1)
+            key = (self.id, record.invoice.id, record.book_key,
+                record.operation_key, record.tax_rate)
+
+            issued = received = False
+            if record.book_key in ['E', 'F']:
+                line_type = Issued
+                issued = True
+            elif record.book_key in ['R', 'S']:
+                line_type = Received
+                received = True
+            elif record.book_key in ['I', 'J']:
+                line_type = Investment
+            else:
+                line_type = Intracommunity
+            lines = to_create.get(line_type.__name__)
+            if lines is None:
+                lines = to_create[line_type.__name__] = (
+                    self._get_line_accumulator())
+
+            _credit_note = all(l.amount <= 0 for l in record.invoice.lines)
+            if _credit_note:
+                sign = -1
+            else:
+                sign = 1
+            if record.operation_key == 'D':
+                assert _credit_note is True
+
+            if key in lines:
+                amounts = {
+                    'base': record.base * sign,
+                    'tax': record.tax * sign,
+                    'total': record.total * sign,
+                    }
+                if record.equivalence_tax and issued:
+                    amounts['equivalence_tax'] = (
+                        record.equivalence_tax * sign)
+                if (record.operation_key == 'B' and record.ticket_count
+                        and (issued or received)):
+                    if issued:
+                        amounts['issued_invoice_count'] = record.ticket_count
+                    else:
+                        amounts['received_invoice_count'] = (
+                            record.ticket_count)
+                    (amounts['first_invoice_number'],
+                        amounts['last_invoice_number']) = (
+                        record.get_first_last_invoice_number())
+                lines.add(key, ids=[record.id], **amounts)
+            else:
+                fiscal = record.get_fiscal_values()
+                if fiscal['fiscal_identifier_type'] != '1':
+                    self.raise_user_warning(
+                        'foreign_vat_%s_%s_%s' % (self.id,
+                            line_type.__name__, record.party.id),
+                        'foreign_vat_check_identifier_type', {
+                            'line_type': model_names[line_type.__name__],
+                            'report': self.rec_name,
+                            'party': fiscal['fiscal_name'],
+                            })
+
+                lines.insert(key, self._get_report_line_vals(record,
+                        line_type, sign))
+
+    @staticmethod
+    def _get_line_accumulator():
+        'Return the accumulator of the line values of a line model'
+        return Accumulator(('base', 'tax', 'total', 'equivalence_tax',
+                'issued_invoice_count', 'received_invoice_count'), 'records',
+            min_fields=('first_invoice_number',),
+            max_fields=('last_invoice_number',))
+
+    @staticmethod
+    def _get_line_model_names():
+        'Return the description of the line models by name'
+        Model = Pool().get('ir.model')
         models = Model.search([
                 ('model', 'in', ('aeat.340.report.issued',
-                    'aeat.340.report.received', 'aeat.340.report.investment',
-                    'aeat.340.report.intracommunity')),
+                        'aeat.340.report.received',
+                        'aeat.340.report.investment',
+                        'aeat.340.report.intracommunity')),
                 ])
-        model_names = {m.model: m.name for m in models}
-
-        cls._delete_lines(reports)
+        return {m.model: m.name for m in models}
 
-        issued_to_create = {}
-        received_to_create = {}
-        investment_to_create = {}
-        intracomunity_to_create = {}
-        for report in reports:
-            fiscalyear = report.fiscalyear
-            multiplier = 1
-            period = report.period
-            if 'T' in period:
-                period = int(period[0]) - 1
-                multiplier = 3
-                start_month = period * multiplier + 1
-            else:
-                start_month = int(period) * multiplier
+    @staticmethod
+    def _get_line_model_name(book_key):
+        'Return the name of the line model of the records of book_key'
+        if book_key in ('E', 'F'):
+            return 'aeat.340.report.issued'
+        elif book_key in ('R', 'S'):
+            return 'aeat.340.report.received'
+        elif book_key in ('I', 'J'):
+            return 'aeat.340.report.investment'
+        return 'aeat.340.report.intracommunity'
 
-            end_month = start_month + multiplier
+    @classmethod
+    def _create_lines(cls, to_create):
+        with Transaction().set_context(_check_access=False):
+            for Line in cls._get_line_models():
+                lines = to_create.get(Line.__name__)
+                if lines:
+                    Line.create(sorted(lines.vlist(),
+                            key=lambda x: x['issue_date']))
 
+    @classmethod
+    def _calculate_chunked(cls, report, chunk):
+        '''
+        Calculate the report committing every chunk records.
+
+        The records are read by id in ascending order and the aggregated
+        line values are kept in the staging table until all the records of
+        the report have been processed. If the calculation is interrupted,
+        the next run resumes after the last committed record.
+        '''
+        pool = Pool()
+        Data = pool.get('aeat.340.record')
+        Staging = pool.get('aeat.340.report.staging')
+        transaction = Transaction()
+
+        domain = report._get_records_domain()
+        last_id = report.calculation_last_record or 0
+        done = report.calculation_done or 0
+        while True:
+            records = Data.search(domain + [('id', '>', last_id)],
+                order=[('id', 'ASC')], limit=chunk or None)
+            if not records:
+                break
             to_create = {}
-            for record in Data.search([
-                    ('fiscalyear', '=', fiscalyear.id),
-                    ('month', '>=', start_month),
-                    ('month', '<', end_month)
-                    ]):
-                key = '%s-%s-%s-%s-%s' % (report.id, record.invoice.id,
-                    record.book_key, record.operation_key, record.tax_rate)
-
-                issued = received = False
-                if record.book_key in ['E', 'F']:
-                    to_create = issued_to_create
-                    line_type = Issued
-                    issued = True
-                elif record.book_key in ['R', 'S']:
-                    to_create = received_to_create
-                    line_type = Received
-                    received = True
-                elif record.book_key in ['I', 'J']:
-                    to_create = investment_to_create
-                    line_type = Investment
-                else:
-                    to_create = intracomunity_to_create
-                    line_type = Intracommunity
-
-                _credit_note = all(l.amount <= 0 for l in record.invoice.lines)
-                if _credit_note:
-                    sign = -1
-                else:
-                    sign = 1
-                if record.operation_key == 'D':
-                    assert _credit_note is True
-
-                if key in to_create:
-                    to_create[key]['base'] += record.base * sign
-                    to_create[key]['tax'] += record.tax * sign
-                    if record.equivalence_tax and issued:
-                        to_create[key]['equivalence_tax'] += (
-                            record.equivalence_tax * sign)
-                    to_create[key]['total'] += record.total * sign
-                    if (record.operation_key == 'B' and record.ticket_count
-                            and (issued or received)):
-                        if issued:
-                            to_create[key]['issued_invoice_count'] += (
-                                record.ticket_count)
-                        elif received:
-                            to_create[key]['received_invoice_count'] += (
-                                record.ticket_count)
-                        first_inv_number, last_inv_number = (
-                            record.get_first_last_invoice_number())
-                        if (first_inv_number
-                                and to_create[key]['first_invoice_number']
-                                and first_inv_number
-                                < to_create[key]['first_invoice_number']):
-                            to_create[key]['first_invoice_number'] = (
-                                first_inv_number)
-                        if (last_inv_number
-                                and to_create[key]['last_invoice_number']
-                                and last_inv_number
-                                < to_create[key]['last_invoice_number']):
-                            to_create[key]['last_invoice_number'] = (
-                                last_inv_number)
-                    to_create[key]['records'][0][1].append(record.id)
-                else:
-                    if (not record.party or not record.party.tax_identifier or
-                            record.party.tax_identifier.code[:2] != 'ES'):
-                        cls.raise_user_warning(
-                            'foreign_vat_%s_%s_%s' % (report.id,
-                                line_type.__name__, record.party.id),
-                            'foreign_vat_check_identifier_type', {
-                                'line_type': model_names[line_type.__name__],
-                                'report': report.rec_name,
-                                'party': record.party.rec_name,
-                                })
-
-                    to_create[key] = report._get_report_line_vals(record,
-                        line_type, sign)
+            report._aggregate_records(records, to_create)
+            Staging.stage(report, to_create)
+            last_id = records[-1].id
+            done += len(records)
+            cls.write([report], {
+                    'calculation_done': done,
+                    'calculation_last_record': last_id,
+                    })
+            transaction.commit()
+            # The report may have been reset while it was calculated
+            report = cls(report.id)
+            if report.state != 'calculating':
+                return
 
-        with Transaction().set_context(_check_access=False):
-            Issued.create(sorted(issued_to_create.values(),
-                    key=lambda x: x['issue_date']))
-            Received.create(sorted(received_to_create.values(),
-                    key=lambda x: x['issue_date']))
-            Investment.create(sorted(investment_to_create.values(),
-                    key=lambda x: x['issue_date']))
-            Intracomunity.create(sorted(intracomunity_to_create.values(),
-                    key=lambda x: x['issue_date']))
+        cls._create_lines(Staging.unstage(report))
+        cls._calculated([report])
+        transaction.commit()
 
+    @classmethod
+    @Workflow.transition('calculated')
+    def _calculated(cls, reports):
         cls.write(reports, {
                 'calculation_date': datetime.datetime.now(),
+                'calculation_last_record': None,
                 })
 
+    def check_foreign_vat(self):
+        '''
+        Warn about the parties without Spanish VAT number of the records of
+        the report
+        '''
+        pool = Pool()
+        Data = pool.get('aeat.340.record')
+        Party = pool.get('party.party')
+        cursor = Transaction().connection.cursor()
+        table = Data.__table__()
+
+        model_names = self._get_line_model_names()
+        start_month, end_month = self._get_period_months()
+        columns = [table.book_key, table.party,
+            table.fiscal_identifier_type, table.fiscal_name]
+        cursor.execute(*table.select(*columns,
+                where=(table.fiscalyear == self.fiscalyear.id)
+                & (table.month >= start_month) & (table.month < end_month)
+                & (Coalesce(table.fiscal_identifier_type, '') != '1'),
+                group_by=columns))
+        for book_key, party_id, identifier_type, name in cursor.fetchall():
+            if not identifier_type:
+                # Older records use the current data of the party
+                fiscal = Data.get_party_fiscal_values(Party(party_id))
+                if fiscal['fiscal_identifier_type'] == '1':
+                    continue
+                name = fiscal['fiscal_name']
+            line_model = self._get_line_model_name(book_key)
+            self.raise_user_warning(
+                'foreign_vat_%s_%s_%s' % (self.id, line_model, party_id),
+                'foreign_vat_check_identifier_type', {
+                    'line_type': model_names[line_model],
+                    'report': self.rec_name,
+                    'party': name or '',
+                    })
+
+    @instrumented('aeat.340.report._get_report_line_vals',
+        rows=lambda self, record, line_type, sign: 1, section=True)
     def _get_report_line_vals(self, record, line_type, sign):
         assert line_type.__name__ in (
                 'aeat.340.report.issued',
                 'aeat.340.report.received',
                 'aeat.340.report.investment',
                 'aeat.340.report.intracommunity')
+        fiscal = record.get_fiscal_values()
         vals = {
             'report': self.id,
             'company': record.company.id,
-            'party_nif': (record.party.tax_identifier.code[2:9]
-                if record.party.tax_identifier and
-                record.party.tax_identifier.code[:2] == 'ES' else ''),
+            'party_nif': fiscal['fiscal_nif'],
             # TODO: set representative_nif?
-            'party_name': record.party.name[:40],
-            'party_country': (
-                record.party.addresses[0].country.code
-                if (record.party.addresses and
-                    record.party.addresses[0].country and
-                    record.party.addresses[0].country.code)
-                else record.party.tax_identifier.code[:2]),
-            'party_identifier_type': ('1'
-                if record.party.tax_identifier and
-                record.party.tax_identifier.code[:2] == 'ES'
-                else '4'),
-            'party_identifier': (record.party.tax_identifier.code[:20]
-                if record.party.tax_identifier and
-                record.party.tax_identifier.code[:2] != 'ES' else ''),
+            'party_name': fiscal['fiscal_name'],
+            'party_country': fiscal['fiscal_country'],
+            'party_identifier_type': fiscal['fiscal_identifier_type'],
+            'party_identifier': fiscal['fiscal_identifier'],
             'book_key': record.book_key,
             'operation_key': record.operation_key,
             'issue_date': record.issue_date,
@@ -532,7 +1005,7 @@ class Report(Workflow, ModelSQL, ModelView):
                 'aeat.340.report.received'):
             vals['record_count'] = (
                 len(record.invoice.aeat340_records)
-                if record.operation_key == 'C' else 1),
+                if record.operation_key == 'C' else 1)
             if line_type.__name__ == 'aeat.340.report.issued':
                 vals.update({
                         'equivalence_tax': record.equivalence_tax,
@@ -573,8 +1046,10 @@ class Report(Workflow, ModelSQL, ModelView):
         Received = pool.get('aeat.340.report.received')
         Investment = pool.get('aeat.340.report.investment')
         Intracomunity = pool.get('aeat.340.report.intracommunity')
+        Staging = pool.get('aeat.340.report.staging')
         report_ids = [r.id for r in reports]
         with Transaction().set_context(from_report=True, _check_access=False):
+            Staging.delete(Staging.search([('report', 'in', report_ids)]))
             Issued.delete(Issued.search([('report', 'in', report_ids)]))
             Received.delete(Received.search([('report', 'in', report_ids)]))
             Investment.delete(Investment.search(
@@ -587,6 +1062,7 @@ class Report(Workflow, ModelSQL, ModelView):
     @Workflow.transition('done')
     def process(cls, reports):
         for report in reports:
+            report.check_lines()
             report.create_file()
 
     @classmethod
@@ -595,6 +1071,50 @@ class Report(Workflow, ModelSQL, ModelView):
     def cancel(cls, reports):
         pass
 
+    @classmethod
+    @ModelView.button
+    def archive(cls, reports):
+        'Compress the files of the done reports to archive them'
+        for report in reports:
+            if (report.state != 'done' or report.file_compressed
+                    or report.file_ is None):
+                continue
+            report.file_ = fields.Binary.cast(
+                compress(report.get_file_data()))
+            report.file_compressed = True
+            report.save()
+
+    @instrumented('aeat.340.report.validate_lines')
+    def validate_lines(self):
+        '''
+        Return the list of LineError of all the lines of the report read as
+        tuples
+        '''
+        errors = []
+        for Line in self._get_line_models():
+            validator = LineValidator(Line)
+            rows = list(Line.read_record_rows([self], validator.columns))
+            add_rows(len(rows))
+            errors.extend(validator.validate(rows))
+        return errors
+
+    def check_lines(self):
+        errors = self.validate_lines()
+        if not errors:
+            return
+        pool = Pool()
+        messages = []
+        for error in errors[:_MAX_ERRORS]:
+            Line = pool.get(error.model)
+            messages.append(Line.get_error_message(error))
+        if len(errors) > _MAX_ERRORS:
+            messages.append('...')
+        self.raise_user_error('invalid_lines', {
+                'report': self.rec_name,
+                'count': len(errors),
+                'errors': '\n'.join(messages),
+                })
+
     def auto_sequence(self):
         pool = Pool()
         Report = pool.get('aeat.340.report')
@@ -607,47 +1127,161 @@ class Report(Workflow, ModelSQL, ModelView):
             ], count=True)
         return count + 1
 
+    @instrumented('aeat.340.report.create_file')
     def create_file(self):
-        records = []
-        record = Record(aeat340.PRESENTER_HEADER_RECORD)
-        record.fiscalyear = str(self.fiscalyear_code)
-        record.nif = self.company_vat
-        record.presenter_name = self.company.party.name
-        record.support_type = self.support_type
-        record.contact_phone = self.contact_phone
-        record.contact_name = self.contact_name
         try:
             period = int(self.period)
             period = self.period
         except ValueError:
             period = '0%s' % self.period[:1]
-        record.declaration_number = int('340{}{}{:0>4}'.format(
-            self.fiscalyear_code,
-            period,
-            self.auto_sequence()))
-        # record.complementary =
-        # record.replacement =
-        record.previous_declaration_number = self.previous_number or '0'
-        record.period = self.period
-        record.record_count = self.record_count
-        record.total_base = self.taxable_total
-        record.total_tax = self.sharetax_total
-        record.total = self.total
-        record.representative_nif = self.representative_vat
-        records.append(record)
-        for line in self.lines:
-            record = line.get_record()
-            record.fiscalyear = str(self.fiscalyear_code)
-            record.nif = self.company_vat
-            records.append(record)
-
-        data = retrofix_write(records)
+        declaration_number = int('340{}{}{:0>4}'.format(
+                self.fiscalyear_code,
+                period,
+                self.auto_sequence()))
+        self.declaration_number = str(declaration_number)
+        header = {
+            'fiscalyear': str(self.fiscalyear_code),
+            'nif': self.company_vat,
+            'presenter_name': self.company.party.name,
+            'support_type': self.support_type,
+            'contact_phone': self.contact_phone,
+            'contact_name': self.contact_name,
+            'declaration_number': declaration_number,
+            'complementary': 'C' if self.type == 'C' else None,
+            'replacement': 'S' if self.type == 'S' else None,
+            'previous_declaration_number': self.previous_number or '0',
+            'period': self.period,
+            'record_count': self.record_count,
+            'total_base': self.taxable_total,
+            'total_tax': self.sharetax_total,
+            'total': self.total,
+            'representative_nif': self.representative_vat,
+            }
+        lines = [RecordFormatter(aeat340.PRESENTER_HEADER_RECORD, [],
+                header).format(())]
+        defaults = {
+            'fiscalyear': str(self.fiscalyear_code),
+            'nif': self.company_vat,
+            }
+        # Read the lines as plain tuples to not instantiate them
+        for Line in self._get_line_models():
+            columns = Line._get_record_columns()
+            formatter = RecordFormatter(Line._record_structure, columns,
+                defaults)
+            for row in Line.read_record_rows([self], columns):
+                add_rows(1)
+                lines.append(formatter.format(row))
+
+        data = write_lines(lines)
         data = remove_accents(data).upper()
         if isinstance(data, unicode):
             data = data.encode('iso-8859-1')
-        self.file_ = bytes(data)
+        self.file_compressed = False
+        self.file_ = fields.Binary.cast(data)
         self.save()
 
+    def get_file_data(self):
+        'Return the content of the file uncompressed'
+        if self.file_ is None:
+            return
+        data = bytes(self.file_)
+        if self.file_compressed:
+            data = decompress(data)
+        return data
+
+
+class ReportStaging(ModelSQL):
+    '''
+    AEAT 340 Report Calculation Staging
+    '''
+    __name__ = 'aeat.340.report.staging'
+    report = fields.Many2One('aeat.340.report', 'Report', required=True,
+        ondelete='CASCADE', select=True)
+    line_model = fields.Char('Line Model', required=True)
+    key = fields.Char('Key', required=True)
+    values = fields.Text('Values', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReportStaging, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('report_key_uniq', Unique(t, t.report, t.line_model, t.key),
+                'The key must be unique per report and line model.'),
+            ]
+
+    @staticmethod
+    def dumps(vals):
+        return json.dumps(vals, cls=JSONEncoder, separators=(',', ':'))
+
+    @staticmethod
+    def loads(values):
+        return json.loads(values, object_hook=JSONDecoder())
+
+    @staticmethod
+    def get_key(key):
+        return '-'.join(str(k) for k in key)
+
+    @classmethod
+    def stage(cls, report, to_create):
+        '''
+        Merge the line accumulators of to_create, a dictionary by line model
+        name, into the staged values of report
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        with Transaction().set_context(_check_access=False):
+            for line_model, lines in to_create.iteritems():
+                keys = dict((cls.get_key(k), k) for k in lines)
+                to_write = []
+                for sub_keys in grouped_slice(keys.keys()):
+                    for staged in cls.search([
+                                ('report', '=', report.id),
+                                ('line_model', '=', line_model),
+                                ('key', 'in', list(sub_keys)),
+                                ]):
+                        merged = Report._get_line_accumulator()
+                        merged.insert(staged.key, cls.loads(staged.values))
+                        vals = lines.get_vals(keys.pop(staged.key))
+                        if vals.get('operation_key') != 'B':
+                            # Only ticket summaries add up their counts
+                            for field in ('issued_invoice_count',
+                                    'received_invoice_count'):
+                                vals.pop(field, None)
+                        merged.merge(staged.key, vals)
+                        to_write.extend(([staged], {
+                                    'values': cls.dumps(
+                                        merged.get_vals(staged.key)),
+                                    }))
+                if to_write:
+                    cls.write(*to_write)
+                cls.create([{
+                            'report': report.id,
+                            'line_model': line_model,
+                            'key': key,
+                            'values': cls.dumps(lines.get_vals(k)),
+                            } for key, k in keys.iteritems()])
+
+    @classmethod
+    def unstage(cls, report):
+        '''
+        Return the staged line values of report with the structure of
+        to_create and delete them
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        to_create = {}
+        with Transaction().set_context(_check_access=False):
+            staged = cls.search([('report', '=', report.id)])
+            for line in staged:
+                lines = to_create.get(line.line_model)
+                if lines is None:
+                    lines = to_create[line.line_model] = (
+                        Report._get_line_accumulator())
+                lines.insert(line.key, cls.loads(line.values))
+            cls.delete(staged)
+        return to_create
+
 
 class LineMixin(object):
     _rec_name = 'party_name'
@@ -688,7 +1322,24 @@ class LineMixin(object):
                 'delete_state_invalid': ('Line "%s" cannot be deleted because '
                     'its report is not in Draft state.'),
                 'invalid_book_key': ('Invalid Book Key "%(key)s" for record '
-                    '"%(record)s".')
+                    '"%(record)s".'),
+                'invalid_operation_key': 'Invalid Operation Key "%(value)s".',
+                'too_long': ('The value "%(value)s" of field "%(field)s" is '
+                    'too long.'),
+                'missing_name': 'The party name is missing.',
+                'missing_invoice_number': 'The invoice number is missing.',
+                'invalid_nif': 'Invalid party NIF "%(value)s".',
+                'missing_nif': 'The party NIF is missing.',
+                'invalid_country': ('Invalid or missing party country '
+                    '"%(value)s".'),
+                'missing_identifier': 'The party identifier is missing.',
+                'invalid_property_state': ('Invalid property state '
+                    '"%(value)s" for the operation key.'),
+                'missing_cadaster_number': 'The cadaster number is missing.',
+                'invalid_cadaster_number': ('Invalid cadaster number '
+                    '"%(value)s".'),
+                'unexpected_cadaster_number': ('The cadaster number '
+                    '"%(value)s" is not allowed for the property state.'),
                 })
 
     def get_rec_name(self, name):
@@ -715,12 +1366,56 @@ class LineMixin(object):
             if value:
                 setattr(record, column, getattr(self, column))
 
+    def get_record(self):
+        record = Record(self._record_structure)
+        self.set_values(record)
+        return record
+
+    @classmethod
+    def _get_record_columns(cls):
+        'Return the stored fields of the line written to the 340 file'
+        return [x[2] for x in cls._record_structure
+            if x[2] in cls._fields
+            and not isinstance(cls._fields[x[2]], fields.Function)]
+
+    @classmethod
+    def read_record_rows(cls, reports, columns):
+        '''
+        Yield the values of columns for the lines of reports as tuples
+        ordered by id without instantiating the lines
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        sql_columns = [Column(table, c) for c in columns]
+        for sub_ids in grouped_slice([r.id for r in reports]):
+            cursor.execute(*table.select(*sql_columns,
+                    where=reduce_ids(table.report, sub_ids),
+                    order_by=[table.report.asc, table.id.asc]))
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+
     @classmethod
     def validate(cls, lines):
         super(LineMixin, cls).validate(lines)
         for line in lines:
             line.check_key()
 
+    @classmethod
+    def get_error_message(cls, error):
+        'Return the message of the LineError error'
+        line = cls(error.id)
+        field = cls._fields[error.field]
+        return '%s: %s' % (line.rec_name, cls.raise_user_error(error.code, {
+                    'key': error.value,
+                    'record': line.rec_name,
+                    'field': field.string,
+                    'value': error.value or '',
+                    }, raise_exception=False))
+
     def check_key(self):
         if self._possible_keys and self.book_key not in self._possible_keys:
             self.raise_user_error('invalid_book_key', {
@@ -773,6 +1468,7 @@ class Issued(LineMixin, ModelSQL, ModelView):
         'AEAT 340 Records', readonly=True)
 
     _possible_keys = ['E', 'F']
+    _record_structure = aeat340.ISSUED_RECORD
 
     @classmethod
     def __register__(cls, module_name):
@@ -817,11 +1513,6 @@ class Issued(LineMixin, ModelSQL, ModelView):
             return None
         return self.cadaster_number
 
-    def get_record(self):
-        record = Record(aeat340.ISSUED_RECORD)
-        self.set_values(record)
-        return record
-
 
 class Received(LineMixin, ModelSQL, ModelView):
     '''
@@ -837,6 +1528,7 @@ class Received(LineMixin, ModelSQL, ModelView):
         'AEAT 340 Records', readonly=True)
 
     _possible_keys = ['R', 'S']
+    _record_structure = aeat340.RECEIVED_RECORD
 
     @classmethod
     def __register__(cls, module_name):
@@ -858,11 +1550,6 @@ class Received(LineMixin, ModelSQL, ModelView):
                 values=[sql_table.invoice_count]))
             table.drop_column('invoice_count')
 
-    def get_record(self):
-        record = Record(aeat340.RECEIVED_RECORD)
-        self.set_values(record)
-        return record
-
 
 class Investment(LineMixin, ModelSQL, ModelView):
     '''
@@ -880,11 +1567,7 @@ class Investment(LineMixin, ModelSQL, ModelView):
         'AEAT 340 Records', readonly=True)
 
     _possible_keys = ['I', 'J']
-
-    def get_record(self):
-        record = Record(aeat340.INVESTMENT_RECORD)
-        self.set_values(record)
-        return record
+    _record_structure = aeat340.INVESTMENT_RECORD
 
 
 class Intracommunity(LineMixin, ModelSQL, ModelView):
@@ -906,8 +1589,4 @@ class Intracommunity(LineMixin, ModelSQL, ModelView):
         'AEAT 340 Records', readonly=True)
 
     _possible_keys = ['U']
-
-    def get_record(self):
-        record = Record(aeat340.INTRACOMMUNITY_RECORD)
-        self.set_values(record)
-        return record
+    _record_structure = aeat340.INTRACOMMUNITY_RECORD
@@ -0,0 +1,279 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import csv
+import gzip
+from decimal import Decimal
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+from retrofix import aeat340
+from retrofix.fields import (Numeric, SIGN_12, SIGN_N, SIGN_N_BLANK)
+
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+from .aeat import remove_accents
+from .instrumentation import instrumented, add_rows
+
+__all__ = ['CompareFileStart', 'CompareFileResult', 'CompareFile',
+    'FileError', 'read_file']
+
+_SPOOL_SIZE = 1024 * 1024
+_CENT = Decimal('0.01')
+
+DETAIL_STRUCTURES = {
+    'E': aeat340.ISSUED_RECORD,
+    'F': aeat340.ISSUED_RECORD,
+    'R': aeat340.RECEIVED_RECORD,
+    'S': aeat340.RECEIVED_RECORD,
+    'I': aeat340.INVESTMENT_RECORD,
+    'J': aeat340.INVESTMENT_RECORD,
+    'U': aeat340.INTRACOMMUNITY_RECORD,
+    }
+# Position of the book key in the detail records
+_BOOK_KEY = 98
+
+
+def _numeric_decoder(field):
+    signed = field._sign in (SIGN_12, SIGN_N, SIGN_N_BLANK)
+
+    def decode(value):
+        if signed:
+            if value[0] in ('1', 'N'):
+                return -int(value[1:])
+            value = value[1:]
+        return int(value.strip() or 0)
+    return decode
+
+
+def _compile(structure, names):
+    '''
+    Return the list of (start, end, decode) for names read from the
+    retrofix structure
+    '''
+    definitions = dict((d[2], d) for d in structure)
+    result = []
+    for name in names:
+        start, size, _, field = definitions[name]
+        if isinstance(field, type):
+            field = field()
+        if isinstance(field, Numeric):
+            decode = _numeric_decoder(field)
+        else:
+            decode = str.strip
+        result.append((start - 1, start - 1 + size, decode))
+    return result
+
+
+class FileError(Exception):
+    'Error on a line of a 340 file with its number and the erroneous value'
+
+    def __init__(self, line_number, value):
+        super(FileError, self).__init__(line_number, value)
+        self.line_number = line_number
+        self.value = value
+
+
+def read_file(file_, names):
+    '''
+    Yield for each detail record of the 340 file_, a file object, the tuple
+    of the values of names decoded with the retrofix record definitions.
+    Numeric values are returned as integers in units of their last decimal
+    to not use Decimal arithmetic on every line.
+    A FileError is raised for a line with an unknown book key or a value
+    that can not be decoded.
+    '''
+    parsers = {}
+    for line_number, line in enumerate(file_, 1):
+        line = line.rstrip('\r\n')
+        if not line or line[0] != '2':
+            continue
+        book_key = line[_BOOK_KEY:_BOOK_KEY + 1]
+        parser = parsers.get(book_key)
+        if parser is None:
+            if book_key not in DETAIL_STRUCTURES:
+                raise FileError(line_number, book_key)
+            parser = parsers[book_key] = _compile(
+                DETAIL_STRUCTURES[book_key], names)
+        try:
+            yield tuple(decode(line[start:end])
+                for start, end, decode in parser)
+        except ValueError:
+            raise FileError(line_number, line)
+
+
+class CompareFileStart(ModelView):
+    'AEAT 340 Compare File Start'
+    __name__ = 'aeat.340.compare_file.start'
+    report = fields.Many2One('aeat.340.report', 'Report', required=True)
+    file_ = fields.Binary('File', required=True)
+
+
+class CompareFileResult(ModelView):
+    'AEAT 340 Compare File Result'
+    __name__ = 'aeat.340.compare_file.result'
+    file_lines = fields.Integer('File Lines', readonly=True)
+    report_lines = fields.Integer('Report Lines', readonly=True)
+    only_file = fields.Integer('Only in File', readonly=True)
+    only_report = fields.Integer('Only in Report', readonly=True)
+    different = fields.Integer('Different', readonly=True)
+    differences = fields.Binary('Differences', filename='filename',
+        readonly=True)
+    filename = fields.Char('File Name', readonly=True)
+
+
+class CompareFile(Wizard):
+    '''
+    AEAT 340 Compare File
+
+    Compare the lines of a 340 file with the lines of a report. Both sides
+    are indexed by book key, invoice number and tax rate and compared with
+    set operations.
+    '''
+    __name__ = 'aeat.340.compare_file'
+    start = StateView('aeat.340.compare_file.start',
+        'aeat_340.aeat_340_compare_file_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Compare', 'compare', 'tryton-ok', default=True),
+            ])
+    compare = StateTransition()
+    result = StateView('aeat.340.compare_file.result',
+        'aeat_340.aeat_340_compare_file_result_view', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    _key_fields = ['book_key', 'invoice_number', 'tax_rate']
+    _value_fields = ['base', 'tax', 'total']
+
+    @classmethod
+    def __setup__(cls):
+        super(CompareFile, cls).__setup__()
+        cls._error_messages.update({
+                'invalid_file_line': ('The line %(line)s of the file is not '
+                    'a valid AEAT 340 record: "%(value)s".'),
+                })
+
+    def default_start(self, fields):
+        context = Transaction().context
+        defaults = {}
+        if context.get('active_model') == 'aeat.340.report':
+            defaults['report'] = context.get('active_id')
+        return defaults
+
+    @staticmethod
+    def _cents(value):
+        return int((value or Decimal(0)).quantize(_CENT) * 100)
+
+    @staticmethod
+    def _format(value):
+        if isinstance(value, (int, long)):
+            return str(Decimal(value).scaleb(-2))
+        return str(value)
+
+    @staticmethod
+    def _add(index, row, size):
+        key = row[:size]
+        values = index.get(key)
+        if values is None:
+            index[key] = list(row[size:])
+        else:
+            for i, value in enumerate(row[size:]):
+                values[i] += value
+
+    def get_file_index(self):
+        'Return the number of lines and the index of the file'
+        data = bytes(self.start.file_)
+        file_ = BytesIO(data)
+        if data[:2] == '\x1f\x8b':
+            file_ = gzip.GzipFile(fileobj=file_)
+        size = len(self._key_fields)
+        index = {}
+        count = 0
+        try:
+            for row in read_file(file_,
+                    self._key_fields + self._value_fields):
+                count += 1
+                self._add(index, row, size)
+        except FileError as e:
+            self.raise_user_error('invalid_file_line', {
+                    'line': e.line_number,
+                    'value': e.value.decode('iso-8859-1').strip(),
+                    })
+        return count, index
+
+    @staticmethod
+    def _file_text(value, size):
+        '''
+        Return value as it is written in the file by create_file: truncated,
+        encoded to latin-1 ignoring the other characters, without accents
+        and in upper case
+        '''
+        value = (value or '')[:size]
+        if isinstance(value, unicode):
+            value = value.encode('iso-8859-1', 'ignore')
+        value = remove_accents(value).upper()
+        if isinstance(value, unicode):
+            value = value.encode('iso-8859-1')
+        return value.strip()
+
+    def get_report_index(self):
+        'Return the number of lines and the index of the report'
+        Report = Pool().get('aeat.340.report')
+        size = len(self._key_fields)
+        columns = self._key_fields + self._value_fields
+        index = {}
+        count = 0
+        for Line in Report._get_line_models():
+            for row in Line.read_record_rows([self.start.report], columns):
+                count += 1
+                book_key, number, tax_rate = row[:size]
+                key = (book_key, self._file_text(number, 40),
+                    self._cents(tax_rate))
+                self._add(index, key + tuple(self._cents(v)
+                        for v in row[size:]), size)
+        return count, index
+
+    @instrumented('aeat.340.compare_file')
+    def transition_compare(self):
+        file_count, file_index = self.get_file_index()
+        report_count, report_index = self.get_report_index()
+        add_rows(file_count + report_count)
+        file_keys = set(file_index)
+        report_keys = set(report_index)
+        only_file = file_keys - report_keys
+        only_report = report_keys - file_keys
+        different = {k for k in file_keys & report_keys
+            if file_index[k] != report_index[k]}
+
+        with SpooledTemporaryFile(max_size=_SPOOL_SIZE) as file_:
+            writer = csv.writer(file_)
+            writer.writerow(['status'] + self._key_fields
+                + ['file_%s' % f for f in self._value_fields]
+                + ['report_%s' % f for f in self._value_fields])
+            empty = [''] * len(self._value_fields)
+            for status, keys in (('only_file', only_file),
+                    ('only_report', only_report),
+                    ('different', different)):
+                for key in sorted(keys):
+                    writer.writerow([status] + [self._format(k)
+                            for k in key]
+                        + [self._format(v)
+                            for v in file_index.get(key, empty)]
+                        + [self._format(v)
+                            for v in report_index.get(key, empty)])
+            file_.seek(0)
+            self.result.differences = fields.Binary.cast(file_.read())
+        self.result.filename = 'aeat340-differences.csv'
+        self.result.file_lines = file_count
+        self.result.report_lines = report_count
+        self.result.only_file = len(only_file)
+        self.result.only_report = len(only_report)
+        self.result.different = len(different)
+        return 'result'
+
+    def default_result(self, fields):
+        return {f: getattr(self.result, f) for f in ['file_lines',
+                'report_lines', 'only_file', 'only_report', 'different',
+                'differences', 'filename']}
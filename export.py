@@ -0,0 +1,316 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import csv
+import datetime
+import filecmp
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from decimal import Decimal
+from tempfile import NamedTemporaryFile
+
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+from .instrumentation import instrumented, add_rows
+
+__all__ = ['ExportStart', 'ExportResult', 'Export']
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+class _DigestWriter(object):
+    'Write to a file and compute the MD5 digest of the data written'
+
+    def __init__(self, file_):
+        self.file_ = file_
+        self.digest = hashlib.md5()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.file_.write(data)
+
+
+def _store_file(path, digest, prefix):
+    '''
+    Move the file at path to the filestore, without reading it, and return
+    its file id. The same ids as the filestore are used: the MD5 digest and
+    a counter on collisions.
+    '''
+    file_id = digest
+    collision = 0
+    while True:
+        filename = filestore._filename(file_id, prefix)
+        if not os.path.exists(filename):
+            dirname = os.path.dirname(filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0770)
+            os.rename(path, filename)
+            return file_id
+        if filecmp.cmp(path, filename, shallow=False):
+            return file_id
+        collision += 1
+        file_id = '%s-%s' % (digest, collision)
+
+
+class ExportStart(ModelView):
+    'AEAT 340 Export Start'
+    __name__ = 'aeat.340.export.start'
+    source = fields.Selection([
+            ('lines', 'Report Lines'),
+            ('records', 'Records'),
+            ], 'Source', required=True)
+    report = fields.Many2One('aeat.340.report', 'Report',
+        states={
+            'required': Eval('source') == 'lines',
+            'invisible': Eval('source') != 'lines',
+            }, depends=['source'])
+    company = fields.Many2One('company.company', 'Company',
+        states={
+            'required': Eval('source') == 'records',
+            'invisible': Eval('source') != 'records',
+            }, depends=['source'])
+    start_date = fields.Date('Start Date',
+        states={
+            'required': Eval('source') == 'records',
+            'invisible': Eval('source') != 'records',
+            }, depends=['source'])
+    end_date = fields.Date('End Date',
+        domain=[
+            ('end_date', '>=', Eval('start_date')),
+            ],
+        states={
+            'required': Eval('source') == 'records',
+            'invisible': Eval('source') != 'records',
+            }, depends=['source', 'start_date'])
+    format_ = fields.Selection([
+            ('csv', 'CSV'),
+            ('jsonl', 'JSON Lines'),
+            ], 'Format', required=True)
+
+    @staticmethod
+    def default_source():
+        return 'lines'
+
+    @staticmethod
+    def default_format_():
+        return 'csv'
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class ExportResult(ModelView):
+    'AEAT 340 Export Result'
+    __name__ = 'aeat.340.export.result'
+    attachment = fields.Many2One('ir.attachment', 'Attachment',
+        readonly=True)
+
+
+class Export(Wizard):
+    '''
+    AEAT 340 Export
+
+    Export the lines of a report or the records of a date range as CSV or
+    JSON Lines. The rows are read in batches as tuples and streamed to a
+    file of the filestore that is attached to the report or the company.
+    '''
+    __name__ = 'aeat.340.export'
+    start = StateView('aeat.340.export.start',
+        'aeat_340.aeat_340_export_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateTransition()
+    result = StateView('aeat.340.export.result',
+        'aeat_340.aeat_340_export_result_view', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    @classmethod
+    def __setup__(cls):
+        super(Export, cls).__setup__()
+        cls._error_messages.update({
+                'company_not_allowed': ('You are not allowed to export the '
+                    'records of company "%(company)s".'),
+                'report_not_allowed': ('You are not allowed to export the '
+                    'lines of report "%(report)s".'),
+                })
+
+    def default_start(self, fields):
+        context = Transaction().context
+        defaults = {}
+        if context.get('active_model') == 'aeat.340.report':
+            defaults['report'] = context.get('active_id')
+        return defaults
+
+    def get_rows(self):
+        '''
+        Return the column names and an iterator over the rows of the
+        selected source
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        Record = pool.get('aeat.340.record')
+        if self.start.source == 'records':
+            self.check_company(self.start.company)
+            columns = Record._get_export_columns()
+            return columns, Record.read_export_rows(self.start.company,
+                self.start.start_date, self.start.end_date, columns)
+
+        # The rows are read with SQL so the rules are checked with the ORM
+        reports = Report.search([('id', '=', self.start.report.id)])
+        if not reports:
+            self.raise_user_error('report_not_allowed', {
+                    'report': self.start.report.rec_name,
+                    })
+        report, = reports
+        models = Report._get_line_models()
+        columns = ['line_type']
+        model_columns = {}
+        for Line in models:
+            model_columns[Line] = Line._get_record_columns()
+            columns.extend(c for c in model_columns[Line]
+                if c not in columns)
+
+        def rows():
+            for Line in models:
+                indexes = [columns.index(c) for c in model_columns[Line]]
+                for row in Line.read_record_rows([report],
+                        model_columns[Line]):
+                    values = [None] * len(columns)
+                    values[0] = Line.__name__
+                    for index, value in zip(indexes, row):
+                        values[index] = value
+                    yield values
+        return columns, rows()
+
+    def check_company(self, company):
+        'Check the user is allowed to read the records of company'
+        User = Pool().get('res.user')
+        user_id = Transaction().user
+        if not user_id:
+            return
+        if company not in User(user_id).companies:
+            self.raise_user_error('company_not_allowed', {
+                    'company': company.rec_name,
+                    })
+
+    def get_filename(self):
+        if self.start.source == 'records':
+            name = 'aeat340-records-%s-%s' % (self.start.start_date,
+                self.start.end_date)
+        else:
+            name = 'aeat340-%s-%s' % (self.start.report.fiscalyear_code,
+                self.start.report.period)
+        return '%s.%s' % (name, self.start.format_)
+
+    def get_resource(self):
+        'Return the record to which the exported file is attached'
+        if self.start.source == 'records':
+            return self.start.company
+        return self.start.report
+
+    def write_rows(self, file_, columns, rows):
+        'Write the rows in the selected format to file_'
+        if self.start.format_ == 'csv':
+            writer = csv.writer(file_)
+            writer.writerow(columns)
+            for row in rows:
+                add_rows(1)
+                writer.writerow([_format_value(v) for v in row])
+        else:
+            for row in rows:
+                add_rows(1)
+                file_.write(json.dumps(OrderedDict(zip(columns, row)),
+                        default=_json_default, separators=(',', ':')))
+                file_.write('\n')
+
+    @instrumented('aeat.340.export')
+    def transition_export(self):
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+
+        # The file is written in the filestore directory to be moved there
+        # once its digest is known. If the attachments are not stored in the
+        # default filestore, the file must be read to be saved.
+        prefix = Attachment.data.store_prefix
+        if prefix is None:
+            prefix = Transaction().database.name
+        directory = None
+        if Attachment.data.file_id and not config.get('database', 'class'):
+            directory = os.path.normpath(os.path.join(
+                    config.get('database', 'path'), prefix))
+            if not os.path.exists(directory):
+                os.makedirs(directory, 0770)
+
+        columns, rows = self.get_rows()
+        file_ = NamedTemporaryFile(dir=directory, delete=False)
+        try:
+            with file_:
+                writer = _DigestWriter(file_)
+                self.write_rows(writer, columns, rows)
+            if directory:
+                values = {
+                    'file_id': _store_file(file_.name,
+                        writer.digest.hexdigest(), prefix),
+                    }
+            else:
+                with open(file_.name, 'rb') as fp:
+                    values = {
+                        'data': fields.Binary.cast(fp.read()),
+                        }
+        finally:
+            if os.path.exists(file_.name):
+                os.remove(file_.name)
+
+        resource = str(self.get_resource())
+        name = self.get_filename()
+        # The access to the report or the company is already checked
+        with Transaction().set_context(_check_access=False):
+            attachments = Attachment.search([
+                    ('resource', '=', resource),
+                    ('name', '=', name),
+                    ])
+            if attachments:
+                Attachment.write(attachments, values)
+                attachment, = attachments
+            else:
+                values.update({
+                        'resource': resource,
+                        'name': name,
+                        'type': 'data',
+                        })
+                attachment, = Attachment.create([values])
+        self.result.attachment = attachment
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'attachment': self.result.attachment.id,
+            }
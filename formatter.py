@@ -0,0 +1,188 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Fixed width formatting of the records of the AEAT 340 file
+
+The fields of the retrofix record structures are compiled once into
+formatting functions and each record is written with a template where the
+constant fields and the gaps between fields are already filled, so a row
+tuple is turned into a line without building a retrofix Record. The result
+is the same as the one of retrofix.
+"""
+import datetime
+import re
+from decimal import Decimal
+
+from retrofix.fields import (Field, Char, Const, Date, Number, Numeric,
+    SIGN_12, SIGN_N, SIGN_N_BLANK, SIGN_POSITIVE)
+from retrofix.formatting import format_number
+from retrofix.record import BLANK
+
+__all__ = ['RecordFormatter', 'write']
+
+_DIGITS = re.compile('[0-9]*$')
+_compiled = {}
+
+
+def _char(size):
+    def fmt(value):
+        if not value:
+            return BLANK * size
+        if isinstance(value, unicode):
+            value = value[:size].encode('iso-8859-1', 'ignore')
+        else:
+            value = str(value)[:size]
+        return value.ljust(size)
+    return fmt
+
+
+def _number(size, align):
+    def fmt(value):
+        if not value:
+            return BLANK * size
+        if isinstance(value, (int, long)):
+            value = str(value)
+        assert _DIGITS.match(value), (
+            'Non-number value "%s" in field' % value)
+        if align == 'right':
+            value = value.rjust(size, '0')
+        return str(value[:size]).ljust(size)
+    return fmt
+
+
+def _numeric(size, decimals, sign):
+    positive, negative = {
+        SIGN_12: ('2', '1'),
+        SIGN_N: ('', 'N'),
+        SIGN_N_BLANK: (' ', 'N'),
+        SIGN_POSITIVE: ('', ''),
+        }.get(sign, ('', '-'))
+    zero = positive + '0' * (size - len(positive))
+
+    def fmt(value):
+        if not value:
+            return zero
+        if isinstance(value, (int, long)):
+            is_negative = value < 0
+            text = str(abs(value)) + '0' * decimals
+        else:
+            if not isinstance(value, Decimal):
+                value = Decimal(value)
+            is_negative, digits, exponent = value.as_tuple()
+            if exponent == -decimals:
+                text = ''.join(map(str, digits))
+            else:
+                text = None
+        if is_negative:
+            assert sign != SIGN_POSITIVE, (
+                'Field must be >= 0.0 but got "%s"' % value)
+            prefix = negative
+        else:
+            prefix = positive
+        length = size - len(prefix)
+        if text is None or len(text) > length:
+            text = format_number(abs(Decimal(value)), length, decimals)
+        return prefix + text.rjust(length, '0')
+    return fmt
+
+
+def _date(size, pattern):
+    def fmt(value):
+        if not value:
+            return BLANK * size
+        if pattern == '%Y%m%d':
+            text = '%04d%02d%02d' % (value.year, value.month, value.day)
+        else:
+            text = datetime.datetime.strftime(value, pattern)
+        return text[:size].ljust(size)
+    return fmt
+
+
+def _generic(size, name, field):
+    def fmt(value):
+        field._size = size
+        field._name = name
+        if value:
+            value = field.set(value)
+        else:
+            value = None
+        return field.get_for_file(value)
+    return fmt
+
+
+def _compile(structure):
+    '''
+    Return the list of (start, size, name, const, fmt) of the structure where
+    const is the text of the constant fields and fmt the formatting function
+    of the others
+    '''
+    key = id(structure)
+    if key in _compiled and _compiled[key][0] is structure:
+        return _compiled[key][1]
+    result = []
+    for start, size, name, field in structure:
+        if not isinstance(field, Field):
+            field = field()
+        const, fmt = None, None
+        if isinstance(field, Const):
+            const = field._const
+        elif isinstance(field, Number):
+            fmt = _number(size, field._align)
+        elif isinstance(field, Numeric):
+            fmt = _numeric(size, field._decimals, field._sign)
+        elif isinstance(field, Date):
+            fmt = _date(size, field._pattern)
+        elif type(field) is Char:
+            fmt = _char(size)
+        else:
+            fmt = _generic(size, name, field)
+        result.append((start, size, name, const, fmt))
+    _compiled[key] = (structure, result)
+    return result
+
+
+class RecordFormatter(object):
+    '''
+    Format rows of the values of columns with the retrofix structure.
+
+    The values of the fields which are not in columns are taken from
+    defaults, a dictionary, and are formatted only once.
+    '''
+    __slots__ = ('columns', '_template', '_fields')
+
+    def __init__(self, structure, columns, defaults=None):
+        defaults = defaults or {}
+        self.columns = tuple(columns)
+        index = dict((c, i) for i, c in enumerate(self.columns))
+        template = []
+        fields = []
+        position = 1
+        for start, size, name, const, fmt in _compile(structure):
+            assert start >= position, ('Error writing field "%s". Start: %d, '
+                'Current Position: %d' % (name, start, position))
+            template.append(BLANK * (start - position))
+            if const is not None:
+                text = const
+            elif name in index:
+                text = None
+                fields.append((index[name], fmt))
+            else:
+                text = fmt(defaults.get(name))
+            if text is None:
+                template.append('%s')
+            else:
+                assert len(text) == size, ('Field "%s" should be of size '
+                    '"%d" but got "%d".' % (name, size, len(text)))
+                template.append(text.replace('%', '%%'))
+            position = start + size
+        self._template = ''.join(template)
+        self._fields = tuple(fields)
+
+    def format(self, row):
+        'Return the line of the row'
+        return self._template % tuple(fmt(row[i]) for i, fmt in self._fields)
+
+
+def write(lines, separator='\r\n'):
+    'Return the data of the file of lines like retrofix write'
+    return ''.join(line + separator for line in lines)
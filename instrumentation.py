@@ -0,0 +1,202 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Optional instrumentation of the AEAT 340 hot paths
+
+It is enabled with the ``aeat340_instrument`` context key or with the
+``instrument`` option of the ``aeat_340`` configuration section. Every
+measured call reports its elapsed time, number of SQL statements, rows
+processed and rows per second to the logger of this module and to the
+callbacks registered with ``register_callback``.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['register_callback', 'unregister_callback', 'enabled',
+    'count_queries', 'measure', 'instrumented', 'add_rows']
+
+logger = logging.getLogger(__name__)
+
+_CONFIG_ENABLED = config.getboolean('aeat_340', 'instrument', default=False)
+_callbacks = []
+_local = threading.local()
+
+
+def register_callback(callback):
+    '''
+    Register a callable called with a dictionary of statistics (name,
+    elapsed, queries, rows, rate and sections) for each measure
+    '''
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+
+
+def unregister_callback(callback):
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+
+def enabled():
+    return (_CONFIG_ENABLED
+        or bool(Transaction().context.get('aeat340_instrument')))
+
+
+class _CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection(object):
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._connection.cursor(*args, **kwargs),
+            self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def count_queries():
+    '''
+    Count the SQL statements executed through the connection of the current
+    transaction. The yielded list contains the count as first item.
+    '''
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = [0]
+    transaction.connection = _CountingConnection(connection, counter)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+class _Measure(object):
+    __slots__ = ('name', 'rows', 'elapsed', 'queries', 'calls', 'sections')
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.elapsed = 0.
+        self.queries = 0
+        self.calls = 0
+        self.sections = {}
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'elapsed': self.elapsed,
+            'queries': self.queries,
+            'rows': self.rows,
+            'rate': self.rows / self.elapsed if self.elapsed else None,
+            'calls': self.calls,
+            'sections': dict((n, s.stats())
+                for n, s in self.sections.iteritems()),
+            }
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _emit(measure):
+    stats = measure.stats()
+    logger.info('%s: %.3fs, %d queries, %d rows, %s rows/s', stats['name'],
+        stats['elapsed'], stats['queries'], stats['rows'],
+        '%.1f' % stats['rate'] if stats['rate'] is not None else '-')
+    for section in sorted(stats['sections'].itervalues(),
+            key=lambda s: s['name']):
+        logger.info('%s > %s: %d calls, %.3fs, %d queries', stats['name'],
+            section['name'], section['calls'], section['elapsed'],
+            section['queries'])
+    for callback in _callbacks:
+        try:
+            callback(stats)
+        except Exception:
+            logger.exception('instrumentation callback %r failed', callback)
+
+
+@contextmanager
+def measure(name, rows=0, section=False):
+    '''
+    Measure the enclosed block as name. If section is set and the block is
+    run inside another measure, the calls are accumulated in the sections of
+    the enclosing measure instead of being reported individually.
+    '''
+    if not enabled():
+        yield None
+        return
+    stack = _stack()
+    standalone = not (section and stack)
+    if standalone:
+        current = _Measure(name)
+    else:
+        current = stack[-1].sections.get(name)
+        if current is None:
+            current = stack[-1].sections[name] = _Measure(name)
+    current.rows += rows
+    current.calls += 1
+    stack.append(current)
+    start = time.time()
+    try:
+        with count_queries() as counter:
+            yield current
+    finally:
+        current.elapsed += time.time() - start
+        current.queries += counter[0]
+        stack.pop()
+        if standalone:
+            _emit(current)
+
+
+def instrumented(name, rows=None, section=False):
+    '''
+    Decorate a function to be measured as name. rows is an optional
+    callable that receives the arguments of the function and returns the
+    number of rows it processes.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with measure(name, rows(*args, **kwargs) if rows else 0,
+                    section=section):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_rows(count):
+    'Add count rows to the innermost running measure'
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].rows += count
@@ -1,29 +1,51 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import re
 from decimal import Decimal
-from sql import Literal, Null
-from sql.aggregate import Count
-from sql.operators import In
+from sql import Cast, Column, Literal, Null, Table
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, Round
+from sql.operators import Concat
 import logging
 
 from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserError, UserWarning
 from trytond.model import ModelSQL, ModelView, Unique, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
-from trytond.tools import grouped_slice
+from trytond.pyson import Bool, Eval, If
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
-from .aeat import BOOK_KEY, OPERATION_KEY
+from .accumulator import Accumulator
+from .aeat import BOOK_KEY, OPERATION_KEY, PARTY_IDENTIFIER_TYPE
+from .instrumentation import instrumented
 
 __all__ = ['Type', 'TypeTax', 'TypeTemplateTax',
-    'Record', 'AEAT340RecordInvoiceLine',
+    'Record', 'AEAT340RecordInvoiceLine', 'RecordSummary',
     'TemplateTax', 'Tax', 'Invoice', 'InvoiceLine',
     'Recalculate340RecordStart', 'Recalculate340RecordEnd',
-    'Recalculate340Record', 'Reasign340RecordStart',
+    'Recalculate340RecordScheduled', 'Recalculate340Record',
+    'Recalculate340RecordJob', 'Reasign340RecordStart',
     'Reasign340RecordEnd', 'Reasign340Record']
 
 
+_SUMMARY_TOTALS = ('base', 'tax', 'total', 'equivalence_tax', 'record_count',
+    'invoice_count')
+
+
+def _add(x, y):
+    'Return the sum of x and y where None is no value'
+    if x is None:
+        return y
+    if y is None:
+        return x
+    return x + y
+
+
 class Type(ModelSQL, ModelView):
     """
     AEAT 340 Type
@@ -34,6 +56,8 @@ class Type(ModelSQL, ModelView):
 
     book_key = fields.Selection(BOOK_KEY, 'Book key',
         required=True)
+    _book_key_labels_cache = Cache('aeat.340.type.book_key_labels',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -44,12 +68,38 @@ class Type(ModelSQL, ModelView):
                 'Book key must be unique.')
             ]
 
+    @classmethod
+    def get_book_key_labels(cls):
+        'Return the translated label of each book key'
+        language = Transaction().language
+        labels = cls._book_key_labels_cache.get(language)
+        if labels is None:
+            labels = dict(
+                cls.fields_get(['book_key'])['book_key']['selection'])
+            cls._book_key_labels_cache.set(language, labels)
+        return labels
+
     def get_rec_name(self, name):
-        opts = self.fields_get('book_key')['book_key']['selection']
-        for key, value in opts:
-            if self.book_key == key:
-                return value
-        return self.book_key
+        return self.get_book_key_labels().get(self.book_key, self.book_key)
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        _, operator, value = clause
+        negative = operator.startswith('not ') or operator == '!='
+        if negative:
+            operator = {'!=': '='}.get(operator, operator[4:])
+        labels = cls.get_book_key_labels().iteritems()
+        if operator in ('like', 'ilike'):
+            pattern = re.compile('^%s$' % ''.join(
+                    '.*' if c == '%' else '.' if c == '_' else re.escape(c)
+                    for c in value or ''),
+                re.IGNORECASE if operator == 'ilike' else 0)
+            keys = [k for k, l in labels if pattern.match(l)]
+        elif operator == 'in':
+            keys = [k for k, l in labels if l in (value or [])]
+        else:
+            keys = [k for k, l in labels if l == value]
+        return [('book_key', 'not in' if negative else 'in', keys)]
 
 
 class TypeTax(ModelSQL):
@@ -63,6 +113,25 @@ class TypeTax(ModelSQL):
     tax = fields.Many2One('account.tax', 'Tax', ondelete='CASCADE',
         select=True, required=True)
 
+    @classmethod
+    def create(cls, vlist):
+        Tax = Pool().get('account.tax')
+        records = super(TypeTax, cls).create(vlist)
+        Tax._aeat340_keys_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        Tax = Pool().get('account.tax')
+        super(TypeTax, cls).write(*args)
+        Tax._aeat340_keys_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        Tax = Pool().get('account.tax')
+        super(TypeTax, cls).delete(records)
+        Tax._aeat340_keys_cache.clear()
+
 
 class TypeTemplateTax(ModelSQL):
     """
@@ -105,9 +174,12 @@ class Record(ModelSQL, ModelView):
     """
     __name__ = 'aeat.340.record'
 
-    invoice = fields.Many2One('account.invoice', 'Invoice', readonly=True)
+    invoice = fields.Many2One('account.invoice', 'Invoice', readonly=True,
+        select=True)
     invoice_lines = fields.Many2Many('aeat.340.record-account.invoice.line',
         'aeat340_record', 'invoice_line', 'Invoice Lines')
+    account_tax = fields.Many2One('account.tax', 'Account Tax',
+        readonly=True)
     company = fields.Many2One('company.company', 'Company', required=True,
         readonly=True)
     fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
@@ -115,6 +187,13 @@ class Record(ModelSQL, ModelView):
     month = fields.Integer('Month', readonly=True)
     party = fields.Many2One('party.party', 'Party', required=True,
         readonly=True)
+    fiscal_name = fields.Char('Fiscal Name', size=40, readonly=True)
+    fiscal_nif = fields.Char('Fiscal NIF', size=9, readonly=True)
+    fiscal_identifier = fields.Char('Fiscal Identifier', size=20,
+        readonly=True)
+    fiscal_identifier_type = fields.Selection([(None, '')]
+        + PARTY_IDENTIFIER_TYPE, 'Fiscal Identifier Type', readonly=True)
+    fiscal_country = fields.Char('Fiscal Country', size=2, readonly=True)
     book_key = fields.Selection(BOOK_KEY, 'Book Key', sort=False,
         required=True)
     operation_key = fields.Selection(OPERATION_KEY, 'Operation Key',
@@ -143,66 +222,299 @@ class Record(ModelSQL, ModelView):
     intracommunity = fields.Many2One('aeat.340.report.intracommunity',
         'Intracommunity')
 
+    @classmethod
+    def __setup__(cls):
+        super(Record, cls).__setup__()
+        cls._error_messages.update({
+                'delete_done_report': ('The AEAT 340 records of invoice '
+                    '"%(invoice)s" can not be deleted because they are '
+                    'included in the done report "%(report)s".'),
+                })
+
     @classmethod
     def __register__(cls, module_name):
-        pool = Pool()
-        Party = pool.get('party.party')
         TableHandler = backend.get('TableHandler')
 
         super(Record, cls).__register__(module_name)
 
         # Migration from 3.4.5: add party field instead of party data fields
-        cursor = Transaction().connection.cursor()
         handler = TableHandler(cls, module_name)
-        party_name_exists = handler.column_exist('party_name')
-        if party_name_exists:
+        if handler.column_exist('party_name'):
             # first time module migrated or not all records has been migrated
+            cls._migrate_party_data()
             table = cls.__table__()
-            party = Party.__table__()
-
-            select_query = table.join(party,
-                type_='LEFT',
-                condition=(
-                    ((table.party_nif != Null)
-                        & (table.party_nif != '')
-                        & (party.vat_number == table.party_nif))
-                    | (party.name == table.party_name))
-                ).select(
-                    table.id, party.id,
-                    where=(table.party == Null),
-                    group_by=(table.id, party.id),
-                    having=(Count(party.id) != 1))
-            cursor.execute(*select_query)
-            party_not_found_ids = [r[0] for r in cursor.fetchall()]
-
-            update_query = table.update([table.party], [party.id],
-                from_=[party],
-                where=(
-                    ((table.party_nif != Null)
-                        & (table.party_nif != '')
-                        & (party.vat_number == table.party_nif))
-                    | (party.name == table.party_name)))
-
-            if party_not_found_ids:
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(Count(table.id),
+                    where=table.party == Null))
+            not_found, = cursor.fetchone()
+            if not_found:
                 logger = logging.getLogger(cls.__name__)
                 logger.warning('It can\'t found the correct party for %s %s. '
                     'Maybe there are any party with the same name or '
-                    'vat_number than record or there are more than one '
-                    'matching party. Fix it manually.',
-                    len(party_not_found_ids), cls.__name__)
+                    'vat_number than record. Fix it manually.',
+                    not_found, cls.__name__)
+                select_query = table.select(table.id, table.party_nif,
+                    table.party_name, where=table.party == Null)
                 logger.warning('You can use this query: %s (params: %s)',
                     select_query, select_query.params)
-                update_query.where &= ~table.id.in_(party_not_found_ids)
-                cursor.execute(*update_query)
                 handler.not_null_action('party_identifier_type',
                     action='remove')
             else:
-                cursor.execute(*update_query)
                 handler.drop_column('party_name')
                 handler.drop_column('party_nif')
                 handler.drop_column('party_country')
                 handler.drop_column('party_identifier_type')
 
+        # Migration from 4.0: set the tax of the records created before it
+        # was stored
+        cls._migrate_account_tax()
+
+    @classmethod
+    def _migrate_party_data(cls):
+        '''
+        Set the party of the records without party from the stored party
+        data. The records are processed by ranges of ids and the parties are
+        matched first by Spanish VAT identifier, as the VAT number of the
+        parties has been migrated to their identifiers, and then by name,
+        each pass being an equality join that can use the indexes. The records
+        that match several parties are left without party, so they are
+        reported to be fixed manually.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        cursor = Transaction().connection.cursor()
+        logger = logging.getLogger(cls.__name__)
+        table = cls.__table__()
+        party = Party.__table__()
+        identifier = Identifier.__table__()
+        match = Table('aeat_340_record_party_match')
+        batch = config.getint('aeat_340', 'migration_batch', default=50000)
+
+        cursor.execute(*table.select(Min(table.id), Max(table.id),
+                Count(table.id), where=table.party == Null))
+        min_id, max_id, total = cursor.fetchone()
+        if not total:
+            return
+
+        cursor.execute('CREATE TEMPORARY TABLE "%s" '
+            '(record INTEGER, party INTEGER)' % match._name)
+        cursor.execute('CREATE INDEX "%s_record_index" ON "%s" (record)'
+            % (match._name, match._name))
+
+        migrated = 0
+        for start in xrange(min_id, max_id + 1, batch):
+            in_range = ((table.id >= start) & (table.id < start + batch)
+                & (table.party == Null))
+            # VAT pass
+            cursor.execute(*match.insert([match.record, match.party],
+                    table.join(identifier,
+                        condition=identifier.code
+                        == Concat('ES', table.party_nif)
+                        ).select(table.id,
+                        Case((Count(identifier.party, distinct=True) == 1,
+                                Min(identifier.party)), else_=Null),
+                        where=in_range
+                        & (table.party_nif != Null)
+                        & (table.party_nif != ''),
+                        group_by=table.id)))
+            # Name pass for the records without VAT match
+            cursor.execute(*match.insert([match.record, match.party],
+                    table.join(party,
+                        condition=party.name == table.party_name
+                        ).select(table.id, Min(party.id),
+                        where=in_range
+                        & ~table.id.in_(match.select(match.record)),
+                        group_by=table.id,
+                        having=Count(party.id, distinct=True) == 1)))
+            matched = match.select(match.record, where=match.party != Null)
+            cursor.execute(*table.update([table.party],
+                    [match.select(match.party,
+                            where=match.record == table.id)],
+                    where=in_range & table.id.in_(matched)))
+            cursor.execute(*match.select(Count(match.record),
+                    where=match.party != Null))
+            count, = cursor.fetchone()
+            migrated += count
+            cursor.execute(*match.delete())
+            logger.info('Migrated party of %s/%s %s', migrated, total,
+                cls.__name__)
+        cursor.execute('DROP TABLE "%s"' % match._name)
+
+    @classmethod
+    def _migrate_account_tax(cls):
+        '''
+        Set the tax of the records without tax from the taxes of their
+        invoice lines. The records are updated by ranges of ids and the tax
+        is the tax of the lines whose rate, or the rate of one of its
+        children, is the tax rate of the record. The records that match
+        several taxes are left without tax and are not reconciled with the
+        ledger until their invoices are recalculated.
+        '''
+        pool = Pool()
+        RecordLine = pool.get('aeat.340.record-account.invoice.line')
+        LineTax = pool.get('account.invoice.line-account.tax')
+        Tax = pool.get('account.tax')
+        cursor = Transaction().connection.cursor()
+        logger = logging.getLogger(cls.__name__)
+        table = cls.__table__()
+        record_line = RecordLine.__table__()
+        line_tax = LineTax.__table__()
+        tax = Tax.__table__()
+        child = Tax.__table__()
+        batch = config.getint('aeat_340', 'migration_batch', default=50000)
+        tax_rate = Cast(table.tax_rate, cls.tax_rate.sql_type().base)
+
+        cursor.execute(*table.select(Min(table.id), Max(table.id),
+                Count(table.id), where=table.account_tax == Null))
+        min_id, max_id, total = cursor.fetchone()
+        if not total:
+            return
+
+        # The subquery returns no row if several taxes match
+        record_tax = record_line.join(line_tax,
+            condition=line_tax.line == record_line.invoice_line
+            ).join(tax, condition=line_tax.tax == tax.id
+            ).join(child, 'LEFT', condition=child.parent == tax.id
+            ).select(Min(tax.id),
+            where=(record_line.aeat340_record == table.id)
+            & ((Round(tax.rate * 100, 2) == tax_rate)
+                | (Round(child.rate * 100, 2) == tax_rate)),
+            having=Count(tax.id, distinct=True) == 1)
+        for start in xrange(min_id, max_id + 1, batch):
+            cursor.execute(*table.update([table.account_tax], [record_tax],
+                    where=(table.id >= start) & (table.id < start + batch)
+                    & (table.account_tax == Null)))
+            logger.info('Migrated tax of %s up to id %s/%s', cls.__name__,
+                min(start + batch - 1, max_id), max_id)
+
+        cursor.execute(*table.select(Count(table.id),
+                where=table.account_tax == Null))
+        not_found, = cursor.fetchone()
+        if not_found:
+            logger.warning('The tax of %s %s could not be found. They are '
+                'not reconciled with the ledger until the records of their '
+                'invoices are recalculated.', not_found, cls.__name__)
+
+    @classmethod
+    def delete_invoice_records(cls, invoice_ids):
+        '''
+        Delete with SQL the records of the invoices. It fails if any of them
+        is included in a done report.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Report = pool.get('aeat.340.report')
+        RecordLine = pool.get('aeat.340.record-account.invoice.line')
+        Summary = pool.get('aeat.340.record.summary')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        record_line = RecordLine.__table__()
+        report = Report.__table__()
+
+        totals = Summary.get_invoice_totals(invoice_ids)
+        for sub_ids in grouped_slice(invoice_ids):
+            where = reduce_ids(table.invoice, sub_ids)
+            for name in ('issued', 'received', 'investment',
+                    'intracommunity'):
+                line = pool.get('aeat.340.report.%s' % name).__table__()
+                cursor.execute(*table.join(line,
+                        condition=getattr(table, name) == line.id
+                        ).join(report,
+                        condition=line.report == report.id
+                        ).select(table.invoice, report.id,
+                        where=where & (report.state == 'done'),
+                        limit=1))
+                row = cursor.fetchone()
+                if row:
+                    invoice_id, report_id = row
+                    cls.raise_user_error('delete_done_report', {
+                            'invoice': Invoice(invoice_id).rec_name,
+                            'report': Report(report_id).rec_name,
+                            })
+            cursor.execute(*record_line.delete(
+                    where=record_line.aeat340_record.in_(
+                        table.select(table.id, where=where))))
+            cursor.execute(*table.delete(where=where))
+        Summary.update_totals(totals, {})
+
+    @staticmethod
+    def _get_export_columns():
+        'Return the columns of the records exported by read_export_rows'
+        return ['invoice_number', 'issue_date', 'fiscalyear', 'month',
+            'fiscal_nif', 'fiscal_name', 'fiscal_country',
+            'fiscal_identifier_type', 'fiscal_identifier', 'book_key',
+            'operation_key', 'tax_rate', 'base', 'tax', 'total',
+            'equivalence_tax_rate', 'equivalence_tax']
+
+    @classmethod
+    def read_export_rows(cls, company, start_date, end_date, columns):
+        '''
+        Yield the values of columns for the records of the invoices of
+        company between the dates as tuples without instantiating them
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        FiscalYear = pool.get('account.fiscalyear')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        invoice = Invoice.__table__()
+        fiscalyear = FiscalYear.__table__()
+
+        invoice_columns = {
+            'invoice_number': invoice.number,
+            'issue_date': invoice.invoice_date,
+            'fiscalyear': fiscalyear.name,
+            }
+        sql_columns = [invoice_columns[c] if c in invoice_columns
+            else Column(table, c) for c in columns]
+        cursor.execute(*table.join(invoice,
+                condition=table.invoice == invoice.id
+                ).join(fiscalyear,
+                condition=table.fiscalyear == fiscalyear.id
+                ).select(*sql_columns,
+                where=(table.company == company.id)
+                & (invoice.invoice_date >= start_date)
+                & (invoice.invoice_date <= end_date),
+                order_by=[invoice.invoice_date.asc, table.id.asc]))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    @staticmethod
+    def get_party_fiscal_values(party):
+        'Return the fiscal data of the party stored on the records'
+        code = party.tax_identifier.code if party.tax_identifier else ''
+        spanish = code[:2] == 'ES'
+        country = None
+        if party.addresses and party.addresses[0].country:
+            country = party.addresses[0].country.code
+        return {
+            'fiscal_name': party.name[:40],
+            'fiscal_nif': code[2:11] if spanish else '',
+            'fiscal_identifier': code[:20] if not spanish else '',
+            'fiscal_identifier_type': '1' if spanish else '4',
+            'fiscal_country': country or code[:2],
+            }
+
+    def get_fiscal_values(self):
+        '''
+        Return the fiscal data of the party of the record at the time it was
+        created or of the current party for older records
+        '''
+        if not self.fiscal_identifier_type:
+            return self.get_party_fiscal_values(self.party)
+        return {
+            'fiscal_name': self.fiscal_name or '',
+            'fiscal_nif': self.fiscal_nif or '',
+            'fiscal_identifier': self.fiscal_identifier or '',
+            'fiscal_identifier_type': self.fiscal_identifier_type,
+            'fiscal_country': self.fiscal_country or '',
+            }
+
     def get_issue_date(self, name):
         return self.invoice.invoice_date
 
@@ -280,6 +592,173 @@ class AEAT340RecordInvoiceLine(ModelSQL):
         ondelete='CASCADE', required=True, select=True)
 
 
+class RecordSummary(ModelSQL, ModelView):
+    """
+    AEAT 340 Record Summary
+
+    Totals of the AEAT 340 records by month, book key, operation key and tax
+    rate. The differences are applied each time the records of invoices
+    change.
+    """
+    __name__ = 'aeat.340.record.summary'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        required=True, readonly=True, select=True)
+    month = fields.Integer('Month', readonly=True)
+    book_key = fields.Selection(BOOK_KEY, 'Book Key', sort=False,
+        readonly=True)
+    operation_key = fields.Selection(OPERATION_KEY, 'Operation Key',
+        sort=False, readonly=True)
+    tax_rate = fields.Numeric('Tax Rate', digits=(16, 2), readonly=True)
+    base = fields.Numeric('Base', digits=(16, 2), readonly=True)
+    tax = fields.Numeric('Tax', digits=(16, 2), readonly=True)
+    total = fields.Numeric('Total', digits=(16, 2), readonly=True)
+    equivalence_tax = fields.Numeric('Equivalence Tax', digits=(16, 2),
+        readonly=True)
+    record_count = fields.Integer('Record Count', readonly=True)
+    invoice_count = fields.Integer('Invoice Count', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(RecordSummary, cls).__setup__()
+        cls._order = [
+            ('fiscalyear', 'DESC'),
+            ('month', 'ASC'),
+            ('book_key', 'ASC'),
+            ('operation_key', 'ASC'),
+            ('tax_rate', 'ASC'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        created = not TableHandler.table_exist(cls._table)
+        super(RecordSummary, cls).__register__(module_name)
+        if created:
+            cls.refresh()
+
+    @classmethod
+    def refresh(cls, months=None):
+        '''
+        Rebuild with SQL the summary of months, a list of (company,
+        fiscalyear, month), or of all the records if months is None
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        record = Record.__table__()
+
+        def month_where(table, sub_months):
+            return reduce(lambda x, y: x | y, [
+                    (table.company == company)
+                    & (table.fiscalyear == fiscalyear)
+                    & (table.month == month)
+                    for company, fiscalyear, month in sub_months])
+
+        if months is None:
+            cursor.execute(*table.delete())
+            wheres = [None]
+        else:
+            wheres = []
+            for sub_months in grouped_slice(months, count=100):
+                sub_months = list(sub_months)
+                cursor.execute(*table.delete(
+                        where=month_where(table, sub_months)))
+                wheres.append(month_where(record, sub_months))
+
+        columns = [record.company, record.fiscalyear, record.month,
+            record.book_key, record.operation_key, record.tax_rate]
+        for where in wheres:
+            cursor.execute(*table.insert([table.create_uid,
+                        table.create_date, table.company, table.fiscalyear,
+                        table.month, table.book_key, table.operation_key,
+                        table.tax_rate, table.base, table.tax, table.total,
+                        table.equivalence_tax, table.record_count,
+                        table.invoice_count],
+                    record.select(*([Literal(transaction.user),
+                                CurrentTimestamp()] + columns + [
+                                Sum(record.base), Sum(record.tax),
+                                Sum(record.total),
+                                Sum(record.equivalence_tax),
+                                Count(record.id),
+                                Count(record.invoice, distinct=True)]),
+                        where=where, group_by=columns)))
+
+    @classmethod
+    def get_invoice_totals(cls, invoice_ids):
+        '''
+        Return the totals of the records of the invoices by (company,
+        fiscalyear, month, book_key, operation_key, tax_rate)
+        '''
+        Record = Pool().get('aeat.340.record')
+        cursor = Transaction().connection.cursor()
+        record = Record.__table__()
+
+        columns = [record.company, record.fiscalyear, record.month,
+            record.book_key, record.operation_key, record.tax_rate]
+        totals = {}
+        for sub_ids in grouped_slice(invoice_ids):
+            cursor.execute(*record.select(*(columns + [
+                            Sum(record.base), Sum(record.tax),
+                            Sum(record.total), Sum(record.equivalence_tax),
+                            Count(record.id),
+                            Count(record.invoice, distinct=True)]),
+                    where=reduce_ids(record.invoice, sub_ids),
+                    group_by=columns))
+            for row in cursor.fetchall():
+                key, values = tuple(row[:6]), row[6:]
+                # SQLite returns the sums as float
+                values = [Decimal(str(v)) if v is not None else None
+                    for v in values[:4]] + list(values[4:])
+                if key in totals:
+                    values = [_add(x, y) for x, y in zip(totals[key], values)]
+                totals[key] = values
+        return totals
+
+    @classmethod
+    def update_totals(cls, old_totals, new_totals):
+        '''
+        Apply to the summary the differences between old_totals and
+        new_totals, as returned by get_invoice_totals, of the same invoices
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        empty = [None] * len(_SUMMARY_TOTALS)
+        key_columns = [table.company, table.fiscalyear, table.month,
+            table.book_key, table.operation_key, table.tax_rate]
+        for key in set(old_totals) | set(new_totals):
+            deltas = [_add(n, -o if o is not None else None)
+                for o, n in zip(old_totals.get(key, empty),
+                    new_totals.get(key, empty))]
+            if not any(deltas):
+                continue
+            where = reduce(lambda x, y: x & y, [
+                    column == (value if value is not None else Null)
+                    for column, value in zip(key_columns, key)])
+            columns = [table.write_uid, table.write_date]
+            values = [transaction.user, CurrentTimestamp()]
+            for name, delta in zip(_SUMMARY_TOTALS, deltas):
+                if delta is not None:
+                    column = Column(table, name)
+                    columns.append(column)
+                    values.append(Coalesce(column, 0) + delta)
+            cursor.execute(*table.update(columns, values, where=where))
+            if not cursor.rowcount:
+                cursor.execute(*table.insert([table.create_uid,
+                            table.create_date] + key_columns
+                        + [Column(table, n) for n in _SUMMARY_TOTALS],
+                        [[transaction.user, CurrentTimestamp()] + list(key)
+                            + deltas]))
+        cursor.execute(*table.delete(where=table.record_count <= 0))
+
+
 class TemplateTax:
     __metaclass__ = PoolMeta
     __name__ = 'account.tax.template'
@@ -346,6 +825,70 @@ class Tax:
         'Default In Book Key',
         domain=[('id', 'in', Eval('aeat340_book_keys', []))],
         depends=['aeat340_book_keys'])
+    _aeat340_keys_cache = Cache('account.tax.aeat340_keys', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        taxes = super(Tax, cls).create(vlist)
+        cls._aeat340_keys_cache.clear()
+        return taxes
+
+    @classmethod
+    def write(cls, *args):
+        super(Tax, cls).write(*args)
+        cls._aeat340_keys_cache.clear()
+
+    @classmethod
+    def delete(cls, taxes):
+        super(Tax, cls).delete(taxes)
+        cls._aeat340_keys_cache.clear()
+
+    @classmethod
+    def get_aeat340_keys(cls, tax_ids):
+        '''
+        Return for each tax id a dictionary with the ids of its available
+        book keys, the closure of the book keys of the tax and all its
+        descendants, its default in and out book key ids, the ids of its
+        children and its recargo de equivalencia flag.
+
+        The values are cached until a tax or its book keys are modified, so
+        they must not be changed by the caller.
+        '''
+        result = {}
+        missing = []
+        for tax_id in set(tax_ids):
+            value = cls._aeat340_keys_cache.get(tax_id)
+            if value is None:
+                missing.append(tax_id)
+            else:
+                result[tax_id] = value
+        fields_names = ['aeat340_book_keys', 'aeat340_default_in_book_key',
+            'aeat340_default_out_book_key', 'childs']
+        # recargo_equivalencia is defined by account_es
+        if 'recargo_equivalencia' in cls._fields:
+            fields_names.append('recargo_equivalencia')
+        values = []
+        for sub_ids in grouped_slice(missing):
+            for tax in cls.read(list(sub_ids), fields_names):
+                values.append({
+                        'id': tax['id'],
+                        'book_keys': frozenset(tax['aeat340_book_keys']),
+                        'default_in_book_key': (
+                            tax['aeat340_default_in_book_key']),
+                        'default_out_book_key': (
+                            tax['aeat340_default_out_book_key']),
+                        'childs': tuple(tax['childs']),
+                        'recargo_equivalencia': bool(
+                            tax.get('recargo_equivalencia')),
+                        })
+        childs = cls.get_aeat340_keys([c for v in values
+                for c in v['childs']]) if values else {}
+        for value in values:
+            value['closure_book_keys'] = value['book_keys'].union(
+                *(childs[c]['closure_book_keys'] for c in value['childs']))
+            cls._aeat340_keys_cache.set(value['id'], value)
+            result[value['id']] = value
+        return result
 
 STATES = {
     'invisible': Eval('type') != 'line',
@@ -386,7 +929,6 @@ class InvoiceLine:
 
     @fields.depends('invoice', 'taxes')
     def on_change_product(self):
-        Taxes = Pool().get('account.tax')
         type_ = None
 
         super(InvoiceLine, self).on_change_product()
@@ -400,17 +942,15 @@ class InvoiceLine:
         self.aeat340_operation_key = None
         if type_ and self.taxes:
             self.aeat340_book_key = self.get_aeat340_book_key(
-                        type_, Taxes.browse(self.taxes))
+                        type_, self.taxes)
             self.aeat340_operation_key = self.get_aeat340_operation_key(type_)
 
     @fields.depends('taxes', 'product')
     def on_change_with_aeat340_available_keys(self, name=None):
-        keys = []
-        for tax in self.taxes:
-            keys.extend([k.id for k in tax.aeat340_book_keys])
-            for child_tax in tax.childs:
-                keys.extend([k.id for k in child_tax.aeat340_book_keys])
-        return list(set(keys))
+        Tax = Pool().get('account.tax')
+        tax_keys = Tax.get_aeat340_keys([t.id for t in self.taxes])
+        return list(frozenset().union(
+                *(v['closure_book_keys'] for v in tax_keys.itervalues())))
 
     @fields.depends('taxes', 'invoice_type', 'aeat340_book_key', 'invoice',
         '_parent_invoice.type', 'product')
@@ -429,12 +969,14 @@ class InvoiceLine:
 
     @classmethod
     def get_aeat340_book_key(cls, invoice_type, taxes):
+        Tax = Pool().get('account.tax')
         type_ = 'in' if invoice_type == 'in' else 'out'
-        for tax in taxes:
-            name = 'aeat340_default_%s_book_key' % type_
-            value = getattr(tax, name)
+        tax_ids = [t if isinstance(t, (int, long)) else t.id for t in taxes]
+        tax_keys = Tax.get_aeat340_keys(tax_ids)
+        for tax_id in tax_ids:
+            value = tax_keys[tax_id]['default_%s_book_key' % type_]
             if value:
-                return value.id
+                return value
 
     @classmethod
     def get_aeat340_operation_key(cls, invoice_type):
@@ -442,23 +984,42 @@ class InvoiceLine:
 
     @classmethod
     def create(cls, vlist):
-        Invoice = Pool().get('account.invoice')
-        Taxes = Pool().get('account.tax')
-        for vals in vlist:
-            if vals.get('type', 'line') != 'line':
-                continue
-            invoice_type = vals.get('invoice_type')
-            if not invoice_type and vals.get('invoice'):
-                invoice = Invoice(vals.get('invoice'))
-                invoice_type = invoice.type
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Tax = pool.get('account.tax')
+
+        def get_tax_ids(vals):
+            tax_ids = []
+            for key, value in vals.get('taxes', []):
+                if key == 'add':
+                    tax_ids.extend(value)
+            return tax_ids
+
+        # Copied lines already have their keys so there is nothing to infer
+        lines = [v for v in vlist if v.get('type', 'line') == 'line'
+            and ((not v.get('aeat340_book_key') and v.get('taxes'))
+                or not v.get('aeat340_operation_key'))]
+        invoice_ids = set()
+        tax_ids = set()
+        for vals in lines:
+            if not vals.get('invoice_type') and vals.get('invoice'):
+                invoice_ids.add(vals['invoice'])
+            if not vals.get('aeat340_book_key') and vals.get('taxes'):
+                tax_ids.update(get_tax_ids(vals))
+
+        invoice_types = {}
+        for sub_ids in grouped_slice(invoice_ids):
+            invoice_types.update((i['id'], i['type'])
+                for i in Invoice.read(list(sub_ids), ['type']))
+        # Fill the cache of the tax keys at once
+        Tax.get_aeat340_keys(tax_ids)
+
+        for vals in lines:
+            invoice_type = (vals.get('invoice_type')
+                or invoice_types.get(vals.get('invoice')))
             if not vals.get('aeat340_book_key') and vals.get('taxes'):
-                taxes_ids = []
-                for key, value in vals.get('taxes'):
-                    if key == 'add':
-                        taxes_ids.extend(value)
-
                 vals['aeat340_book_key'] = cls.get_aeat340_book_key(
-                    invoice_type, Taxes.browse(taxes_ids))
+                    invoice_type, get_tax_ids(vals))
             if not vals.get('aeat340_operation_key'):
                 value = cls.get_aeat340_operation_key(invoice_type)
                 vals['aeat340_operation_key'] = value
@@ -476,11 +1037,14 @@ class Invoice:
         return self.invoice_date.month
 
     @classmethod
+    @instrumented('account.invoice.create_aeat340_records',
+        rows=lambda cls, invoices: len(invoices))
     def create_aeat340_records(cls, invoices):
         pool = Pool()
         Configuration = pool.get('account.configuration')
         InvoiceLine = pool.get('account.invoice.line')
         Record = pool.get('aeat.340.record')
+        Tax = pool.get('account.tax')
 
         config = Configuration(1)
 
@@ -494,9 +1058,12 @@ class Invoice:
                         tax_amount += t['amount']
             return tax_amount
 
-        to_create = {}
+        to_create = Accumulator(
+            ('base', 'tax', 'total', 'equivalence_tax'), 'invoice_lines')
         inv_lines_to_write = []
+        fiscal_values = {}
         for sub_invoices in grouped_slice(invoices, count=100):
+            invoice_keys = {}
             inv_lines = InvoiceLine.search([
                     ('invoice', 'in', [i.id for i in sub_invoices]),
                     ('invoice.move', '!=', None),
@@ -506,6 +1073,12 @@ class Invoice:
                     ('aeat340_book_key', '!=', None),
                     ],
                 order=[('invoice', 'ASC')])
+            tax_keys = Tax.get_aeat340_keys({t.id for l in inv_lines
+                        for t in l.taxes}
+                | {it.tax.id for i in sub_invoices for it in i.taxes
+                    if it.tax})
+            tax_keys.update(Tax.get_aeat340_keys([c
+                        for v in tax_keys.values() for c in v['childs']]))
             for line in inv_lines:
                 invoice = line.invoice
                 fiscalyear_id = invoice.move.period.fiscalyear.id
@@ -521,7 +1094,7 @@ class Invoice:
                 if operation_key in (' ', 'C'):
                     n_aeat340_taxes = len({it.tax.id
                             for it in invoice.taxes
-                            if it.tax and it.tax.aeat340_book_keys})
+                            if it.tax and tax_keys[it.tax.id]['book_keys']})
                     modified = False
                     if operation_key == ' ' and n_aeat340_taxes > 1:
                         operation_key = 'C'
@@ -540,11 +1113,12 @@ class Invoice:
 
                 base = total = line.amount
                 for tax in line.taxes:
-                    if not tax.childs:
-                        assert not tax.recargo_equivalencia, (
+                    keys = tax_keys[tax.id]
+                    if not keys['childs']:
+                        assert not keys['recargo_equivalencia'], (
                             "Unexpected recargo_equivalencia flag on "
                             "non-child tax")
-                        if line.aeat340_book_key not in tax.aeat340_book_keys:
+                        if line.aeat340_book_key.id not in keys['book_keys']:
                             continue
                         tax_rate = tax.rate * 100
                         tax_amount = compute_tax_amount(line, tax)
@@ -557,11 +1131,12 @@ class Invoice:
                             child_tax_amount = compute_tax_amount(line,
                                 child_tax)
                             total += child_tax_amount
-                            if child_tax.recargo_equivalencia:
+                            child_keys = tax_keys[child_tax.id]
+                            if child_keys['recargo_equivalencia']:
                                 equivalence_tax_rate = child_tax.rate * 100
                                 equivalence_tax_amount += child_tax_amount
-                            elif (line.aeat340_book_key
-                                    in child_tax.aeat340_book_keys):
+                            elif (line.aeat340_book_key.id
+                                    in child_keys['book_keys']):
                                 tax_rate = child_tax.rate * 100
                                 tax_amount += child_tax_amount
                         if not tax_rate:
@@ -575,20 +1150,20 @@ class Invoice:
                             equivalence_tax_amount = invoice.currency.round(
                                 equivalence_tax_amount)
 
-                    key = "%d-%d-%s-%s" % (invoice.id, tax.id,
-                        operation_key, book_key)
+                    key = (invoice.id, tax.id, operation_key, book_key)
                     if key in to_create:
-                        to_create[key]['invoice_lines'][0][1].append(line.id)
-                        to_create[key]['base'] += base
-                        to_create[key]['tax'] += tax_amount
-                        to_create[key]['total'] += total
-                        if equivalence_tax_rate:
-                            to_create[key]['equivalence_tax'] += (
-                                equivalence_tax_amount)
+                        to_create.add(key, ids=[line.id], base=base,
+                            tax=tax_amount, total=total,
+                            equivalence_tax=(equivalence_tax_amount
+                                if equivalence_tax_rate else None))
                     else:
-                        to_create[key] = {
+                        if invoice.party.id not in fiscal_values:
+                            fiscal_values[invoice.party.id] = (
+                                Record.get_party_fiscal_values(invoice.party))
+                        vals = {
                             'invoice': invoice.id,
-                            'invoice_lines': [('add', [line.id])],
+                            'invoice_lines': [line.id],
+                            'account_tax': tax.id,
                             'company': invoice.company.id,
                             'fiscalyear': fiscalyear_id,
                             'month': invoice.aeat340_record_month,
@@ -603,37 +1178,99 @@ class Invoice:
                             'equivalence_tax': (equivalence_tax_amount
                                 if equivalence_tax_rate else None),
                             }
+                        vals.update(fiscal_values[invoice.party.id])
+                        to_create.insert(key, vals)
+                        invoice_keys.setdefault(invoice, []).append(key)
             if config.tax_rounding == 'document':
-                for key in to_create:
-                    if not key.startswith('%d-' % invoice.id):
-                        continue
-                    to_create[key]['base'] = invoice.currency.round(
-                        to_create[key]['base'])
-                    to_create[key]['tax'] = invoice.currency.round(
-                        to_create[key]['tax'])
-                    to_create[key]['total'] = invoice.currency.round(
-                        to_create[key]['total'])
-                    if to_create[key]['equivalence_tax_rate']:
-                        to_create[key]['equivalence_tax_rate'] = (
-                            invoice.currency.round(
-                                to_create[key]['equivalence_tax_rate']))
+                for invoice, keys in invoice_keys.iteritems():
+                    currency = invoice.currency
+                    for key in keys:
+                        for field in ('base', 'tax', 'total'):
+                            to_create.set_value(key, field, currency.round(
+                                    to_create.get_value(key, field)))
+                        if to_create.get_value(key, 'equivalence_tax_rate'):
+                            to_create.set_value(key, 'equivalence_tax_rate',
+                                currency.round(to_create.get_value(key,
+                                        'equivalence_tax_rate')))
 
         with Transaction().set_user(0, set_context=True):
-            Record.delete(Record.search([('invoice', 'in',
-                            [i.id for i in invoices])]))
             if inv_lines_to_write:
                 InvoiceLine.write(*inv_lines_to_write)
-            if to_create:
-                Record.create(to_create.values())
+            cls._sync_aeat340_records(invoices, to_create.vlist())
+
+    @classmethod
+    def _sync_aeat340_records(cls, invoices, vlist):
+        '''
+        Create, write and delete the AEAT 340 records of the invoices to
+        match the values of vlist. The records are matched by invoice, tax,
+        operation key and book key and only the differences are written.
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Summary = pool.get('aeat.340.record.summary')
+        fields_names = ['company', 'fiscalyear', 'month', 'party',
+            'tax_rate', 'base', 'tax', 'total', 'equivalence_tax_rate',
+            'equivalence_tax', 'fiscal_name', 'fiscal_nif',
+            'fiscal_identifier', 'fiscal_identifier_type', 'fiscal_country']
+
+        def get_key(values):
+            return (values['invoice'], values['account_tax'],
+                values['operation_key'], values['book_key'])
+
+        invoice_ids = [i.id for i in invoices]
+        old_totals = Summary.get_invoice_totals(invoice_ids)
+        existing = {}
+        to_delete = []
+        for sub_invoices in grouped_slice(invoices):
+            for record in Record.search_read([
+                        ('invoice', 'in', [i.id for i in sub_invoices]),
+                        ], fields_names=['invoice', 'account_tax',
+                        'operation_key', 'book_key', 'invoice_lines']
+                    + fields_names):
+                key = get_key(record)
+                # Records created before the tax was stored can not be
+                # matched
+                if record['account_tax'] is None or key in existing:
+                    to_delete.append(record['id'])
+                else:
+                    existing[key] = record
+
+        to_create = []
+        to_write = []
+        for values in vlist:
+            record = existing.pop(get_key(values), None)
+            if record is None:
+                to_create.append(values)
+                continue
+            changes = dict((f, values[f]) for f in fields_names
+                if values[f] != record[f])
+            line_ids = set(values['invoice_lines'][0][1])
+            old_line_ids = set(record['invoice_lines'])
+            if line_ids != old_line_ids:
+                changes['invoice_lines'] = [
+                    ('remove', list(old_line_ids - line_ids)),
+                    ('add', list(line_ids - old_line_ids)),
+                    ]
+            if changes:
+                to_write.extend(([Record(record['id'])], changes))
+        to_delete.extend(r['id'] for r in existing.itervalues())
+
+        if to_delete:
+            Record.delete(Record.browse(to_delete))
+        if to_write:
+            Record.write(*to_write)
+        if to_create:
+            Record.create(to_create)
+        if to_delete or to_write or to_create:
+            Summary.update_totals(old_totals,
+                Summary.get_invoice_totals(invoice_ids))
 
     @classmethod
     def draft(cls, invoices):
         pool = Pool()
         Record = pool.get('aeat.340.record')
         super(Invoice, cls).draft(invoices)
-        with Transaction().set_user(0, set_context=True):
-            Record.delete(Record.search([('invoice', 'in',
-                            [i.id for i in invoices])]))
+        Record.delete_invoice_records([i.id for i in invoices])
 
     @classmethod
     def post(cls, invoices):
@@ -645,9 +1282,7 @@ class Invoice:
         pool = Pool()
         Record = pool.get('aeat.340.record')
         super(Invoice, cls).cancel(invoices)
-        with Transaction().set_user(0, set_context=True):
-            Record.delete(Record.search([('invoice', 'in',
-                            [i.id for i in invoices])]))
+        Record.delete_invoice_records([i.id for i in invoices])
 
     @classmethod
     def copy(cls, invoices, default=None):
@@ -665,6 +1300,30 @@ class Recalculate340RecordStart(ModelView):
     """
     __name__ = "aeat.340.recalculate.records.start"
 
+    company = fields.Many2One('company.company', 'Company',
+        states={
+            'required': Bool(Eval('start_date')) | Bool(Eval('end_date')),
+            }, depends=['start_date', 'end_date'])
+    start_date = fields.Date('Start Date',
+        states={
+            'required': Bool(Eval('end_date')),
+            }, depends=['end_date'],
+        help='If set, the invoices of the company between the dates are '
+        'recalculated in background instead of the selected ones.')
+    end_date = fields.Date('End Date',
+        domain=[
+            If(Bool(Eval('start_date')) & Bool(Eval('end_date')),
+                ('end_date', '>=', Eval('start_date')),
+                ()),
+            ],
+        states={
+            'required': Bool(Eval('start_date')),
+            }, depends=['start_date'])
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
 
 class Recalculate340RecordEnd(ModelView):
     """
@@ -673,6 +1332,13 @@ class Recalculate340RecordEnd(ModelView):
     __name__ = "aeat.340.recalculate.records.end"
 
 
+class Recalculate340RecordScheduled(ModelView):
+    """
+    Recalculate AEAT 340 Records Scheduled
+    """
+    __name__ = "aeat.340.recalculate.records.scheduled"
+
+
 class Recalculate340Record(Wizard):
     """
     Recalculate AEAT 340 Records
@@ -688,14 +1354,182 @@ class Recalculate340Record(Wizard):
         'aeat_340.aeat_340_recalculate_end_view', [
             Button('Ok', 'end', 'tryton-ok', default=True),
             ])
+    scheduled = StateView('aeat.340.recalculate.records.scheduled',
+        'aeat_340.aeat_340_recalculate_scheduled_view', [
+            Button('Ok', 'end', 'tryton-ok', default=True),
+            ])
 
     def transition_calculate(self):
-        Invoice = Pool().get('account.invoice')
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Job = pool.get('aeat.340.recalculate.job')
+        if self.start.start_date:
+            Job.create([{
+                        'company': self.start.company.id,
+                        'start_date': self.start.start_date,
+                        'end_date': self.start.end_date,
+                        }])
+            return 'scheduled'
         invoices = Invoice.browse(Transaction().context['active_ids'])
         Invoice.create_aeat340_records(invoices)
         return 'done'
 
 
+class Recalculate340RecordJob(ModelSQL, ModelView):
+    """
+    Recalculate AEAT 340 Records Job
+
+    Recalculate in background the records of the invoices of a company
+    between two dates.
+    """
+    __name__ = 'aeat.340.recalculate.job'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    start_date = fields.Date('Start Date', required=True, readonly=True)
+    end_date = fields.Date('End Date', required=True, readonly=True)
+    state = fields.Selection([
+            ('waiting', 'Waiting'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ], 'State', readonly=True, required=True)
+    last_invoice = fields.Integer('Last Invoice', readonly=True)
+    processed = fields.Integer('Processed Invoices', readonly=True)
+    changed = fields.Integer('Changed Invoices', readonly=True)
+    failed = fields.Integer('Failed Invoices', readonly=True)
+    failures = fields.Text('Failures', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Recalculate340RecordJob, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'waiting'
+
+    @staticmethod
+    def default_processed():
+        return 0
+
+    @staticmethod
+    def default_changed():
+        return 0
+
+    @staticmethod
+    def default_failed():
+        return 0
+
+    def get_rec_name(self, name):
+        return '%s (%s - %s)' % (self.company.rec_name, self.start_date,
+            self.end_date)
+
+    @classmethod
+    def process_jobs(cls):
+        'Process the waiting and running jobs, called by the cron'
+        for job in cls.search([
+                    ('state', 'in', ['waiting', 'running']),
+                    ], order=[('id', 'ASC')]):
+            job.process()
+
+    def _get_invoice_domain(self):
+        return [
+            ('company', '=', self.company.id),
+            ('invoice_date', '>=', self.start_date),
+            ('invoice_date', '<=', self.end_date),
+            ('state', 'in', ['posted', 'paid']),
+            ]
+
+    def process(self):
+        '''
+        Recalculate the invoices of the job by batches committed one by one
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        transaction = Transaction()
+        batch = config.getint('aeat_340', 'recalculate_batch', default=100)
+
+        with transaction.set_user(0, set_context=True), \
+                transaction.set_context(company=self.company.id):
+            self.state = 'running'
+            self.save()
+            while True:
+                invoices = Invoice.search(self._get_invoice_domain() + [
+                        ('id', '>', self.last_invoice or 0),
+                        ], order=[('id', 'ASC')], limit=batch)
+                if not invoices:
+                    break
+                changed, failures = self.recalculate(invoices)
+                self.last_invoice = invoices[-1].id
+                self.processed += len(invoices)
+                self.changed += changed
+                if failures:
+                    self.failed += len(failures)
+                    self.failures = '\n'.join(filter(None,
+                            [self.failures] + failures))
+                self.save()
+                transaction.commit()
+            self.state = 'done'
+            self.save()
+
+    def recalculate(self, invoices):
+        '''
+        Recalculate the records of the invoices and return the number of
+        invoices whose records have changed and the list of failures
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        transaction = Transaction()
+
+        before = self._get_records_snapshot(invoices)
+        try:
+            Invoice.create_aeat340_records(invoices)
+        except (UserError, UserWarning):
+            # Retry one by one to isolate the failing invoices
+            transaction.rollback()
+            failures = []
+            recalculated = []
+            for invoice in invoices:
+                try:
+                    Invoice.create_aeat340_records([invoice])
+                except (UserError, UserWarning) as e:
+                    transaction.rollback()
+                    logger = logging.getLogger(self.__name__)
+                    logger.warning('Unable to recalculate AEAT 340 records '
+                        'of invoice %s', invoice.id, exc_info=True)
+                    failures.append('%s: %s' % (invoice.rec_name, e.message))
+                else:
+                    transaction.commit()
+                    recalculated.append(invoice)
+        else:
+            failures = []
+            recalculated = invoices
+        after = self._get_records_snapshot(recalculated)
+        changed = len([i for i in recalculated
+                if before.get(i.id) != after.get(i.id)])
+        return changed, failures
+
+    @staticmethod
+    def _get_records_snapshot(invoices):
+        '''
+        Return for each invoice id the sorted values of its records
+        '''
+        Record = Pool().get('aeat.340.record')
+        fields_names = ['invoice', 'book_key', 'operation_key', 'tax_rate',
+            'base', 'tax', 'total', 'equivalence_tax_rate',
+            'equivalence_tax']
+        snapshot = {}
+        for sub_invoices in grouped_slice(invoices):
+            for record in Record.search_read([
+                        ('invoice', 'in', [i.id for i in sub_invoices]),
+                        ], fields_names=list(fields_names)):
+                snapshot.setdefault(record['invoice'], []).append(
+                    tuple(record[f] for f in fields_names[1:]))
+        for values in snapshot.itervalues():
+            values.sort()
+        return snapshot
+
+
 class Reasign340RecordStart(ModelView):
     """
     Reasign AEAT 340 Records Start
@@ -739,39 +1573,88 @@ class Reasign340Record(Wizard):
                     'selected invoices.'),
                 })
 
+    @staticmethod
+    def _get_chunk():
+        '''
+        Return the number of invoices reasigned per transaction or 0 to
+        reasign all the invoices at once
+        '''
+        return (Transaction().context.get('aeat340_reasign_chunk')
+            or config.getint('aeat_340', 'reasign_chunk', default=0))
+
+    @classmethod
+    def get_available_tax_ids(cls, invoice_ids, book_key):
+        '''
+        Return the ids of the taxes of the lines of the invoices that have
+        book_key available
+        '''
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        LineTax = pool.get('account.invoice.line-account.tax')
+        Tax = pool.get('account.tax')
+        cursor = Transaction().connection.cursor()
+        line = Line.__table__()
+        line_tax = LineTax.__table__()
+
+        tax_ids = set()
+        for sub_ids in grouped_slice(invoice_ids):
+            cursor.execute(*line_tax.join(line,
+                    condition=line_tax.line == line.id
+                    ).select(line_tax.tax,
+                    where=reduce_ids(line.invoice, sub_ids)
+                    & (line.type == 'line'),
+                    group_by=line_tax.tax))
+            tax_ids.update(t for t, in cursor.fetchall())
+        return [t for t, v in Tax.get_aeat340_keys(tax_ids).iteritems()
+            if book_key.id in v['closure_book_keys']]
+
+    def reasign_lines(self, invoice_ids, tax_ids):
+        '''
+        Update the keys of the lines of the invoices. The book key is only
+        set on the lines with any of tax_ids.
+        '''
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        LineTax = pool.get('account.invoice.line-account.tax')
+        cursor = Transaction().connection.cursor()
+        line = Line.__table__()
+        line_tax = LineTax.__table__()
+
+        # Update to allow to modify key for posted invoices
+        where = reduce_ids(line.invoice, invoice_ids) & (line.type == 'line')
+        if self.start.aeat_340_type:
+            cursor.execute(*line.update(columns=[line.aeat340_book_key],
+                    values=[self.start.aeat_340_type.id],
+                    where=where & line.id.in_(line_tax.select(line_tax.line,
+                            where=reduce_ids(line_tax.tax, tax_ids)))))
+        if self.start.operation_key:
+            cursor.execute(*line.update(columns=[line.aeat340_operation_key],
+                    values=[self.start.operation_key],
+                    where=where))
+
     def transition_reasign(self):
         Invoice = Pool().get('account.invoice')
-        Line = Pool().get('account.invoice.line')
-        cursor = Transaction().connection.cursor()
-        invoices = Invoice.browse(Transaction().context['active_ids'])
+        transaction = Transaction()
+        invoice_ids = transaction.context['active_ids']
 
-        line = Line.__table__()
+        tax_ids = []
         value = self.start.aeat_340_type
         if value:
-            lines = []
-            for invoice in invoices:
-                for l in invoice.lines:
-                    if value in l.aeat340_available_keys:
-                        lines.append(l.id)
-            if not lines:
+            tax_ids = self.get_available_tax_ids(invoice_ids, value)
+            if not tax_ids:
                 self.raise_user_error('aeat340_book_key_not_available',
                     value.rec_name)
 
-            # Update to allow to modify key for posted invoices
-            cursor.execute(*line.update(columns=[line.aeat340_book_key],
-                    values=[value.id], where=In(line.id, lines)))
-        value = self.start.operation_key
-        if value:
-            lines = []
-            for invoice in invoices:
-                for l in invoice.lines:
-                    lines.append(l.id)
-
-            # Update to allow to modify key for posted invoices
-            cursor.execute(*line.update(columns=[line.aeat340_operation_key],
-                    values=[value], where=In(line.id, lines)))
-
-        invoices = Invoice.browse(invoices)
-        Invoice.create_aeat340_records(invoices)
+        chunk = self._get_chunk()
+        if chunk:
+            slices = grouped_slice(invoice_ids, chunk)
+        else:
+            slices = [invoice_ids]
+        for sub_ids in slices:
+            sub_ids = list(sub_ids)
+            self.reasign_lines(sub_ids, tax_ids)
+            Invoice.create_aeat340_records(Invoice.browse(sub_ids))
+            if chunk:
+                transaction.commit()
 
         return 'done'
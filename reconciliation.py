@@ -0,0 +1,285 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Cast, Literal, Null, Union
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import CurrentTimestamp, Extract, Round
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = ['ReconciliationContext', 'Reconciliation',
+    'ReconciliationInvoice']
+
+MONTHS = [(m, '%02d' % m) for m in range(1, 13)]
+
+
+class ReconciliationContext(ModelView):
+    'AEAT 340 Ledger Reconciliation Context'
+    __name__ = 'aeat.340.ledger.reconciliation.context'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        required=True,
+        domain=[
+            ('company', '=', Eval('company')),
+            ],
+        depends=['company'])
+    start_month = fields.Selection(MONTHS, 'Start Month', sort=False,
+        required=True)
+    end_month = fields.Selection(MONTHS, 'End Month', sort=False,
+        required=True)
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_fiscalyear(cls):
+        FiscalYear = Pool().get('account.fiscalyear')
+        context = Transaction().context
+        return context.get('fiscalyear',
+            FiscalYear.find(context.get('company'), exception=False))
+
+    @staticmethod
+    def default_start_month():
+        return Transaction().context.get('start_month', 1)
+
+    @staticmethod
+    def default_end_month():
+        return Transaction().context.get('end_month', 12)
+
+
+class Abstract(ModelSQL):
+    company = fields.Many2One('company.company', 'Company')
+    month = fields.Integer('Month')
+    record_base = fields.Numeric('Record Base', digits=(16, 2))
+    record_tax = fields.Numeric('Record Tax', digits=(16, 2))
+    ledger_base = fields.Numeric('Ledger Base', digits=(16, 2))
+    ledger_tax = fields.Numeric('Ledger Tax', digits=(16, 2))
+    base_difference = fields.Numeric('Base Difference', digits=(16, 2))
+    tax_difference = fields.Numeric('Tax Difference', digits=(16, 2))
+
+    @classmethod
+    def __setup__(cls):
+        super(Abstract, cls).__setup__()
+        cls._order.insert(0, ('month', 'ASC'))
+
+    @staticmethod
+    def _get_context():
+        'Return the company, fiscal year, start and end month of the context'
+        context = Transaction().context
+        return (context.get('company'), context.get('fiscalyear'),
+            int(context.get('start_month') or 1),
+            int(context.get('end_month') or 12))
+
+    @classmethod
+    def _record_rows(cls, company, fiscalyear, start_month, end_month):
+        '''
+        Return the query of the amounts of the records by invoice and tax.
+
+        The records without tax, created before it was stored and not
+        migrated, are excluded as they can not be matched with the ledger.
+        '''
+        Record = Pool().get('aeat.340.record')
+        record = Record.__table__()
+        return record.select(
+            record.company.as_('company'),
+            record.invoice.as_('invoice'),
+            record.month.as_('month'),
+            record.account_tax.as_('tax'),
+            record.base.as_('record_base'),
+            (record.tax + Coalesce(record.equivalence_tax, 0)
+                ).as_('record_tax'),
+            Literal(0).as_('ledger_base'),
+            Literal(0).as_('ledger_tax'),
+            Literal(1).as_('record_count'),
+            where=(record.company == company)
+            & (record.fiscalyear == fiscalyear)
+            & (record.month >= start_month)
+            & (record.month <= end_month)
+            & (record.account_tax != Null))
+
+    @classmethod
+    def _ledger_rows(cls, company, fiscalyear, start_month, end_month):
+        '''
+        Return the query of the amounts of the tax lines of the posted
+        invoices by move line and top level tax.
+
+        Every child of a tax has a base line with the same amount so the base
+        of a move line is the mean of its base lines. Like in the records,
+        only the amounts of the taxes with book keys and of the recargo de
+        equivalencia are added to the tax.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        Tax = pool.get('account.tax')
+        TaxLine = pool.get('account.tax.line')
+        TypeTax = pool.get('aeat.340.type-account.tax')
+        invoice = Invoice.__table__()
+        move = Move.__table__()
+        move_line = MoveLine.__table__()
+        period = Period.__table__()
+        tax = Tax.__table__()
+        tax_line = TaxLine.__table__()
+        type_tax = TypeTax.__table__()
+
+        top_tax = Coalesce(tax.parent, tax.id)
+        with_keys = type_tax.select(type_tax.tax)
+        included = tax.id.in_(with_keys)
+        # recargo_equivalencia is defined by account_es
+        if 'recargo_equivalencia' in Tax._fields:
+            included |= tax.recargo_equivalencia == Literal(True)
+        is_base = tax_line.type == 'base'
+        month = Cast(Extract('MONTH', invoice.invoice_date),
+            cls.month.sql_type().base)
+
+        return (tax_line
+            .join(tax, condition=tax_line.tax == tax.id)
+            .join(move_line, condition=tax_line.move_line == move_line.id)
+            .join(invoice, condition=move_line.move == invoice.move)
+            .join(move, condition=invoice.move == move.id)
+            .join(period, condition=move.period == period.id)
+            ).select(
+            invoice.company.as_('company'),
+            invoice.id.as_('invoice'),
+            month.as_('month'),
+            top_tax.as_('tax'),
+            Literal(0).as_('record_base'),
+            Literal(0).as_('record_tax'),
+            Coalesce(Sum(Case((is_base, tax_line.amount), else_=0))
+                / NullIf(Sum(Case((is_base, 1), else_=0)), 0),
+                0).as_('ledger_base'),
+            Sum(Case((~is_base & included, tax_line.amount), else_=0)
+                ).as_('ledger_tax'),
+            Literal(0).as_('record_count'),
+            where=(invoice.company == company)
+            & (period.fiscalyear == fiscalyear)
+            & invoice.state.in_(['posted', 'paid'])
+            & top_tax.in_(with_keys)
+            & (month >= start_month) & (month <= end_month),
+            group_by=[invoice.company, invoice.id, invoice.invoice_date,
+                top_tax, move_line.id])
+
+    @classmethod
+    def _invoice_tax_rows(cls):
+        '''
+        Return the query of the amounts of the records and of the ledger of
+        each invoice and tax of the context in one grouped union
+        '''
+        company, fiscalyear, start_month, end_month = cls._get_context()
+        rows = Union(
+            cls._record_rows(company, fiscalyear, start_month, end_month),
+            cls._ledger_rows(company, fiscalyear, start_month, end_month),
+            all_=True)
+        record_base = Sum(rows.record_base)
+        record_tax = Sum(rows.record_tax)
+        ledger_base = Sum(rows.ledger_base)
+        ledger_tax = Sum(rows.ledger_tax)
+        return rows.select(
+            rows.company.as_('company'),
+            rows.invoice.as_('invoice'),
+            rows.month.as_('month'),
+            rows.tax.as_('tax'),
+            record_base.as_('record_base'),
+            record_tax.as_('record_tax'),
+            ledger_base.as_('ledger_base'),
+            ledger_tax.as_('ledger_tax'),
+            Round(record_base - ledger_base, 2).as_('base_difference'),
+            Round(record_tax - ledger_tax, 2).as_('tax_difference'),
+            Sum(rows.record_count).as_('record_count'),
+            group_by=[rows.company, rows.invoice, rows.month, rows.tax])
+
+    @classmethod
+    def _numeric(cls, name, expression):
+        return Cast(expression, getattr(cls, name).sql_type().base).as_(name)
+
+    @classmethod
+    def _columns(cls, rows):
+        return [
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Cast(Literal(None), cls.write_uid.sql_type().base
+                ).as_('write_uid'),
+            Cast(Literal(None), cls.write_date.sql_type().base
+                ).as_('write_date'),
+            rows.company.as_('company'),
+            rows.month.as_('month'),
+            ] + [cls._numeric(n, Sum(getattr(rows, n)))
+            for n in ['record_base', 'record_tax', 'ledger_base',
+                'ledger_tax', 'base_difference', 'tax_difference']]
+
+
+class Reconciliation(Abstract, ModelView):
+    '''
+    AEAT 340 Ledger Reconciliation
+
+    Compare by month and tax the amounts of the AEAT 340 records with the
+    base and tax lines of the posted invoices.
+    '''
+    __name__ = 'aeat.340.ledger.reconciliation'
+    tax = fields.Many2One('account.tax', 'Tax')
+    missing_invoices = fields.Integer('Missing Invoices',
+        help='Invoices with amounts in the ledger but without records.')
+    stale_invoices = fields.Integer('Stale Invoices',
+        help='Invoices whose records do not match the ledger.')
+
+    @classmethod
+    def __setup__(cls):
+        super(Reconciliation, cls).__setup__()
+        cls._order.insert(1, ('tax', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        rows = cls._invoice_tax_rows()
+        differs = ((rows.base_difference != 0)
+            | (rows.tax_difference != 0))
+        missing = (rows.record_count == 0) & differs
+        stale = (rows.record_count != 0) & differs
+        return rows.select(*(cls._columns(rows) + [
+                    (rows.tax * 100 + rows.month).as_('id'),
+                    rows.tax.as_('tax'),
+                    Sum(Case((missing, 1), else_=0)
+                        ).as_('missing_invoices'),
+                    Sum(Case((stale, 1), else_=0)).as_('stale_invoices'),
+                    ]),
+            group_by=[rows.company, rows.month, rows.tax])
+
+
+class ReconciliationInvoice(Abstract, ModelView):
+    '''
+    AEAT 340 Ledger Reconciliation Invoice
+
+    The invoices whose AEAT 340 records are missing or do not match, for any
+    tax, the base and tax lines of the ledger.
+    '''
+    __name__ = 'aeat.340.ledger.reconciliation.invoice'
+    invoice = fields.Many2One('account.invoice', 'Invoice')
+    status = fields.Selection([
+            ('missing', 'Missing'),
+            ('stale', 'Stale'),
+            ], 'Status')
+
+    @classmethod
+    def __setup__(cls):
+        super(ReconciliationInvoice, cls).__setup__()
+        cls._order.insert(1, ('invoice', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        rows = cls._invoice_tax_rows()
+        differs = Max(Case((
+                    (rows.base_difference != 0)
+                    | (rows.tax_difference != 0), 1), else_=0))
+        return rows.select(*(cls._columns(rows) + [
+                    rows.invoice.as_('id'),
+                    rows.invoice.as_('invoice'),
+                    Case((Sum(rows.record_count) == 0, 'missing'),
+                        else_='stale').as_('status'),
+                    ]),
+            group_by=[rows.company, rows.invoice, rows.month],
+            having=differs == 1)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# This file is part of the aeat_340 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark of the AEAT 340 hot paths
+
+It builds a synthetic company with the requested number of parties, taxes,
+invoices and lines and measures separately the posting of the invoices,
+Invoice.create_aeat340_records, Report.calculate, Report.get_totals,
+Report.create_file and the copy of invoices.
+
+The companies, invoices and taxes are created with the factories of the
+test suite and it uses the same database settings, so DB_NAME must be set,
+for example::
+
+    DB_NAME=:memory: python -m trytond.modules.aeat_340.tests.benchmark_aeat340
+
+    TRYTOND_DATABASE_URI=postgresql:// DB_NAME=test \\
+        python -m trytond.modules.aeat_340.tests.benchmark_aeat340 \\
+        --invoices 5000 --lines 5
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.aeat_340.instrumentation import count_queries
+
+from trytond.modules.aeat_340.tests.test_aeat_340 import (nif,
+    create_spanish_company, create_fiscalyear, get_accounts, create_taxes,
+    create_parties, create_invoices)
+
+
+def _peak_memory():
+    "Return the peak resident memory of the process in KiB"
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        usage //= 1024
+    return usage
+
+
+@contextmanager
+def measure(name, results, rows=None):
+    memory = _peak_memory()
+    start = time.time()
+    with count_queries() as counter:
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            results.append((name, elapsed, counter[0], rows,
+                    _peak_memory() - memory))
+
+
+def run(options):
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    Report = pool.get('aeat.340.report')
+
+    results = []
+    company = create_spanish_company()
+    with Transaction().set_context(company=company.id,
+            _skip_warnings=True):
+        fiscalyear = create_fiscalyear(company, options.year)
+        accounts = get_accounts(company)
+        taxes = create_taxes(company, accounts, options.taxes,
+            options.recargo)
+        parties = create_parties(options.parties)
+
+        with measure('create invoices', results,
+                options.invoices * options.lines):
+            invoices = create_invoices(company, accounts, fiscalyear,
+                parties, taxes, options.invoices, lines=options.lines,
+                tickets=options.tickets, seed=options.seed)
+        with measure('post', results, len(invoices)):
+            Invoice.post(invoices)
+        with measure('create_aeat340_records', results, len(invoices)):
+            Invoice.create_aeat340_records(invoices)
+
+        report, = Report.create([{
+                    'company': company.id,
+                    'fiscalyear': fiscalyear.id,
+                    'fiscalyear_code': options.year,
+                    'company_vat': nif(1),
+                    'period': '1T',
+                    'contact_phone': '999999999',
+                    'contact_name': 'Benchmark',
+                    'representative_vat': nif(2),
+                    }])
+        with measure('Report.calculate', results, len(invoices)):
+            Report.calculate([report])
+        report = Report(report.id)
+        with measure('Report.get_totals', results):
+            totals = Report.get_totals([report], ['record_count',
+                    'taxable_total', 'sharetax_total', 'total'])
+        record_count = totals['record_count'][report.id]
+        results[-1] = results[-1][:3] + (record_count,) + results[-1][4:]
+        with measure('Report.create_file', results, record_count):
+            report.create_file()
+
+        to_copy = invoices[:options.copies]
+        with measure('Invoice.copy', results, len(to_copy) * options.lines):
+            Invoice.copy(to_copy)
+    return results
+
+
+def print_results(results):
+    print('%-24s %10s %10s %10s %12s %12s' % ('step', 'seconds',
+            'queries', 'rows', 'rows/s', 'peak KiB'))
+    for name, elapsed, queries, rows, memory in results:
+        rate = ''
+        if rows and elapsed:
+            rate = '%.1f' % (rows / elapsed)
+        print('%-24s %10.3f %10d %10s %12s %12d' % (name, elapsed, queries,
+                rows if rows is not None else '', rate, memory))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--invoices', type=int, default=300)
+    parser.add_argument('--lines', type=int, default=3,
+        help='lines per invoice')
+    parser.add_argument('--taxes', type=int, default=4)
+    parser.add_argument('--parties', type=int, default=50)
+    parser.add_argument('--copies', type=int, default=100,
+        help='number of invoices to copy')
+    parser.add_argument('--tickets', type=float, default=0.1,
+        help='ratio of invoices that are ticket summaries')
+    parser.add_argument('--no-recargo', dest='recargo', action='store_false',
+        help='do not create recargo de equivalencia taxes')
+    parser.add_argument('--year', type=int,
+        default=datetime.date.today().year)
+    parser.add_argument('--seed', type=int, default=340)
+    parser.add_argument('--modules', default='aeat_340',
+        help='comma separated list of modules to activate, add account_es '
+        'to create recargo de equivalencia taxes')
+    options = parser.parse_args(args)
+
+    for module in options.modules.split(','):
+        activate_module(module)
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        try:
+            results = run(options)
+        finally:
+            Transaction().rollback()
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,1557 @@
+# -*- coding: utf-8 -*-
 # This file is part of the aeat_340 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import json
+import random
 import unittest
 import doctest
+from contextlib import contextmanager
+from decimal import Decimal
+
+from retrofix import aeat340
+from retrofix.fields import Const, Date, Number, Numeric, SIGN_POSITIVE
+from retrofix.record import Record, write as retrofix_write
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.config import config
+from trytond.exceptions import UserError, UserWarning
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond import backend
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart
+from trytond.modules.aeat_340 import instrumentation
+from trytond.modules.aeat_340.instrumentation import count_queries
+from trytond.modules.aeat_340.accumulator import Accumulator
+from trytond.modules.aeat_340.validation import LineValidator, valid_nif
+from trytond.modules.aeat_340.formatter import RecordFormatter, write
+from trytond.modules.aeat_340.aeat import remove_accents
+from trytond.modules.aeat_340.compare import CompareFile, FileError, read_file
+
+NIF_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+TAX_RATES = [Decimal('0.21'), Decimal('0.10'), Decimal('0.04'), Decimal(0)]
+RECARGO_RATES = {
+    Decimal('0.21'): Decimal('0.052'),
+    Decimal('0.10'): Decimal('0.014'),
+    Decimal('0.04'): Decimal('0.005'),
+    Decimal(0): Decimal(0),
+    }
+
+
+def nif(number):
+    'Return a valid Spanish NIF for number'
+    return '%08d%s' % (number, NIF_LETTERS[number % 23])
+
+
+def create_spanish_company():
+    'Create a company in euros with a Spanish VAT number'
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    Company = pool.get('company.company')
+    Party = pool.get('party.party')
+    User = pool.get('res.user')
+
+    currency, = Currency.search([('code', '=', 'EUR')], limit=1) or (
+        Currency.create([{
+                    'name': 'Euro',
+                    'code': 'EUR',
+                    'symbol': u'\u20ac',
+                    }]))
+    party, = Party.create([{
+                'name': 'Spanish Company',
+                'identifiers': [('create', [{
+                                'type': 'eu_vat',
+                                'code': 'ES%s' % nif(1),
+                                }])],
+                }])
+    company, = Company.create([{
+                'party': party.id,
+                'currency': currency.id,
+                }])
+    User.write([User(Transaction().user)], {
+            'main_company': company.id,
+            'company': company.id,
+            })
+    return company
+
+
+def create_fiscalyear(company, year):
+    'Create the fiscal year of company with its periods and sequences'
+    pool = Pool()
+    Sequence = pool.get('ir.sequence')
+    SequenceStrict = pool.get('ir.sequence.strict')
+    FiscalYear = pool.get('account.fiscalyear')
+
+    sequence, = Sequence.create([{
+                'name': '%s' % year,
+                'code': 'account.move',
+                'company': company.id,
+                }])
+    invoice_sequence, = SequenceStrict.create([{
+                'name': '%s' % year,
+                'code': 'account.invoice',
+                'company': company.id,
+                }])
+    fiscalyear, = FiscalYear.create([{
+                'name': '%s' % year,
+                'start_date': datetime.date(year, 1, 1),
+                'end_date': datetime.date(year, 12, 31),
+                'company': company.id,
+                'post_move_sequence': sequence.id,
+                'invoice_sequences': [('create', [{
+                                'company': company.id,
+                                'out_invoice_sequence': invoice_sequence.id,
+                                'in_invoice_sequence': invoice_sequence.id,
+                                'out_credit_note_sequence': (
+                                    invoice_sequence.id),
+                                'in_credit_note_sequence': (
+                                    invoice_sequence.id),
+                                }])],
+                }])
+    FiscalYear.create_period([fiscalyear])
+    return fiscalyear
+
+
+def get_accounts(company):
+    'Create the chart of accounts of company and return the main accounts'
+    pool = Pool()
+    Account = pool.get('account.account')
+    ModelData = pool.get('ir.model.data')
+    AccountTemplate = pool.get('account.account.template')
+    CreateChart = pool.get('account.create_chart', type='wizard')
+
+    template = AccountTemplate(ModelData.get_id(
+            'account', 'account_template_root_en'))
+    session_id, _, _ = CreateChart.create()
+    create_chart = CreateChart(session_id)
+    create_chart.account.account_template = template
+    create_chart.account.company = company
+    create_chart.transition_create_account()
+
+    accounts = {}
+    for kind in ('receivable', 'payable', 'revenue', 'expense'):
+        accounts[kind], = Account.search([
+                ('kind', '=', kind),
+                ('company', '=', company.id),
+                ], limit=1)
+    accounts['tax'], = Account.search([
+            ('name', '=', 'Main Tax'),
+            ('company', '=', company.id),
+            ], limit=1)
+    return accounts
+
+
+def create_taxes(company, accounts, count, recargo):
+    '''
+    Create count taxes with the issued and received book keys. If recargo is
+    set, half of them have a child tax of recargo de equivalencia.
+    '''
+    pool = Pool()
+    Tax = pool.get('account.tax')
+    ModelData = pool.get('ir.model.data')
+
+    key_e = ModelData.get_id('aeat_340', 'aeat_340_key_E')
+    key_r = ModelData.get_id('aeat_340', 'aeat_340_key_R')
+
+    def tax_values(name, rate):
+        return {
+            'name': name,
+            'description': name,
+            'type': 'percentage',
+            'rate': rate,
+            'company': company.id,
+            'invoice_account': accounts['tax'].id,
+            'credit_note_account': accounts['tax'].id,
+            'aeat340_book_keys': [('add', [key_e, key_r])],
+            'aeat340_default_out_book_key': key_e,
+            'aeat340_default_in_book_key': key_r,
+            }
+
+    # recargo_equivalencia is defined by account_es
+    recargo = recargo and 'recargo_equivalencia' in Tax._fields
+    vlist = []
+    for i in range(count):
+        rate = TAX_RATES[i % len(TAX_RATES)]
+        if recargo and i % 2:
+            values = tax_values('IVA %s%% + RE %s' % (rate * 100, i), None)
+            recargo_values = tax_values('RE %s' % i, RECARGO_RATES[rate])
+            recargo_values['recargo_equivalencia'] = True
+            values.update({
+                    'type': 'none',
+                    'childs': [('create', [
+                                tax_values('IVA %s%% %s' % (rate * 100, i),
+                                    rate),
+                                recargo_values,
+                                ])],
+                    })
+            del values['rate']
+        else:
+            values = tax_values('IVA %s%% %s' % (rate * 100, i), rate)
+        vlist.append(values)
+    return Tax.create(vlist)
+
+
+def create_parties(count):
+    'Create count parties with a Spanish VAT number'
+    Party = Pool().get('party.party')
+    return Party.create([{
+                'name': 'Party %s' % i,
+                'addresses': [('create', [{}])],
+                'identifiers': [('create', [{
+                                'type': 'eu_vat',
+                                'code': 'ES%s' % nif(1000 + i),
+                                }])],
+                } for i in range(count)])
+
+
+def create_invoices(company, accounts, fiscalyear, parties, taxes, count,
+        lines=1, tickets=0, seed=None):
+    '''
+    Create count draft invoices of the first quarter of fiscalyear with
+    random parties, taxes and amounts. tickets is the ratio of invoices that
+    are ticket summaries.
+    '''
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    ModelData = pool.get('ir.model.data')
+
+    journals = {
+        'out': ModelData.get_id('account', 'journal_revenue'),
+        'in': ModelData.get_id('account', 'journal_expense'),
+        }
+    term, = PaymentTerm.create([{
+                'name': 'Direct',
+                'lines': [('create', [{'type': 'remainder'}])],
+                }])
+    rng = random.Random(seed)
+    vlist = []
+    for i in range(count):
+        type_ = 'in' if i % 3 == 2 else 'out'
+        invoice_date = fiscalyear.start_date + datetime.timedelta(
+            days=rng.randint(0, 89))
+        ticket = rng.random() < tickets
+        invoice_lines = []
+        for j in range(lines):
+            tax = rng.choice(taxes)
+            line = {
+                'type': 'line',
+                'description': 'Line %s' % j,
+                'account': (accounts['revenue'].id if type_ == 'out'
+                    else accounts['expense'].id),
+                'quantity': 1,
+                'unit_price': Decimal(rng.randint(100, 100000)) / 100,
+                'taxes': [('add', [tax.id])],
+                }
+            if ticket:
+                line['aeat340_operation_key'] = 'B'
+            invoice_lines.append(line)
+        party = rng.choice(parties)
+        vlist.append({
+                'type': type_,
+                'company': company.id,
+                'journal': journals[type_],
+                'party': party.id,
+                'invoice_address': party.addresses[0].id,
+                'account': (accounts['receivable'].id if type_ == 'out'
+                    else accounts['payable'].id),
+                'currency': company.currency.id,
+                'payment_term': term.id,
+                'invoice_date': invoice_date,
+                'reference': 'REF%s' % i if type_ == 'in' else None,
+                'lines': [('create', invoice_lines)],
+                })
+    return Invoice.create(vlist)
+
+
+def create_posted_invoices(company, count, year=2026, lines=2):
+    'Create and post count invoices of company and return the fiscal year'
+    Invoice = Pool().get('account.invoice')
+    fiscalyear = create_fiscalyear(company, year)
+    accounts = get_accounts(company)
+    taxes = create_taxes(company, accounts, 2, False)
+    parties = create_parties(3)
+    invoices = create_invoices(company, accounts, fiscalyear, parties, taxes,
+        count, lines=lines, seed=1)
+    Invoice.post(invoices)
+    return fiscalyear, invoices
+
+
+def create_report(company, fiscalyear, period, **values):
+    'Create the AEAT 340 report of the period of fiscalyear'
+    Report = Pool().get('aeat.340.report')
+    values.update({
+            'company': company.id,
+            'fiscalyear': fiscalyear.id,
+            'fiscalyear_code': fiscalyear.start_date.year,
+            'company_vat': nif(1),
+            'period': period,
+            'contact_phone': '999999999',
+            'contact_name': 'Test',
+            'representative_vat': nif(2),
+            })
+    report, = Report.create([values])
+    return report
+
+
+def get_line_records(report):
+    'Return the record ids of each line of report'
+    return dict(((l.__name__, l.id), sorted(r.id for r in l.records))
+        for l in (report.issued_lines + report.received_lines
+            + report.investment_lines + report.intracommunity_lines))
+
+
+@contextmanager
+def no_commit():
+    'Ignore the commits of the transaction to keep the test isolated'
+    transaction = Transaction()
+    transaction.commit = lambda: None
+    try:
+        yield
+    finally:
+        del transaction.commit
 
 
 class Aeat340TestCase(ModuleTestCase):
     'Test Aeat 340 module'
     module = 'aeat_340'
 
+    @with_transaction()
+    def test_available_keys_tax_hierarchy(self):
+        'Test available keys of invoice lines with multi-level taxes'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Tax = pool.get('account.tax')
+        Type = pool.get('aeat.340.type')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            tax_account, = Account.search([
+                    ('name', '=', 'Main Tax'),
+                    ])
+            key_e, = Type.search([('book_key', '=', 'E')])
+            key_r, = Type.search([('book_key', '=', 'R')])
+            key_i, = Type.search([('book_key', '=', 'I')])
+
+            def tax_values(name, keys, childs=None):
+                values = {
+                    'name': name,
+                    'description': name,
+                    'type': 'none' if childs else 'percentage',
+                    'aeat340_book_keys': [('add', [k.id for k in keys])],
+                    }
+                if childs:
+                    values['childs'] = [('create', childs)]
+                else:
+                    values.update({
+                            'rate': Decimal('0.1'),
+                            'invoice_account': tax_account.id,
+                            'credit_note_account': tax_account.id,
+                            })
+                return values
+
+            tax, = Tax.create([tax_values('Root', [key_e], [
+                            tax_values('Child', [], [
+                                    tax_values('Grandchild 1', [key_r]),
+                                    tax_values('Grandchild 2', [key_i]),
+                                    ]),
+                            ])])
+            single, = Tax.create([tax_values('Single', [key_e])])
+
+            line = InvoiceLine(taxes=[tax])
+            self.assertEqual(
+                sorted(line.on_change_with_aeat340_available_keys()),
+                sorted([key_e.id, key_r.id, key_i.id]))
+            line = InvoiceLine(taxes=[single])
+            self.assertEqual(line.on_change_with_aeat340_available_keys(),
+                [key_e.id])
+
+            # Once computed, the keys are served without any query
+            line = InvoiceLine(taxes=[tax, single])
+            with count_queries() as counter:
+                for _ in range(100):
+                    keys = line.on_change_with_aeat340_available_keys()
+            self.assertEqual(counter[0], 0)
+            self.assertEqual(sorted(keys),
+                sorted([key_e.id, key_r.id, key_i.id]))
+
+            # Modifying a tax invalidates the closure
+            grandchild, = Tax.search([('name', '=', 'Grandchild 2')])
+            Tax.write([grandchild], {
+                    'aeat340_book_keys': [('remove', [key_i.id])],
+                    })
+            line = InvoiceLine(taxes=[tax])
+            self.assertEqual(
+                sorted(line.on_change_with_aeat340_available_keys()),
+                sorted([key_e.id, key_r.id]))
+
+    def test_valid_nif(self):
+        'Test Spanish NIF validation'
+        for nif in ['12345678Z', 'X1234567L', 'Y1234567X', 'B12345674',
+                'Q2826000H', 'P2807900B', 'N0032484H']:
+            self.assertTrue(valid_nif(nif), nif)
+        for nif in ['12345678A', '1234567Z', 'X1234567A', 'B12345675',
+                'Q28260008', 'ES12345678Z', '']:
+            self.assertFalse(valid_nif(nif), nif)
+
+    @with_transaction()
+    def test_line_validator(self):
+        'Test validation of report lines as tuples'
+        pool = Pool()
+        Issued = pool.get('aeat.340.report.issued')
+
+        validator = LineValidator(Issued)
+        valid = {
+            'id': 1,
+            'party_identifier_type': '1',
+            'party_nif': '12345678Z',
+            'party_name': 'Party',
+            'book_key': 'E',
+            'operation_key': ' ',
+            'invoice_number': 'INV1',
+            'property_state': '0',
+            }
+
+        def row(**values):
+            values = dict(valid, **values)
+            return tuple(values.get(c) for c in validator.columns)
+
+        self.assertEqual(validator.validate([row()]), [])
+        errors = validator.validate([
+                row(id=2, party_nif='12345678A'),
+                row(id=3, party_name='N' * 41),
+                row(id=4, party_identifier_type='4', party_nif=None,
+                    party_identifier='FR123'),
+                row(id=5, book_key='R'),
+                row(id=6, operation_key='R'),
+                row(id=7, operation_key='R', property_state='1',
+                    cadaster_number='1234567AB1234C0001DE'),
+                row(id=8, operation_key='R', property_state='3',
+                    cadaster_number='1234567AB1234C0001DE'),
+                row(id=9, cadaster_number='1234567AB1234C0001DE'),
+                row(id=10, operation_key='B', party_nif=None),
+                ])
+        self.assertEqual([(e.id, e.field, e.code) for e in errors], [
+                (2, 'party_nif', 'invalid_nif'),
+                (3, 'party_name', 'too_long'),
+                (4, 'party_country', 'invalid_country'),
+                (5, 'book_key', 'invalid_book_key'),
+                (6, 'property_state', 'invalid_property_state'),
+                (8, 'cadaster_number', 'unexpected_cadaster_number'),
+                (9, 'cadaster_number', 'unexpected_cadaster_number'),
+                ])
+        self.assertTrue(all(e.model == 'aeat.340.report.issued'
+                for e in errors))
+
+    def test_record_formatter(self):
+        'Test formatter writes the same lines than retrofix'
+        def values(field, variant):
+            if isinstance(field, type):
+                field = field()
+            if isinstance(field, Number):
+                return [None, '1', '42'][variant]
+            elif isinstance(field, Numeric):
+                if field._decimals == 0:
+                    return [None, 3, Decimal('12')][variant]
+                if field._sign == SIGN_POSITIVE:
+                    return [None, Decimal('21.00'), Decimal('5.2')][variant]
+                return [Decimal('0.00'), Decimal('-12.34'),
+                    Decimal('7.5')][variant]
+            elif isinstance(field, Date):
+                return [None, datetime.date(2026, 1, 31),
+                    datetime.date(2026, 12, 1)][variant]
+            return [None, u'Ñandú 100% €uro', u'X' * 200][variant]
+
+        for structure in [aeat340.PRESENTER_HEADER_RECORD,
+                aeat340.ISSUED_RECORD, aeat340.RECEIVED_RECORD,
+                aeat340.INVESTMENT_RECORD, aeat340.INTRACOMMUNITY_RECORD]:
+            columns = [f[2] for f in structure
+                if not isinstance(f[3], Const)]
+            formatter = RecordFormatter(structure, columns)
+            records, lines = [], []
+            for variant in range(3):
+                row = [values(f[3], variant) for f in structure
+                    if not isinstance(f[3], Const)]
+                record = Record(structure)
+                for column, value in zip(columns, row):
+                    if value:
+                        setattr(record, column, value)
+                records.append(record)
+                lines.append(formatter.format(row))
+            self.assertEqual(write(lines), retrofix_write(records))
+
+            defaults = {'fiscalyear': '2026', 'nif': '12345678Z'}
+            record = Record(structure)
+            for name, value in defaults.items():
+                setattr(record, name, value)
+            self.assertEqual(
+                RecordFormatter(structure, [], defaults).format(()),
+                record.write())
+
+    @with_transaction()
+    def test_count_queries(self):
+        'Test count_queries counts the queries of the transaction connection'
+        pool = Pool()
+        Party = pool.get('party.party')
+        transaction = Transaction()
+        connection = transaction.connection
+
+        with instrumentation.count_queries() as counter:
+            self.assertNotEqual(transaction.connection, connection)
+            cursor = transaction.connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 2')
+            self.assertEqual(counter[0], 2)
+            Party.search([])
+            self.assertGreater(counter[0], 2)
+        self.assertEqual(transaction.connection, connection)
+
+        with self.assertRaises(ValueError):
+            with instrumentation.count_queries():
+                raise ValueError
+        self.assertEqual(transaction.connection, connection)
+
+    def test_compare_read_file(self):
+        'Test reading of 340 files to compare'
+        names = ['book_key', 'invoice_number', 'tax_rate', 'base']
+        record = Record(aeat340.ISSUED_RECORD)
+        number = u'F\xe0ctura 1 \u20ac'
+        for name, value in zip(names,
+                ('E', number, Decimal('21.00'), Decimal('-10.50'))):
+            setattr(record, name, value)
+        # Like create_file
+        data = remove_accents(retrofix_write([record])).upper().encode('iso-8859-1')
+        self.assertEqual(list(read_file([data], names)),
+            [('E', 'FACTURA 1', 2100, -1050)])
+        # The invoice numbers of the report are normalized like the file
+        self.assertEqual(CompareFile._file_text(number, 40), 'FACTURA 1')
+
+        corrupted = data[:98] + 'Z' + data[99:]
+        with self.assertRaises(FileError) as cm:
+            list(read_file(['1' + ' ' * 499, corrupted], names))
+        self.assertEqual(cm.exception.line_number, 2)
+
+    def test_accumulator(self):
+        'Test the aggregation of value dictionaries by key'
+        accumulator = Accumulator(['base', 'tax', 'equivalence_tax'],
+            'records', min_fields=['issue_date'],
+            max_fields=['operation_date'])
+        first = datetime.date(2026, 1, 10)
+        last = datetime.date(2026, 3, 5)
+
+        accumulator.merge('a', {
+                'name': 'A',
+                'base': Decimal('10.00'),
+                'tax': Decimal('2.10'),
+                'equivalence_tax': None,
+                'issue_date': last,
+                'operation_date': first,
+                'records': [('add', [1])],
+                })
+        accumulator.merge('a', {
+                'name': 'Other',
+                'base': Decimal('5.00'),
+                'tax': None,
+                'equivalence_tax': Decimal('0.26'),
+                'issue_date': first,
+                'operation_date': last,
+                'records': [('add', [2, 3])],
+                })
+        accumulator.merge('b', {
+                'name': 'B',
+                'tax': Decimal('1.00'),
+                'records': [],
+                })
+        accumulator.add('b', ids=[4], base=Decimal('7.00'),
+            tax=Decimal('0.50'), issue_date=first)
+
+        self.assertEqual(len(accumulator), 2)
+        self.assertIn('a', accumulator)
+        self.assertEqual(accumulator.get_vals('a'), {
+                'name': 'A',
+                'base': Decimal('15.00'),
+                'tax': Decimal('2.10'),
+                'equivalence_tax': Decimal('0.26'),
+                'issue_date': first,
+                'operation_date': last,
+                'records': [('add', [1, 2, 3])],
+                })
+        # base was missing in the first dictionary so it is never added
+        self.assertEqual(accumulator.get_vals('b'), {
+                'name': 'B',
+                'tax': Decimal('1.50'),
+                'issue_date': first,
+                'records': [('add', [4])],
+                })
+        self.assertEqual(accumulator.get_value('b', 'base'), None)
+        with self.assertRaises(KeyError):
+            accumulator.add('b', total=Decimal('1.00'))
+        with self.assertRaises(AssertionError):
+            accumulator.insert('b', {'name': 'B'})
+
+        accumulator.set_value('a', 'tax', Decimal('3.00'))
+        accumulator.set_value('b', 'base', Decimal('3.00'))
+        self.assertEqual(accumulator.get_value('a', 'tax'), Decimal('3.00'))
+        self.assertEqual(accumulator.get_value('b', 'base'), None)
+        del accumulator['b']
+        self.assertEqual([v['name'] for v in accumulator.vlist()], ['A'])
+
+    @with_transaction()
+    def test_instrumentation_callback(self):
+        'Test the registered callbacks receive the statistics of measures'
+        pool = Pool()
+        Party = pool.get('party.party')
+        received = []
+        callback = received.append
+
+        @instrumentation.instrumented('search', rows=lambda domain: 3)
+        def search(domain):
+            return Party.search(domain)
+
+        instrumentation.register_callback(callback)
+        try:
+            with instrumentation.measure('disabled', rows=1):
+                Party.search([])
+            self.assertEqual(received, [])
+
+            with Transaction().set_context(aeat340_instrument=True):
+                with instrumentation.measure('measure', rows=5):
+                    Party.search([])
+                    instrumentation.add_rows(2)
+                search([])
+        finally:
+            instrumentation.unregister_callback(callback)
+
+        self.assertEqual([s['name'] for s in received], ['measure', 'search'])
+        stats, search_stats = received
+        self.assertEqual(stats['rows'], 7)
+        self.assertEqual(stats['calls'], 1)
+        self.assertGreaterEqual(stats['queries'], 1)
+        self.assertGreaterEqual(stats['elapsed'], 0)
+        self.assertEqual(search_stats['rows'], 3)
+        self.assertGreaterEqual(search_stats['queries'], 1)
+
+    @with_transaction()
+    def test_archive_file(self):
+        'Test the file of an archived report reads back'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear = create_fiscalyear(company, 2026)
+            report = create_report(company, fiscalyear, '1T')
+            Report.calculate([report])
+            Report.process([report])
+            report = Report(report.id)
+            self.assertFalse(report.file_compressed)
+            self.assertFalse(report.filename.endswith('.gz'))
+            data = report.get_file_data()
+            self.assertEqual(data, bytes(report.file_))
+            self.assertEqual(data[:4], '1340')
+            self.assertEqual(len(data.splitlines()), report.record_count + 1)
+
+            Report.archive([report])
+            report = Report(report.id)
+            self.assertTrue(report.file_compressed)
+            self.assertTrue(report.filename.endswith('.txt.gz'))
+            self.assertNotEqual(bytes(report.file_), data)
+            self.assertEqual(report.get_file_data(), data)
+
+    @with_transaction()
+    def test_calculate_chunked(self):
+        'Test the cron calculation of a report by chunks'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        Staging = pool.get('aeat.340.report.staging')
+        transaction = Transaction()
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt():
+            raise Interrupted
+
+        def get_lines(report):
+            return sorted((l.__name__, l.invoice_number, l.tax_rate, l.base,
+                    l.tax) for l in Report(report.id).lines)
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 4)
+            expected = create_report(company, fiscalyear, '1T')
+            Report.calculate([expected])
+            self.assertEqual(expected.state, 'calculated')
+
+            report = create_report(company, fiscalyear, '1T')
+            with transaction.set_context(aeat340_calculation_chunk=2):
+                Report.calculate([report])
+                self.assertEqual(report.state, 'calculating')
+                self.assertEqual(report.calculation_done, 0)
+                total = report.calculation_total
+                self.assertGreater(total, 2)
+                self.assertEqual(report.calculation_progress, 0)
+                self.assertEqual(get_lines(report), [])
+
+                # Interrupted after the first chunk is committed
+                transaction.commit = interrupt
+                try:
+                    with self.assertRaises(Interrupted):
+                        Report.calculate_scheduled()
+                finally:
+                    del transaction.commit
+                report = Report(report.id)
+                self.assertEqual(report.state, 'calculating')
+                self.assertEqual(report.calculation_done, 2)
+                self.assertEqual(report.calculation_progress,
+                    100. * 2 / total)
+                self.assertTrue(Staging.search([
+                            ('report', '=', report.id),
+                            ]))
+                self.assertEqual(get_lines(report), [])
+
+                # The next run resumes after the last committed record
+                with no_commit():
+                    Report.calculate_scheduled()
+            report = Report(report.id)
+            self.assertEqual(report.state, 'calculated')
+            self.assertEqual(report.calculation_done, total)
+            self.assertEqual(report.calculation_progress, 100)
+            self.assertIsNone(report.calculation_last_record)
+            self.assertFalse(Staging.search([('report', '=', report.id)]))
+            self.assertEqual(get_lines(report), get_lines(expected))
+
+    @with_transaction()
+    def test_calculate_chunked_same_rate(self):
+        'Test a chunk boundary inside the records of a line'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Report = pool.get('aeat.340.report')
+
+        def get_lines(report):
+            return sorted((l.__name__, l.invoice_number, l.tax_rate, l.base,
+                    l.tax, l.issued_invoice_count, l.record_count)
+                for l in Report(report.id).lines)
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear = create_fiscalyear(company, 2026)
+            accounts = get_accounts(company)
+            taxes = create_taxes(company, accounts, 5, False)
+            tax1, tax2 = taxes[0], taxes[4]
+            self.assertEqual(tax1.rate, tax2.rate)
+            parties = create_parties(1)
+            invoice, = create_invoices(company, accounts, fiscalyear,
+                parties, [tax1], 1, lines=2)
+            self.assertEqual(invoice.type, 'out')
+            InvoiceLine.write([invoice.lines[1]], {
+                    'taxes': [('remove', [tax1.id]), ('add', [tax2.id])],
+                    })
+            Invoice.update_taxes([invoice])
+            Invoice.post([invoice])
+            invoice = Invoice(invoice.id)
+            self.assertEqual(len(invoice.aeat340_records), 2)
+
+            expected = create_report(company, fiscalyear, '1T')
+            Report.calculate([expected])
+            lines = get_lines(expected)
+            self.assertEqual(len(lines), 1)
+            self.assertEqual(lines[0][5], 1)
+
+            report = create_report(company, fiscalyear, '1T')
+            with Transaction().set_context(aeat340_calculation_chunk=1), \
+                    no_commit():
+                Report.calculate([report])
+                Report.calculate_scheduled()
+            self.assertEqual(Report(report.id).state, 'calculated')
+            self.assertEqual(get_lines(report), lines)
+
+    @with_transaction()
+    def test_invoice_line_create_keys(self):
+        'Test the keys of the lines are resolved once per create call'
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = create_spanish_company()
+        with set_company(company):
+            fiscalyear = create_fiscalyear(company, 2026)
+            accounts = get_accounts(company)
+            taxes = create_taxes(company, accounts, 4, False)
+            parties = create_parties(1)
+            invoices = create_invoices(company, accounts, fiscalyear,
+                parties, taxes, 6, lines=0)
+
+            def get_vlist(invoice, count, keys=False):
+                vlist = []
+                for i in range(count):
+                    line_taxes = [taxes[i % len(taxes)]]
+                    if i % 3 == 0:
+                        line_taxes.append(taxes[(i + 1) % len(taxes)])
+                    vals = {
+                        'invoice': invoice.id,
+                        'type': 'line',
+                        'description': 'Line %s' % i,
+                        'account': (accounts['revenue'].id
+                            if invoice.type == 'out'
+                            else accounts['expense'].id),
+                        'quantity': 1,
+                        'unit_price': Decimal(10),
+                        'taxes': [('add', [t.id for t in line_taxes])],
+                        }
+                    if keys:
+                        vals['aeat340_book_key'] = (
+                            InvoiceLine.get_aeat340_book_key(invoice.type,
+                                line_taxes))
+                        vals['aeat340_operation_key'] = (
+                            InvoiceLine.get_aeat340_operation_key(
+                                invoice.type))
+                    vlist.append(vals)
+                return vlist
+
+            def count(invoice, vlist):
+                with instrumentation.count_queries() as counter:
+                    InvoiceLine.create(vlist)
+                return counter[0]
+
+            # Fill the caches before counting
+            InvoiceLine.create(get_vlist(invoices[5], len(taxes)))
+            InvoiceLine.create(get_vlist(invoices[5], len(taxes), keys=True))
+
+            out_invoices = [i for i in invoices if i.type == 'out']
+            overheads = []
+            for count_, (resolved, preset) in zip((10, 20), (
+                        out_invoices[0:2], out_invoices[2:4])):
+                overheads.append(
+                    count(resolved, get_vlist(resolved, count_))
+                    - count(preset, get_vlist(preset, count_, keys=True)))
+            self.assertEqual(overheads[0], overheads[1])
+
+            for invoice in invoices[:3]:
+                vlist = get_vlist(invoice, 6)
+                for line in InvoiceLine.create(vlist):
+                    self.assertEqual(line.aeat340_book_key.id,
+                        InvoiceLine.get_aeat340_book_key(invoice.type,
+                            line.taxes))
+                    self.assertEqual(line.aeat340_operation_key,
+                        InvoiceLine.get_aeat340_operation_key(
+                            invoice.type))
+
+    @with_transaction()
+    def test_type_book_key_labels(self):
+        'Test the cached book key labels and the search by name of types'
+        pool = Pool()
+        Type = pool.get('aeat.340.type')
+
+        selection = dict(
+            Type.fields_get(['book_key'])['book_key']['selection'])
+        labels = Type.get_book_key_labels()
+        self.assertEqual(labels, selection)
+        with count_queries() as counter:
+            self.assertEqual(Type.get_book_key_labels(), labels)
+        self.assertEqual(counter[0], 0)
+
+        types = Type.search([])
+        self.assertTrue(types)
+        for type_ in types:
+            self.assertEqual(type_.rec_name, labels[type_.book_key])
+
+        key_e, = Type.search([('book_key', '=', 'E')])
+        key_r, = Type.search([('book_key', '=', 'R')])
+        self.assertEqual(Type.search([
+                    ('rec_name', '=', labels['E']),
+                    ]), [key_e])
+        self.assertEqual(Type.search([
+                    ('rec_name', '=', 'Unknown'),
+                    ]), [])
+        self.assertEqual(Type.search([
+                    ('rec_name', 'ilike', '%s%%' % labels['R'][:5].upper()),
+                    ]), [key_r])
+        self.assertEqual(sorted(Type.search([
+                        ('rec_name', 'in', [labels['E'], labels['R']]),
+                        ])), sorted([key_e, key_r]))
+        self.assertEqual(len(Type.search([
+                        ('rec_name', '!=', labels['E']),
+                        ])), len(types) - 1)
+
+    @with_transaction()
+    def test_reasign_records(self):
+        'Test reasigning the book key of the invoices'
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Type = pool.get('aeat.340.type')
+        Reasign = pool.get('aeat.340.reasign.records', type='wizard')
+
+        def reasign(invoices, book_key):
+            session_id, _, _ = Reasign.create()
+            wizard = Reasign(session_id)
+            wizard.start.aeat_340_type = book_key
+            wizard.start.operation_key = None
+            with Transaction().set_context(active_model='account.invoice',
+                    active_ids=[i.id for i in invoices]):
+                return wizard.transition_reasign()
+
+        def get_keys(invoice):
+            return set(r.book_key for r in Record.search([
+                        ('invoice', '=', invoice.id),
+                        ]))
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 3)
+            invoice, other = [i for i in invoices if i.type == 'out'][:2]
+            self.assertEqual(get_keys(invoice), set(['E']))
+
+            key_r, = Type.search([('book_key', '=', 'R')])
+            self.assertEqual(reasign([invoice], key_r), 'done')
+            self.assertEqual(set(l.aeat340_book_key for l in invoice.lines),
+                set([key_r]))
+            self.assertEqual(get_keys(invoice), set(['R']))
+            self.assertEqual(get_keys(other), set(['E']))
+
+            key_i, = Type.search([('book_key', '=', 'I')])
+            with self.assertRaises(UserError):
+                reasign([other], key_i)
+            self.assertEqual(get_keys(other), set(['E']))
+
+    @with_transaction()
+    def test_recalculate_job(self):
+        'Test the cron processing of the recalculate jobs'
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Job = pool.get('aeat.340.recalculate.job')
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 6)
+            invoice = invoices[0]
+            count = Record.search([('invoice', '=', invoice.id)],
+                count=True)
+            self.assertTrue(count)
+            Record.delete(Record.search([('invoice', '=', invoice.id)]))
+
+            job, = Job.create([{
+                        'company': company.id,
+                        'start_date': fiscalyear.start_date,
+                        'end_date': fiscalyear.end_date,
+                        }])
+            with no_commit():
+                Job.process_jobs()
+            job = Job(job.id)
+            self.assertEqual(job.state, 'done')
+            self.assertEqual(job.processed, 6)
+            self.assertEqual(job.changed, 1)
+            self.assertEqual(job.failed, 0)
+            self.assertEqual(job.last_invoice, max(i.id for i in invoices))
+            self.assertEqual(Record.search([('invoice', '=', invoice.id)],
+                    count=True), count)
+
+    @with_transaction()
+    def test_regenerate_records(self):
+        'Test regenerating the records only writes the changed ones'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.340.record')
+        record_table = Record.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def get_records():
+            return dict((r.id, (r.invoice.id, r.base, r.tax, r.write_date))
+                for r in Record.search([
+                        ('invoice', 'in', [i.id for i in invoices]),
+                        ]))
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 3)
+            records = get_records()
+            self.assertTrue(records)
+
+            Invoice.create_aeat340_records(invoices)
+            self.assertEqual(get_records(), records)
+
+            changed = min(records)
+            cursor.execute(*record_table.update([record_table.base],
+                    [record_table.base + 1],
+                    where=record_table.id == changed))
+            Invoice.create_aeat340_records(invoices)
+            new_records = get_records()
+            self.assertEqual(sorted(new_records), sorted(records))
+            self.assertIsNotNone(new_records[changed][3])
+            self.assertEqual(new_records.pop(changed)[:3],
+                records.pop(changed)[:3])
+            self.assertEqual(new_records, records)
+
+    @with_transaction()
+    def test_delete_invoice_records(self):
+        'Test the records of done reports can not be deleted'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        Record = pool.get('aeat.340.record')
+        RecordLine = pool.get('aeat.340.record-account.invoice.line')
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 3)
+            deleted, kept = invoices[:2]
+            report = create_report(company, fiscalyear, '1T')
+            Report.calculate([report])
+
+            self.assertTrue(RecordLine.search([
+                        ('invoice_line.invoice', '=', deleted.id),
+                        ]))
+            # The report is not done yet
+            Record.delete_invoice_records([deleted.id])
+            self.assertEqual(Record.search([
+                        ('invoice', '=', deleted.id),
+                        ]), [])
+            self.assertEqual(RecordLine.search([
+                        ('invoice_line.invoice', '=', deleted.id),
+                        ]), [])
+
+            Report.draft([report])
+            Report.calculate([report])
+            Report.process([report])
+            records = Record.search([('invoice', '=', kept.id)])
+            self.assertTrue(records)
+            with self.assertRaises(UserError):
+                Record.delete_invoice_records([kept.id])
+            self.assertEqual(Record.search([('invoice', '=', kept.id)]),
+                records)
+
+    @with_transaction()
+    def test_invoice_line_keep_keys(self):
+        'Test the keys of created and copied lines are not inferred again'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Type = pool.get('aeat.340.type')
+
+        def infer(*args):
+            self.fail('AEAT 340 key inferred')
+
+        reads = []
+        read = Invoice.read
+
+        def invoice_read(cls, ids, fields_names=None):
+            reads.append(fields_names)
+            return read(ids, fields_names=fields_names)
+
+        company = create_spanish_company()
+        with set_company(company):
+            fiscalyear = create_fiscalyear(company, 2026)
+            accounts = get_accounts(company)
+            taxes = create_taxes(company, accounts, 2, False)
+            parties = create_parties(1)
+            invoice, = create_invoices(company, accounts, fiscalyear,
+                parties, taxes, 1, lines=0)
+            key_r, = Type.search([('book_key', '=', 'R')])
+            self.assertNotIn(key_r, [t.aeat340_default_out_book_key
+                    for t in taxes])
+
+            InvoiceLine.get_aeat340_book_key = classmethod(infer)
+            InvoiceLine.get_aeat340_operation_key = classmethod(infer)
+            Invoice.read = classmethod(invoice_read)
+            try:
+                lines = InvoiceLine.create([{
+                            'invoice': invoice.id,
+                            'type': 'line',
+                            'description': 'Line %s' % i,
+                            'account': accounts['revenue'].id,
+                            'quantity': 1,
+                            'unit_price': Decimal(10),
+                            'taxes': [('add', [tax.id])],
+                            'aeat340_book_key': key_r.id,
+                            'aeat340_operation_key': 'B',
+                            } for i, tax in enumerate(taxes)])
+                copy, = Invoice.copy([invoice])
+            finally:
+                del InvoiceLine.get_aeat340_book_key
+                del InvoiceLine.get_aeat340_operation_key
+                del Invoice.read
+            # The types of the invoices are not read to infer the keys
+            self.assertNotIn(['type'], reads)
+
+            self.assertEqual(len(copy.lines), len(lines))
+            for line in lines + list(copy.lines):
+                self.assertEqual(line.aeat340_book_key, key_r)
+                self.assertEqual(line.aeat340_operation_key, 'B')
+
+    @with_transaction()
+    def test_migrate_party_data(self):
+        'Test the migration of the party of the records from its data'
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Party = pool.get('party.party')
+        TableHandler = backend.get('TableHandler')
+        record = Record.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            create_posted_invoices(company, 6)
+            cursor.execute(*record.select(record.id, record.party))
+            expected = dict(cursor.fetchall())
+            by_vat, by_name, ambiguous = Party.browse(
+                sorted(set(expected.values()))[:3])
+            ambiguous_records = sorted(r for r, p in expected.iteritems()
+                if p == ambiguous.id)
+            self.assertGreater(len(ambiguous_records), 1)
+            # Other parties with the same VAT number and name
+            Party.create([{
+                        'name': ambiguous.name,
+                        'identifiers': [('create', [{
+                                        'type': 'eu_vat',
+                                        'code': ambiguous.tax_identifier.code,
+                                        }])],
+                        }])
+
+            handler = TableHandler(Record, 'aeat_340')
+            handler.add_column('party_nif', 'VARCHAR')
+            handler.add_column('party_name', 'VARCHAR')
+            for where, nif, name in [
+                    (record.party == by_vat.id,
+                        by_vat.tax_identifier.code[2:], 'Unknown'),
+                    (record.party == by_name.id, None, by_name.name),
+                    (record.id == ambiguous_records[0],
+                        ambiguous.tax_identifier.code[2:], 'Nobody'),
+                    (record.party == ambiguous.id, None, ambiguous.name),
+                    ]:
+                cursor.execute(*record.update(
+                        [record.party_nif, record.party_name, record.party],
+                        [nif, name, None],
+                        where=where))
+
+            if not config.has_section('aeat_340'):
+                config.add_section('aeat_340')
+            config.set('aeat_340', 'migration_batch', '3')
+            try:
+                Record._migrate_party_data()
+            finally:
+                config.remove_option('aeat_340', 'migration_batch')
+
+            cursor.execute(*record.select(record.id, record.party))
+            migrated = dict(cursor.fetchall())
+            for record_id, party_id in expected.items():
+                if party_id == ambiguous.id:
+                    party_id = None
+                self.assertEqual(migrated[record_id], party_id)
+            self.assertIn(by_vat.id, migrated.values())
+            self.assertIn(by_name.id, migrated.values())
+
+    @with_transaction()
+    def test_record_fiscal_snapshot(self):
+        'Test the records keep the fiscal data of the party'
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Party = pool.get('party.party')
+        table = Record.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 1)
+            invoice, = invoices
+            party = invoice.party
+            nif = party.tax_identifier.code[2:]
+            self.assertEqual(len(nif), 9)
+            records = Record.search([('invoice', '=', invoice.id)])
+            self.assertTrue(records)
+            for record in records:
+                self.assertEqual(record.get_fiscal_values(), {
+                        'fiscal_name': party.name,
+                        'fiscal_nif': nif,
+                        'fiscal_identifier': '',
+                        'fiscal_identifier_type': '1',
+                        'fiscal_country': 'ES',
+                        })
+
+            name = party.name
+            Party.write([party], {'name': 'Renamed'})
+            for record in Record.browse(records):
+                self.assertEqual(record.get_fiscal_values()['fiscal_name'],
+                    name)
+
+            report = create_report(company, fiscalyear,
+                '%02d' % records[0].month)
+
+        with set_company(company):
+            report.check_foreign_vat()
+            # The check uses the stored identifier type
+            cursor.execute(*table.update([table.fiscal_identifier_type],
+                    ['2']))
+            with self.assertRaises(UserWarning):
+                report.check_foreign_vat()
+            # and older records the current data of the party
+            cursor.execute(*table.update([table.fiscal_identifier_type],
+                    [None]))
+            report.check_foreign_vat()
+
+    @with_transaction()
+    def test_record_summary(self):
+        'Test the summary of the records is updated with the records'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.340.record')
+        Summary = pool.get('aeat.340.record.summary')
+        cent = Decimal('0.01')
+
+        def add(total, value):
+            if value is None:
+                return total
+            return (total or 0) + value
+
+        def get_expected():
+            expected = {}
+            invoices = {}
+            for record in Record.search([]):
+                key = (record.fiscalyear.id, record.month, record.book_key,
+                    record.operation_key, record.tax_rate.quantize(cent))
+                base, tax, total, equivalence_tax, count = expected.get(
+                    key, (None, None, None, None, 0))
+                expected[key] = (add(base, record.base),
+                    add(tax, record.tax), add(total, record.total),
+                    add(equivalence_tax, record.equivalence_tax), count + 1)
+                invoices.setdefault(key, set()).add(record.invoice.id)
+            return dict((k, tuple(v.quantize(cent) if v is not None else v
+                            for v in values[:4])
+                        + (values[4], len(invoices[k])))
+                for k, values in expected.items())
+
+        def get_summary():
+            return dict(((s.fiscalyear.id, s.month, s.book_key,
+                            s.operation_key, s.tax_rate.quantize(cent)),
+                        tuple(v.quantize(cent) if v is not None else v
+                            for v in [s.base, s.tax, s.total,
+                                s.equivalence_tax])
+                        + (s.record_count, s.invoice_count))
+                for s in Summary.search([]))
+
+        def get_ids():
+            return dict(((s.fiscalyear.id, s.month, s.book_key,
+                            s.operation_key, s.tax_rate.quantize(cent)), s.id)
+                for s in Summary.search([]))
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 6)
+            expected = get_expected()
+            self.assertTrue(expected)
+            self.assertEqual(get_summary(), expected)
+
+            ids = get_ids()
+            invoice = invoices[0]
+            keys = set((r.fiscalyear.id, r.month, r.book_key,
+                    r.operation_key, r.tax_rate.quantize(cent))
+                for r in invoice.aeat340_records)
+            Record.delete_invoice_records([invoice.id])
+            self.assertEqual(get_summary(), get_expected())
+            # Only the rows of the deleted records are updated
+            for key, id_ in get_ids().iteritems():
+                self.assertEqual(id_, ids[key])
+            self.assertTrue(keys & set(ids))
+
+            Invoice.create_aeat340_records([invoice])
+            self.assertEqual(get_summary(), expected)
+            for key, id_ in get_ids().iteritems():
+                if key not in keys:
+                    self.assertEqual(id_, ids[key])
+
+            month = Record.search([], limit=1)[0].month
+            Record.delete_invoice_records(list(set(r.invoice.id
+                        for r in Record.search([('month', '=', month)]))))
+            self.assertFalse([k for k in get_summary() if k[1] == month])
+            self.assertEqual(get_summary(), get_expected())
+
+            Summary.refresh()
+            self.assertEqual(get_summary(), get_expected())
+
+    @with_transaction()
+    def test_rollup_keeps_records(self):
+        'Test the sub-period reports keep their records after a roll up'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 6)
+            quarter = create_report(company, fiscalyear, '1T')
+            Report.calculate([quarter])
+            quarter = Report(quarter.id)
+            records = get_line_records(quarter)
+            self.assertTrue(all(records.values()))
+
+            year = create_report(company, fiscalyear, '0A', rollup=True)
+            Report.calculate([year])
+            year = Report(year.id)
+            self.assertEqual(len(get_line_records(year)), len(records))
+            self.assertEqual(get_line_records(Report(quarter.id)), records)
+
+    @with_transaction()
+    def test_complementary_changes(self):
+        'Test the complementary report only has the changed lines'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        Record = pool.get('aeat.340.record')
+        record = Record.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def get_lines(report):
+            return sorted((l.invoice_number, l.book_key, l.tax_rate, l.base,
+                    l.tax, l.total) for l in Report(report.id).lines)
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 4)
+            previous = create_report(company, fiscalyear, '1T')
+            Report.calculate([previous])
+            Report.process([previous])
+            self.assertEqual(previous.state, 'done')
+            old_lines = get_lines(previous)
+            old_records = get_line_records(previous)
+
+            changed, removed = invoices[:2]
+            to_change = Record.search([('invoice', '=', changed.id)],
+                limit=1)
+            Record.write(to_change, {
+                    'base': to_change[0].base + 1,
+                    'total': to_change[0].total + 1,
+                    })
+            cursor.execute(*record.delete(
+                    where=record.invoice == removed.id))
+
+            report = create_report(company, fiscalyear, '1T', type='C')
+            Report.calculate([report])
+            lines = get_lines(report)
+
+            self.assertEqual(
+                [l for l in lines if l[0] == removed.number],
+                sorted((n, k, r, -b, -t, -a)
+                    for n, k, r, b, t, a in old_lines
+                    if n == removed.number))
+            for line in Report(report.id).lines:
+                if line.invoice_number == removed.number:
+                    self.assertEqual(line.record_count, 0)
+                    for name in ('issued_invoice_count',
+                            'received_invoice_count'):
+                        self.assertFalse(getattr(line, name, 0))
+                    self.assertFalse(line.records)
+            changed_lines = [l for l in lines if l[0] == changed.number]
+            self.assertEqual(len(changed_lines), 1)
+            self.assertNotIn(changed_lines[0], old_lines)
+            self.assertFalse([l for l in lines
+                    if l[0] not in (changed.number, removed.number)])
+
+            # The unchanged lines keep their records
+            new_records = get_line_records(Report(previous.id))
+            for key, record_ids in old_records.iteritems():
+                invoice_ids = set(r.invoice.id
+                    for r in Record.browse(record_ids))
+                if invoice_ids & set([changed.id, removed.id]):
+                    continue
+                self.assertEqual(new_records[key], record_ids)
+
+    @with_transaction()
+    def test_export_access(self):
+        'Test the export only reads the data of the companies of the user'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        Export = pool.get('aeat.340.export', type='wizard')
+
+        def export(source, **values):
+            session_id, _, _ = Export.create()
+            wizard = Export(session_id)
+            wizard.start.source = source
+            for name, value in values.iteritems():
+                setattr(wizard.start, name, value)
+            columns, rows = wizard.get_rows()
+            return list(rows)
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 3)
+            report = create_report(company, fiscalyear, '1T')
+            Report.calculate([report])
+            records = dict(source='records', company=company,
+                start_date=fiscalyear.start_date,
+                end_date=fiscalyear.end_date)
+            self.assertTrue(export(**records))
+            self.assertTrue(export('lines', report=report))
+
+        other = create_spanish_company()
+        with set_company(other):
+            with self.assertRaises(UserError):
+                export(**records)
+            with self.assertRaises(UserError):
+                export('lines', report=report)
+
+    @with_transaction()
+    def test_export_file(self):
+        'Test the export streams the file to an attachment'
+        pool = Pool()
+        Report = pool.get('aeat.340.report')
+        Record = pool.get('aeat.340.record')
+        Export = pool.get('aeat.340.export', type='wizard')
+
+        def export(format_, **values):
+            session_id, _, _ = Export.create()
+            wizard = Export(session_id)
+            wizard.start.format_ = format_
+            for name, value in values.iteritems():
+                setattr(wizard.start, name, value)
+            self.assertEqual(wizard.transition_export(), 'result')
+            return wizard.result.attachment
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 3)
+            report = create_report(company, fiscalyear, '1T')
+            Report.calculate([report])
+            report = Report(report.id)
+
+            attachment = export('csv', source='lines', report=report)
+            self.assertEqual(str(attachment.resource), str(report))
+            self.assertEqual(attachment.name,
+                'aeat340-%s-1T.csv' % report.fiscalyear_code)
+            self.assertTrue(attachment.file_id)
+            rows = list(csv.reader(str(attachment.data).splitlines()))
+            self.assertEqual(len(rows), len(list(report.lines)) + 1)
+            self.assertEqual(rows[0][0], 'line_type')
+
+            # The same export replaces the file of the attachment
+            self.assertEqual(
+                export('csv', source='lines', report=report), attachment)
+
+            records = Record.search([])
+            attachment = export('jsonl', source='records', company=company,
+                start_date=fiscalyear.start_date,
+                end_date=fiscalyear.end_date)
+            self.assertEqual(str(attachment.resource), str(company))
+            rows = [json.loads(l) for l in str(attachment.data).splitlines()]
+            self.assertEqual(sorted(r['invoice_number'] for r in rows),
+                sorted(r.invoice.number for r in records))
+
+    @with_transaction()
+    def test_ledger_reconciliation(self):
+        'Test the reconciliation of the records with the ledger'
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Reconciliation = pool.get('aeat.340.ledger.reconciliation')
+        ReconciliationInvoice = pool.get(
+            'aeat.340.ledger.reconciliation.invoice')
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            # With one line the taxes of the records are not rounded apart
+            fiscalyear, invoices = create_posted_invoices(company, 4,
+                lines=1)
+            missing, stale = [i for i in invoices if i.type == 'out'][:2]
+
+        context = {
+            'company': company.id,
+            'fiscalyear': fiscalyear.id,
+            'start_month': 1,
+            'end_month': 12,
+            }
+        with set_company(company), Transaction().set_context(context):
+            rows = Reconciliation.search([])
+            self.assertTrue(rows)
+            self.assertEqual(sum(r.ledger_base for r in rows),
+                sum(abs(i.untaxed_amount) for i in invoices))
+            for row in rows:
+                self.assertEqual(row.company, company)
+                self.assertEqual(row.base_difference, 0)
+                self.assertEqual(row.tax_difference, 0)
+                self.assertEqual(row.missing_invoices, 0)
+                self.assertEqual(row.stale_invoices, 0)
+            self.assertEqual(ReconciliationInvoice.search([]), [])
+
+            Record.delete_invoice_records([missing.id])
+            record, = Record.search([('invoice', '=', stale.id)], limit=1)
+            Record.write([record], {'base': record.base + 1})
+
+            rows = Reconciliation.search([])
+            self.assertEqual(sum(r.missing_invoices for r in rows), 1)
+            self.assertEqual(sum(r.stale_invoices for r in rows), 1)
+            self.assertEqual(sum(r.base_difference for r in rows),
+                1 - missing.untaxed_amount)
+            self.assertEqual(
+                sorted((r.invoice, r.status, r.ledger_base)
+                    for r in ReconciliationInvoice.search([])),
+                sorted([(missing, 'missing', missing.untaxed_amount),
+                        (stale, 'stale', stale.untaxed_amount)]))
+
+        # The rows of other companies are not readable
+        other = create_spanish_company()
+        with set_company(other), Transaction().set_context(context):
+            self.assertEqual(Reconciliation.search([]), [])
+            self.assertEqual(ReconciliationInvoice.search([]), [])
+
+    @with_transaction()
+    def test_migrate_account_tax(self):
+        'Test the migration of the tax of the records'
+        pool = Pool()
+        Record = pool.get('aeat.340.record')
+        Reconciliation = pool.get('aeat.340.ledger.reconciliation')
+        table = Record.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_spanish_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            fiscalyear, invoices = create_posted_invoices(company, 4,
+                lines=1)
+        records = Record.search([])
+        taxes = dict((r.id, r.account_tax.id) for r in records)
+        self.assertTrue(all(taxes.values()))
+        cursor.execute(*table.update([table.account_tax], [None]))
+
+        context = {
+            'company': company.id,
+            'fiscalyear': fiscalyear.id,
+            }
+        # The records without tax are not reconciled
+        with set_company(company), Transaction().set_context(context):
+            self.assertEqual(sum(r.record_base
+                    for r in Reconciliation.search([])), 0)
+
+        if not config.has_section('aeat_340'):
+            config.add_section('aeat_340')
+        config.set('aeat_340', 'migration_batch', '3')
+        try:
+            Record._migrate_account_tax()
+        finally:
+            config.remove_option('aeat_340', 'migration_batch')
+        cursor.execute(*table.select(table.id, table.account_tax))
+        self.assertEqual(dict(cursor.fetchall()), taxes)
+        with set_company(company), Transaction().set_context(context):
+            for row in Reconciliation.search([]):
+                self.assertEqual(row.base_difference, 0)
+                self.assertEqual(row.missing_invoices, 0)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
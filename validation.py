@@ -0,0 +1,178 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Validation of the lines of the AEAT 340 reports before the file is created
+
+The lines are checked as tuples read in bulk from the database with regular
+expressions and lookup tables compiled once per line model from its field
+definitions, so errors that AEAT would reject are found for all the lines
+of a report at once.
+"""
+import re
+from collections import namedtuple
+
+from trytond.model import fields
+
+__all__ = ['LineError', 'LineValidator', 'valid_nif']
+
+LineError = namedtuple('LineError', ['model', 'id', 'field', 'code', 'value'])
+
+NIF_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+CIF_LETTERS = 'JABCDEFGHI'
+_DNI = re.compile(r'^([KLMXYZ0-9])([0-9]{7})([A-Z])$')
+_CIF = re.compile(r'^([ABCDEFGHJNPQRSUVW])([0-9]{7})([0-9A-J])$')
+_COUNTRY = re.compile(r'^[A-Z]{2}$')
+_CADASTER = re.compile(r'^[0-9A-Z]{20}$')
+# The K, L and M NIFs and the NIEs use the letter of the DNI of their number
+_NIE_PREFIX = {'X': '0', 'Y': '1', 'Z': '2', 'K': '', 'L': '', 'M': ''}
+
+
+def _cif_control(digits):
+    total = sum(int(d) for d in digits[1::2])
+    for d in digits[0::2]:
+        total += sum(divmod(int(d) * 2, 10))
+    return (10 - total % 10) % 10
+
+
+def valid_nif(nif):
+    'Return if nif is a valid Spanish NIF, NIE or CIF'
+    match = _DNI.match(nif)
+    if match:
+        first, digits, letter = match.groups()
+        number = int(_NIE_PREFIX.get(first, first) + digits)
+        return letter == NIF_LETTERS[number % 23]
+    match = _CIF.match(nif)
+    if match:
+        first, digits, control = match.groups()
+        value = _cif_control(digits)
+        if first in 'ABEH':
+            return control == str(value)
+        elif first in 'KNPQRSW':
+            return control == CIF_LETTERS[value]
+        return control in (str(value), CIF_LETTERS[value])
+    return False
+
+
+class LineValidator(object):
+    '''
+    Check the rows of the columns of a line model.
+
+    The checks are compiled from the fields of the line model and the
+    validate method returns a list of LineError for the rows.
+    '''
+
+    def __init__(self, Line):
+        self.model = Line.__name__
+        columns = ['id'] + [f for f in Line._get_record_columns()
+            if f != 'id']
+        for name in ['party_identifier_type', 'party_nif', 'party_name',
+                'party_country', 'party_identifier', 'book_key',
+                'operation_key', 'invoice_number', 'property_state',
+                'cadaster_number']:
+            if name in Line._fields and name not in columns:
+                columns.append(name)
+        self.columns = columns
+        self.index = dict((c, i) for i, c in enumerate(columns))
+        self.book_keys = frozenset(getattr(Line, '_possible_keys', None)
+            or [k for k, _ in Line.book_key.selection])
+        self.operation_keys = frozenset(
+            k for k, _ in Line.operation_key.selection)
+        self.sizes = [(self.index[c], c, Line._fields[c].size)
+            for c in columns
+            if isinstance(Line._fields[c], fields.Char)
+            and Line._fields[c].size]
+        self.property_states = (frozenset(
+                k for k, _ in Line.property_state.selection)
+            if 'property_state' in self.index else None)
+        self._nifs = {}
+
+    def check_nif(self, nif):
+        valid = self._nifs.get(nif)
+        if valid is None:
+            valid = self._nifs[nif] = valid_nif(nif)
+        return valid
+
+    def validate(self, rows):
+        'Return the list of LineError of rows'
+        errors = []
+        append = errors.append
+        model = self.model
+        index = self.index
+        id_ = index['id']
+        identifier_type = index['party_identifier_type']
+        nif = index['party_nif']
+        name = index['party_name']
+        country = index['party_country']
+        identifier = index['party_identifier']
+        book_key = index['book_key']
+        operation_key = index['operation_key']
+        invoice_number = index['invoice_number']
+        property_state = index.get('property_state')
+        cadaster_number = index.get('cadaster_number')
+        book_keys = self.book_keys
+        operation_keys = self.operation_keys
+        sizes = self.sizes
+        property_states = self.property_states
+        check_nif = self.check_nif
+        country_match = _COUNTRY.match
+        cadaster_match = _CADASTER.match
+
+        for row in rows:
+            line = row[id_]
+            if row[book_key] not in book_keys:
+                append(LineError(model, line, 'book_key',
+                        'invalid_book_key', row[book_key]))
+            if row[operation_key] not in operation_keys:
+                append(LineError(model, line, 'operation_key',
+                        'invalid_operation_key', row[operation_key]))
+            for i, field, size in sizes:
+                if row[i] and len(row[i]) > size:
+                    append(LineError(model, line, field, 'too_long', row[i]))
+            if not row[name]:
+                append(LineError(model, line, 'party_name', 'missing_name',
+                        row[name]))
+            if not row[invoice_number]:
+                append(LineError(model, line, 'invoice_number',
+                        'missing_invoice_number', row[invoice_number]))
+            if row[identifier_type] == '1':
+                value = row[nif]
+                if value:
+                    if not check_nif(value):
+                        append(LineError(model, line, 'party_nif',
+                                'invalid_nif', value))
+                elif row[operation_key] != 'B':
+                    append(LineError(model, line, 'party_nif',
+                            'missing_nif', value))
+            else:
+                if not row[country] or not country_match(row[country]):
+                    append(LineError(model, line, 'party_country',
+                            'invalid_country', row[country]))
+                if not row[identifier]:
+                    append(LineError(model, line, 'party_identifier',
+                            'missing_identifier', row[identifier]))
+            if property_states is None:
+                continue
+            state = row[property_state]
+            cadaster = row[cadaster_number]
+            if row[operation_key] == 'R':
+                if state not in property_states or state == '0':
+                    append(LineError(model, line, 'property_state',
+                            'invalid_property_state', state))
+                elif state in ('1', '2'):
+                    if not cadaster:
+                        append(LineError(model, line, 'cadaster_number',
+                                'missing_cadaster_number', cadaster))
+                    elif state == '1' and not cadaster_match(cadaster):
+                        append(LineError(model, line, 'cadaster_number',
+                                'invalid_cadaster_number', cadaster))
+                elif cadaster:
+                    append(LineError(model, line, 'cadaster_number',
+                            'unexpected_cadaster_number', cadaster))
+            else:
+                if state not in ('0', None):
+                    append(LineError(model, line, 'property_state',
+                            'invalid_property_state', state))
+                if cadaster:
+                    append(LineError(model, line, 'cadaster_number',
+                            'unexpected_cadaster_number', cadaster))
+        return errors